@@ -0,0 +1,584 @@
+from multiprocessing.managers import BaseManager
+import multiprocessing as mp
+import JTrojan2.communication as comm
+import JTrojan2.network as net
+import JTrojan2.server as server
+import JTrojan2.tracing as tracing
+import concurrent.futures
+import threading
+import itertools
+import socket
+import queue
+import time
+
+
+class AgentDirectory:
+    """
+    The AgentDirectory records, which node of the cluster holds the connection of which trojan and at which address
+    every node can be reached. It is served to all the nodes by a DirectoryManager, see 'serve_directory', thus all its
+    methods take and return lists, so that a node needs a single round trip for many trojans.
+    """
+    def __init__(self):
+        # The dict with the string node names as keys and the (ip, port) tuples of the nodes as values
+        self._nodes = {}
+        # The dict with the string trojan ids as keys and the string names of their nodes as values
+        self._locations = {}
+        self._lock = threading.Lock()
+
+    def register_node(self, node, address):
+        """
+        Adds the node of the given name, which can be reached at the given address, to the cluster
+        Args:
+            node: The string name of the node
+            address: The (ip, port) tuple of the node
+
+        Returns:
+        void
+        """
+        with self._lock:
+            self._nodes[node] = tuple(address)
+
+    def unregister_node(self, node):
+        """
+        Removes the node and all the trojans it holds from the directory
+        Args:
+            node: The string name of the node
+
+        Returns:
+        void
+        """
+        with self._lock:
+            self._nodes.pop(node, None)
+            self._locations = {trojan_id: owner for trojan_id, owner in self._locations.items() if owner != node}
+
+    def node_address(self, node):
+        """
+        Returns the (ip, port) tuple of the node of the given name
+        Raises:
+            KeyError: In case the node is not part of the cluster
+        """
+        with self._lock:
+            return self._nodes[node]
+
+    def nodes(self):
+        """
+        Returns the list of the string names of all the nodes of the cluster
+        """
+        with self._lock:
+            return list(self._nodes)
+
+    def claim(self, trojan_ids, node):
+        """
+        Records, that the given node holds the connections of the given trojans. A trojan, that reconnects to another
+        node, is simply claimed by that node
+        Args:
+            trojan_ids: The list of the string trojan ids
+            node: The string name of the node
+
+        Returns:
+        void
+        """
+        with self._lock:
+            for trojan_id in trojan_ids:
+                self._locations[trojan_id] = node
+
+    def release(self, trojan_ids, node):
+        """
+        Removes the given trojans from the directory, unless they were claimed by another node in the meantime
+        Args:
+            trojan_ids: The list of the string trojan ids
+            node: The string name of the node, that held them
+
+        Returns:
+        void
+        """
+        with self._lock:
+            for trojan_id in trojan_ids:
+                if self._locations.get(trojan_id) == node:
+                    del self._locations[trojan_id]
+
+    def locate(self, trojan_ids):
+        """
+        Returns the nodes of the given trojans
+        Args:
+            trojan_ids: The list of the string trojan ids
+
+        Returns:
+        The dict with the trojan ids as keys and the string names of their nodes as values. Unknown trojans are left out
+        """
+        with self._lock:
+            return {trojan_id: self._locations[trojan_id] for trojan_id in trojan_ids if trojan_id in self._locations}
+
+
+# The AgentDirectory of the process, which serves the directory
+_directory = None
+
+
+def get_directory():
+    """
+    Returns the AgentDirectory of this process, creating it on the first call. This is called by the process of the
+    DirectoryManager for every node, that connects to it
+    """
+    global _directory
+    if _directory is None:
+        _directory = AgentDirectory()
+    return _directory
+
+
+class DirectoryManager(BaseManager):
+    """
+    The manager, which serves the single AgentDirectory of the cluster to the nodes, see 'serve_directory' and
+    'connect_directory'
+    """
+    pass
+
+
+DirectoryManager.register("directory", callable=get_directory)
+
+
+def serve_directory(address, authkey):
+    """
+    Starts the process, which serves a new AgentDirectory at the given address
+    Args:
+        address: The (ip, port) tuple to listen at. The port 0 lets the operating system choose a free port
+        authkey: The bytes key, the nodes have to know to connect to the directory
+
+    Returns:
+    The started DirectoryManager. Its 'address' attribute is the actual address and its 'shutdown' method stops it
+    """
+    manager = DirectoryManager(address, authkey)
+    manager.start()
+    return manager
+
+
+def connect_directory(address, authkey):
+    """
+    Connects to the directory served at the given address
+    Args:
+        address: The (ip, port) tuple of the directory
+        authkey: The bytes key of the directory
+
+    Returns:
+    The proxy of the AgentDirectory, which can be used from multiple threads
+    """
+    manager = DirectoryManager(address, authkey)
+    manager.connect()
+    return manager.directory()
+
+
+class ClusterNode:
+    """
+    A ClusterNode is one server of the cluster. It holds the connections of a part of the trojans in its own
+    management and records them in the shared AgentDirectory. Commands for trojans, that are held by other nodes, are
+    forwarded to those nodes and their results are relayed back, so a command can be issued to any trojan of the
+    cluster at any node.
+    The nodes talk to each other with the forms of the JTrojan protocol: every node runs its own Greeter and Evaluator
+    and answers the "execute" and "pop_results" requests of the other nodes with response forms, which carry the
+    return values of the according methods of its management. To the other nodes, it connects with MultiplexClients,
+    which are kept open. A forwarded request is only ever executed on the local management of the receiving node, so
+    requests cannot be forwarded in circles.
+    The node drives the cycles of its management in the thread, that answers the requests of the other nodes, thus the
+    management must not be started as a thread itself. Whenever the shelf is synced, the trojans, that the management
+    removed in the meantime because they went offline, are released in the directory.
+    Args:
+        name: The string name of the node, unique in the cluster
+        management: The TrojanManagement or ShardedManagement of the node
+        directory: The AgentDirectory or the proxy of it, see 'connect_directory'
+        ip: The string ip, at which the node listens for the other nodes. Default is "127.0.0.1"
+        port: The integer port, at which the node listens. Default is 0, which lets the operating system choose
+        handler_amount: The integer amount of FormReceiveHandlers of the node. Default is 2
+        interval: The float amount of seconds between two cycles of the management, which run whether or not requests
+            arrive. Default is 0.01
+        timeout: The float amount of seconds to wait for the response of another node, before the request fails with
+            a TimeoutError. Default is 30
+        sync_interval: The float amount of seconds between writing the shelf to the disk. Default is 1
+    """
+    def __init__(self, name, management, directory, ip="127.0.0.1", port=0, handler_amount=2, interval=0.01,
+                 timeout=30, sync_interval=1):
+        self.name = name
+        self.management = management
+        self.directory = directory
+        self.ip = ip
+        self.interval = interval
+        self.timeout = timeout
+        self.sync_interval = sync_interval
+
+        self.state = mp.Value("b", True)
+        self.accepted = mp.Queue()
+        self.output = mp.Queue()
+        # The sender is shared with the handlers of the evaluator, which may send responses on the same connections
+        self.sender = net.ResponseSender(shared=True)
+        self.greeter = net.Greeter(port, self.accepted, self.state, ip=ip)
+        self.evaluator = net.Evaluator(self.accepted, self.output, self.state, handler_amount=handler_amount,
+                                       sender=self.sender)
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+
+        # The lock, that protects the management, as it is used by the dispatcher and the callers of the node
+        self._lock = threading.Lock()
+        # The dict with the node names as keys and the MultiplexClients connected to them as values
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+
+        # The dict with the integer ids of the aggregations as keys and the CombinedAggregations of the nodes as values
+        self._aggregations = {}
+        self._aggregations_lock = threading.Lock()
+        self._aggregation_counter = itertools.count()
+
+    @property
+    def port(self):
+        return self.greeter.port
+
+    def start(self):
+        """
+        Starts listening for the other nodes and adds the node to the directory
+        Returns:
+        void
+        """
+        self.greeter.start()
+        self.evaluator.start()
+        self.dispatcher.start()
+        self.directory.register_node(self.name, (self.ip, self.port))
+
+    def stop(self):
+        """
+        Removes the node from the directory, closes the connections to the other nodes and stops listening
+        Returns:
+        void
+        """
+        self.directory.unregister_node(self.name)
+        with self._clients_lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+        self.state.value = False
+        self.greeter.join(2)
+        self.evaluator.join(2)
+        self.dispatcher.join(2)
+        self.greeter.sock.close()
+
+    def dispatch(self):
+        """
+        The main loop of the dispatcher thread. Answers the requests of the other nodes and runs the cycles of the
+        management in between, at least once every interval, as a steady stream of requests would keep the returns
+        from being collected otherwise
+        Returns:
+        void
+        """
+        last_sync = time.time()
+        last_cycle = time.time()
+        while self.state.value:
+            if time.time() - last_cycle >= self.interval:
+                sync = time.time() - last_sync >= self.sync_interval
+                self.cycle(sync)
+                last_cycle = time.time()
+                if sync:
+                    last_sync = last_cycle
+            # Waiting for a request at most until the next cycle is due
+            try:
+                sock, form = self.output.get(timeout=max(0, last_cycle + self.interval - time.time()))
+            except queue.Empty:
+                continue
+            try:
+                self.sender.send(sock, self.evaluate_request(form))
+            except OSError:
+                # The response could not be sent completely. Closing the duplicate alone would not end the connection,
+                # as the handler still holds it, thus it is shut down, so that the client of the requesting node fails
+                # the request instead of waiting for it forever
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            finally:
+                sock.close()
+
+    def cycle(self, sync):
+        """
+        Runs one cycle of the management. In case the shelf is synced, the trojans, that the management removed since
+        the last sync, are released in the directory as well. This is done under the lock, so that a trojan, which
+        reconnects in the meantime, is not released after it was claimed again
+        Args:
+            sync: The boolean value of whether to sync the shelf in this cycle
+
+        Returns:
+        void
+        """
+        with self._lock:
+            self.management.cycle(sync)
+            if sync:
+                removed = self.management.pop_removed()
+                if len(removed) > 0:
+                    self.directory.release(removed, self.name)
+
+    def evaluate_request(self, form):
+        """
+        Calls the method of the local management, that is requested by the given form of another node
+        Args:
+            form: The RequestForm. The function name is the name of the method, the addresses are the trojan ids and
+                the parameters are the further arguments of the method
+
+        Returns:
+        The ResponseForm with the return value of the method or the exception it raised
+        """
+        try:
+            if form.function_name == "execute":
+                value = self.execute_local(form.addresses, form.parameters)
+            elif form.function_name == "pop_results":
+                command_ids, command_name = form.parameters
+                with self._lock:
+                    value = self.management.pop_results(form.addresses, command_ids, command_name)
+            elif form.function_name == "aggregate":
+                command_ids, command_name, reducer = form.parameters
+                with self._lock:
+                    value = self.management.aggregate(form.addresses, command_ids, command_name, reducer)
+            elif form.function_name == "poll_aggregate":
+                aggregation_id, discard = form.parameters
+                with self._lock:
+                    value = self.management.poll_aggregate(aggregation_id, discard)
+            else:
+                raise ValueError("The function {} is not offered by the node".format(form.function_name))
+        except Exception as exception:
+            return comm.ResponseForm(form.sequence, "error", exception, form.id)
+        return comm.ResponseForm(form.sequence, "ok", value, form.id)
+
+    def get_client(self, node):
+        """
+        Returns the MultiplexClient connected to the node of the given name, connecting to it if there is none yet or
+        the previous connection broke
+        Args:
+            node: The string name of the node
+
+        Returns:
+        The MultiplexClient object
+        """
+        with self._clients_lock:
+            client = self._clients.get(node)
+            if client is None or not client.receiver.is_alive():
+                ip, port = self.directory.node_address(node)
+                client = net.MultiplexClient.connect(ip, port, self.name)
+                self._clients[node] = client
+            return client
+
+    def forward(self, node, function_name, parameters, trojan_ids):
+        """
+        Sends the request for the method of the given name to the node of the given name
+        Returns:
+        The concurrent.futures.Future, which resolves with the ResponseForm
+        """
+        return self.get_client(node).request(function_name, parameters, trojan_ids)
+
+    def wait(self, future):
+        """
+        Waits for the response of another node and returns its value, see 'evaluate_response'
+        Raises:
+            TimeoutError: In case the node did not respond within the timeout
+        """
+        try:
+            response = future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            # The response may still arrive later, but nobody waits for it anymore
+            future.cancel()
+            raise TimeoutError("The node did not respond within {} seconds".format(self.timeout))
+        return self.evaluate_response(response)
+
+    @staticmethod
+    def evaluate_response(response):
+        """
+        Returns the value of the response of another node or raises the exception it contains
+        """
+        if response.status != "ok":
+            raise response.value
+        return response.value
+
+    def split(self, trojan_ids, *columns):
+        """
+        Splits the given trojan ids and the items of the other lists at the same positions by the nodes, which hold the
+        trojans. The trojans, that are not in the directory, are assigned to this node
+        Returns:
+        The tuple (locate, parts). The locate function returns the node name of a trojan id, the parts are a dict with
+        the node names as keys and lists of the split lists as values
+        """
+        locations = self.directory.locate(list(set(trojan_ids)))
+
+        def locate(trojan_id):
+            return locations.get(trojan_id, self.name)
+
+        parts = {}
+        for items in zip(trojan_ids, *columns):
+            part = parts.setdefault(locate(items[0]), [[] for _ in items])
+            for column, item in zip(part, items):
+                column.append(item)
+        return locate, parts
+
+    def add_trojan(self, trojan):
+        """
+        Adds the trojan, whose connection this node holds, to the management and claims it in the directory
+        """
+        with self._lock:
+            self.management.add_trojan(trojan)
+            self.directory.claim([trojan.id], self.name)
+
+    def terminate_trojan(self, trojan_id):
+        """
+        Terminates the trojan in the management of this node and releases it in the directory
+        """
+        with self._lock:
+            self.management.terminate_trojan(trojan_id)
+            self.directory.release([trojan_id], self.name)
+
+    def tag_trojan(self, trojan_id, tags):
+        """
+        Adds the tags to the trojan, which has to be held by this node, see TrojanManagement.tag_trojan
+        """
+        with self._lock:
+            self.management.tag_trojan(trojan_id, tags)
+
+    def untag_trojan(self, trojan_id, tags):
+        """
+        Removes the tags from the trojan, which has to be held by this node, see TrojanManagement.untag_trojan
+        """
+        with self._lock:
+            self.management.untag_trojan(trojan_id, tags)
+
+    def execute(self, trojan_id_list, command, priority, pos_args, kw_args, treat_missing=False, trace=None,
+                coalesce=False):
+        """
+        Executes the command on the given trojans, see TrojanManagement.execute. The trojans held by other nodes are
+        forwarded to them all at once, while the trojans of this node are executed locally, after which the results
+        are merged back into the order of the given list. Symbolic addresses are forwarded to all the nodes, each of
+        which resolves them with its own index, together with the ids of the trojans held by that node
+        Returns:
+        The tuple (trojan_ids, command_ids)
+        """
+        start = tracing.now()
+        parameters = [command, priority, pos_args, kw_args, treat_missing, coalesce]
+        if any(server.is_symbolic(address) for address in trojan_id_list):
+            result = self.broadcast(trojan_id_list, parameters)
+        else:
+            result = self.route(trojan_id_list, parameters)
+
+        if trace is not None:
+            trace.add_span("cluster.execute", start, tracing.now())
+        return result
+
+    def execute_local(self, trojan_ids, parameters):
+        """
+        Executes the command on the given trojans with the local management
+        Args:
+            trojan_ids: The list of the string trojan ids or symbolic addresses
+            parameters: The list [command, priority, pos_args, kw_args, treat_missing, coalesce]
+
+        Returns:
+        The tuple (trojan_ids, command_ids)
+        """
+        command, priority, pos_args, kw_args, treat_missing, coalesce = parameters
+        with self._lock:
+            return self.management.execute(trojan_ids, command, priority, pos_args, kw_args, treat_missing, None,
+                                           coalesce)
+
+    def broadcast(self, trojan_id_list, parameters):
+        """
+        Executes the command with the given symbolic addresses on all the nodes of the cluster and concatenates the
+        results. The plain ids of the list are only sent to the nodes, which hold those trojans, as the other nodes
+        would not find them
+        Returns:
+        The tuple (trojan_ids, command_ids)
+        """
+        symbolic = [address for address in trojan_id_list if server.is_symbolic(address)]
+        locate, parts = self.split([address for address in trojan_id_list if not server.is_symbolic(address)])
+        nodes = self.directory.nodes()
+        nodes += [node for node in parts if node not in nodes]
+        addresses = {node: symbolic + parts.get(node, [[]])[0] for node in nodes}
+        futures = [
+            self.forward(node, "execute", parameters, addresses[node])
+            for node in nodes if node != self.name
+        ]
+        executed = [self.execute_local(addresses.get(self.name, symbolic), parameters)]
+        executed += [self.wait(future) for future in futures]
+        return server.merge_broadcast(executed)
+
+    def route(self, trojan_id_list, parameters):
+        """
+        Executes the command on the given trojans on the nodes, which hold them, and merges the results
+        Returns:
+        The tuple (trojan_ids, command_ids)
+        """
+        locate, parts = self.split(trojan_id_list)
+        futures = {
+            node: self.forward(node, "execute", parameters, part[0])
+            for node, part in parts.items() if node != self.name
+        }
+        executed = {}
+        if self.name in parts:
+            executed[self.name] = self.execute_local(parts[self.name][0], parameters)
+        for node, future in futures.items():
+            executed[node] = self.wait(future)
+        return server.merge_executed(trojan_id_list, executed, locate)
+
+    def pop_results(self, trojan_ids, command_ids, command_name):
+        """
+        Takes the available returns of the given commands out of the managements of the nodes, which hold the trojans,
+        see TrojanManagement.pop_results
+        Returns:
+        The tuple (results, missing)
+        """
+        locate, parts = self.split(trojan_ids, command_ids)
+        futures = [
+            self.forward(node, "pop_results", [part[1], command_name], part[0])
+            for node, part in parts.items() if node != self.name
+        ]
+        popped = []
+        if self.name in parts:
+            with self._lock:
+                popped.append(self.management.pop_results(parts[self.name][0], parts[self.name][1], command_name))
+        popped += [self.wait(future) for future in futures]
+        return server.merge_popped(trojan_ids, command_ids, popped)
+
+    def aggregate(self, trojan_ids, command_ids, command_name, reducer):
+        """
+        Folds the returns of the given commands into the state of the reducer, see TrojanManagement.aggregate. Every
+        node aggregates the returns of its trojans and the states of the nodes are combined when polled
+        Returns:
+        The integer id of the aggregation
+        """
+        locate, parts = self.split(trojan_ids, command_ids)
+        futures = {
+            node: self.forward(node, "aggregate", [part[1], command_name, reducer], part[0])
+            for node, part in parts.items() if node != self.name
+        }
+        aggregations = {}
+        if self.name in parts:
+            with self._lock:
+                aggregations[self.name] = self.management.aggregate(parts[self.name][0], parts[self.name][1],
+                                                                    command_name, reducer)
+        for node, future in futures.items():
+            aggregations[node] = self.wait(future)
+        with self._aggregations_lock:
+            aggregation_id = next(self._aggregation_counter)
+            self._aggregations[aggregation_id] = server.CombinedAggregation(reducer, aggregations)
+        return aggregation_id
+
+    def poll_aggregate(self, aggregation_id, discard=False):
+        """
+        Returns the combined state of the aggregation of all the nodes, see TrojanManagement.poll_aggregate
+        Returns:
+        The tuple (state, missing)
+        """
+        aggregation = self._aggregations[aggregation_id]
+        parts = list(aggregation.parts.items())
+        futures = {
+            node: self.forward(node, "poll_aggregate", [part_id, discard], [])
+            for node, part_id in parts if node != self.name
+        }
+        polled = {}
+        for node, part_id in parts:
+            if node == self.name:
+                with self._lock:
+                    polled[node] = self.management.poll_aggregate(part_id, discard)
+        for node, future in futures.items():
+            polled[node] = self.wait(future)
+        state, missing = aggregation.update(polled)
+        if missing == 0 or discard:
+            with self._aggregations_lock:
+                self._aggregations.pop(aggregation_id, None)
+        return state, missing
@@ -2,48 +2,379 @@ import codecs
 import pickle
 
 
+# The status of a response to a request, which the server rejected, because it is overloaded
+OVERLOADED = "overloaded"
+
+# The dict with the string headers as keys and the form classes as values. Every form class registers itself with the
+# 'register_form' decorator, which is how 'produce_form' and the receive handlers know about it
+FORM_TYPES = {}
+
+
+def decode_string(content):
+    """
+    Decodes the content of a line into a string
+    """
+    return content.decode()
+
+
+def decode_integer(content):
+    """
+    Decodes the content of a line into an integer. The int function accepts the ascii digits as bytes directly
+    """
+    return int(content)
+
+
+def decode_boolean(content):
+    """
+    Decodes the content of a line, which is either 1 or 0, into a boolean
+    """
+    return content == b'1'
+
+
+def decode_list(content):
+    """
+    Decodes the content of a line, which is a comma separated list, into a list of strings. An empty line is an empty
+    list and a line without any comma a list with a single item
+    """
+    if len(content) == 0:
+        return []
+    return content.decode().split(",")
+
+
+def decode_pickled(content):
+    """
+    Decodes the content of an encoded line, which is pickled data encoded with the 'base64' codec, into the original
+    object
+    """
+    return pickle.loads(codecs.decode(content, "base64"))
+
+
+def decode_raw_pickled(content):
+    """
+    Decodes the content of an encoded line, which is raw pickled data, into the original object
+    """
+    return pickle.loads(content)
+
+
+class EncodedContent:
+    """
+    An EncodedContent object holds the received content of a line, whose decoding is deferred until the value is
+    actually needed. This way forms can be routed, queued or forwarded without ever decoding that content.
+    Args:
+        content: The bytes of the content, as they were received
+        decoder: The decoder function, which turns the content into the value
+    """
+    __slots__ = ("content", "decoder")
+
+    def __init__(self, content, decoder):
+        self.content = content
+        self.decoder = decoder
+
+    def decode(self):
+        """
+        Returns the decoded value of the content
+        """
+        return self.decoder(self.content)
+
+
+def decode_lazy_pickled(content):
+    """
+    Defers the decoding of the content of an encoded line, which is pickled data encoded with the 'base64' codec, by
+    wrapping it into an EncodedContent object
+    """
+    return EncodedContent(content, decode_pickled)
+
+
+def decode_field(decoder, content):
+    """
+    Decodes the content of a line with the given decoder. The decoders raise whatever the functions they use raise for
+    malformed content, e.g. the pickle.UnpicklingError, thus all of those are turned into a single error type, which the
+    receivers of the forms handle
+    Raises:
+        ValueError: In case the content cannot be decoded
+    Args:
+        decoder: The decoder function of the field
+        content: The bytes of the content
+
+    Returns:
+    The decoded value
+    """
+    try:
+        return decoder(content)
+    except Exception as exception:
+        raise ValueError("The content could not be decoded: {!r}".format(exception)) from exception
+
+
+def register_form(form_class):
+    """
+    This is a class decorator for the form classes. It takes the header and the field declarations of the class and
+    precompiles the decoder table of the form, which is a dict with the identifiers of the lines as byte strings
+    (exactly as they are received) as keys and tuples of the attribute name and the decoder function as values.
+    The form class is then added to the registry of the form types under its header.
+    The field declarations are a tuple of (identifier, attribute, decoder) tuples. The attribute names have to be the
+    names of the parameters of the constructor of the form and have to be part of its slots. The fields, that have no
+    value in the DEFAULTS of the form class, are required. Fields, that are decoded lazily, are listed in the LAZY
+    class attribute, their value is stored in the slot with a leading underscore and a property decodes it on access.
+    Every field is also assigned a bit, with which a form records, which of its fields were received.
+    Args:
+        form_class: The subclass of CommunicationForm to register
+
+    Returns:
+    The form class
+    """
+    assert form_class.HEADER not in FORM_TYPES, "The header {} is already registered".format(form_class.HEADER)
+    form_class.DECODERS = {
+        identifier.encode(): (attribute, decoder) for identifier, attribute, decoder in form_class.FIELDS
+    }
+    form_class.REQUIRED = tuple(
+        attribute for identifier, attribute, decoder in form_class.FIELDS if attribute not in form_class.DEFAULTS
+    )
+    form_class.FIELD_BITS = {
+        attribute: 1 << position for position, (identifier, attribute, decoder) in enumerate(form_class.FIELDS)
+    }
+    FORM_TYPES[form_class.HEADER] = form_class
+    return form_class
+
+
+def get_decoders(header):
+    """
+    Returns the decoder table of the form with the given header.
+    Raises:
+        KeyError: In case there is no form type with the given header
+    Args:
+        header: The string header of the form
+
+    Returns:
+    The dict with the byte string identifiers as keys and (attribute, decoder) tuples as values
+    """
+    return FORM_TYPES[header].DECODERS
+
+
 def produce_form(form_dict):
-    header = form_dict["header"]
-    if header == "REQUEST":
-        return _produce_request_form(form_dict)
+    """
+    This function creates the form object from the given dictionary, which contains the header of the form and the
+    already decoded values of the fields with their attribute names as keys. Fields that are missing in the dictionary
+    take the default value of the constructor of the form.
+    Raises:
+        KeyError: In case the header is unknown
+        TypeError: In case a field without a default value is missing
+    Args:
+        form_dict: The dictionary with the header and the decoded field values
+
+    Returns:
+    The form object
+    """
+    form_class = FORM_TYPES[form_dict["header"]]
+    # The header itself is not a parameter of the constructor
+    parameters = {key: value for key, value in form_dict.items() if key != "header"}
+    return form_class(**parameters)
 
 
-def _produce_request_form(form_dict):
+def parse_form_bytes(data):
     """
-    This function takes the arguments from the given dictionary and assumes it is the items, that describe a
-    RequestForm, extracts the values from the dict and passes them to the constructor of te Form object, which is then
-    returned
+    This function parses a whole form from the given bytes, which are exactly what the form sends over the socket, see
+    'create_form_bytes'. The lines are decoded with the decoder table of the form type, just like the receive handlers
+    do it, which makes it possible to pass forms as plain bytes without going through a socket.
+    Raises:
+        KeyError: In case the header or an identifier is unknown or a required field is missing
+        ValueError: In case the data ends before the end line of the form or the content of a line cannot be decoded
     Args:
-        form_dict: The dictionary containing the parameters for the Request form
+        data: The bytes of the form
 
     Returns:
-    The RequestForm object according to the parameters in the string
+    The form object
     """
-    # Extracting the data from the dictionary and passing it to the constructor of the RequestForm
-    user_identifier = form_dict["id"]
-    parameters = form_dict["parameters"]
-    addresses = form_dict["addresses"]
-    error_handle = form_dict["error"]
-    return_handle = form_dict["return"]
-    function_name = form_dict["function"]
+    position = data.index(b'\n')
+    form_class = FORM_TYPES[data[:position].decode()]
+    form = form_class.blank()
+    decoders = form_class.DECODERS
+    position += 1
+    while True:
+        end = data.index(b'\n', position)
+        identifier, content = data[position:end].split(b':', 1)
+        position = end + 1
+        if identifier == b'end':
+            break
+        if identifier == b'length':
+            # The encoded line is not terminated by the newline but by its length, as it may contain newlines itself
+            length = int(content)
+            separator = data.index(b':', position)
+            identifier = data[position:separator]
+            position = separator + 1 + length
+            if position >= len(data):
+                raise ValueError("The encoded line of {} bytes exceeds the data".format(length))
+            content = data[separator + 1:position]
+            position += 1
+        attribute, decoder = decoders[identifier]
+        form.set_field(attribute, decode_field(decoder, content))
 
-    form = RequestForm(function_name, parameters, addresses, return_handle, error_handle, user_identifier)
+    missing = form.missing_fields()
+    if len(missing) != 0:
+        raise KeyError("The {} form is missing the fields {}".format(form.header, missing))
     return form
 
 
+class FormPool:
+    """
+    The FormPool keeps form objects, that are not used anymore, in free lists per form type, so that they can be
+    reused for the next received forms instead of allocating new ones. This reduces the allocation churn, in case
+    many forms are received and processed in the same process.
+    A form may only be released, once nothing references it anymore, as it will be reset and handed out again.
+    Args:
+        max_size: The integer maximum amount of free forms per form type. Default is 1024
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        # The dict with the form classes as keys and the lists of free forms as values
+        self._free = {}
+
+    def acquire(self, form_class):
+        """
+        Returns a blank form of the given type, reusing a free one if there is one
+        Args:
+            form_class: The registered subclass of CommunicationForm
+
+        Returns:
+        The form object with all its fields set to the defaults
+        """
+        free = self._free.get(form_class)
+        if free:
+            try:
+                return free.pop()
+            except IndexError:
+                # Another thread took the last free form in the meantime
+                pass
+        return form_class.blank()
+
+    def release(self, form):
+        """
+        Resets the given form and adds it to the free list of its type, unless that list is full already
+        Args:
+            form: The form object, which is not used anymore
+
+        Returns:
+        void
+        """
+        free = self._free.setdefault(type(form), [])
+        if len(free) < self.max_size:
+            form.reset()
+            free.append(form)
+
+
+def encode_content(content):
+    """
+    This function pickles the given object and encodes the pickled data with the 'base64' codec, so that it can be
+    sent as the encoded line of a form.
+    Args:
+        content: The object to be encoded
+
+    Returns:
+    The string of the encoded content
+    """
+    # Pickling the object into a bytes object
+    pickled_content = pickle.dumps(content)
+    # Encoding the pickled data into a byte string of the 'base64' encoding and then into an actual string
+    encoded_byte_string = codecs.encode(pickled_content, "base64")
+    return encoded_byte_string.decode()
+
+
+def create_response_batches(sequence, results, id, batch_size=1000):
+    """
+    This function splits the given results of a single request into batch forms of at most the given size, so that
+    the results of a large fan-out can be sent with a few writes, without creating one huge frame. Only the last of
+    the forms is marked as final.
+    Args:
+        sequence: The integer sequence number of the request
+        results: The list of (address, command id, status, value) tuples
+        id: The string id of the user
+        batch_size: The integer maximum amount of results per form. Default is 1000
+
+    Returns:
+    The list of ResponseBatchForm objects. Contains at least one form, even if there are no results
+    """
+    forms = []
+    for start in range(0, max(len(results), 1), batch_size):
+        final = start + batch_size >= len(results)
+        forms.append(ResponseBatchForm(sequence, results[start:start + batch_size], id, final))
+    return forms
+
+
 class CommunicationForm:
     """
     The class represents the base class for all the forms which are sent between the server and the user in the
     JTrojan system. This class already contains the property for the header of the Form and the utility to create
     the end line, which is shared amongst all forms, as the end line acts as a terminator to the receive loop.
+    Every subclass declares its header in the HEADER class attribute and the lines of its form in the FIELDS class
+    attribute and registers itself with the 'register_form' decorator.
+    The forms use slots instead of an attribute dict, as the server may hold a large amount of them in its queues.
+    Because of that every subclass has to declare the slots for its fields as well.
     Args:
         header: The string header for the form
     Attributes:
         header: The string header of the form
+        trace: The tracing.Trace object of the form, in case the form is being traced, None otherwise. The trace is not
+            part of the transmitted form string
     """
+    __slots__ = ("header", "trace", "_received")
+
+    HEADER = None
+    FIELDS = ()
+    DEFAULTS = {}
+    DECODERS = {}
+    REQUIRED = ()
+    FIELD_BITS = {}
+    LAZY = ()
+
     def __init__(self, header):
         assert isinstance(header, str) and header.isupper()
         self.header = header
+        self.trace = None
+        # The bits of the fields, which were set. The constructor sets all of them
+        self._received = sum(self.FIELD_BITS.values())
+
+    @classmethod
+    def blank(cls):
+        """
+        Creates a new form of this type without calling the constructor, all the fields are set to their defaults.
+        This is used by the receive handlers to set the fields directly, as they are decoded
+        Returns:
+        The form object
+        """
+        form = cls.__new__(cls)
+        form.reset()
+        return form
+
+    def reset(self):
+        """
+        Sets all the fields of the form to their default value, or None if they do not have one
+        Returns:
+        void
+        """
+        self.header = self.HEADER
+        self.trace = None
+        self._received = 0
+        for identifier, attribute, decoder in self.FIELDS:
+            setattr(self, attribute, self.DEFAULTS.get(attribute))
+
+    def set_field(self, attribute, value):
+        """
+        Sets the field of the given attribute name to the value, which was received for it, and marks the field as set
+        Args:
+            attribute: The string attribute name of the field
+            value: The decoded value of the field
+
+        Returns:
+        void
+        """
+        setattr(self, attribute, value)
+        self._received |= self.FIELD_BITS[attribute]
+
+    def missing_fields(self):
+        """
+        Returns the list of the attribute names of the required fields, which were not set. Whether a field was set is
+        tracked separately from its value, as None is a valid value for some fields, e.g. the value of a response
+        """
+        return [attribute for attribute in self.REQUIRED if not self._received & self.FIELD_BITS[attribute]]
 
     @staticmethod
     def create_end_string():
@@ -55,13 +386,26 @@ class CommunicationForm:
         """
         return "end:True"
 
+    def create_form_bytes(self):
+        """
+        This method creates the bytes, that are actually sent over the socket for the form. For most forms this is
+        simply the encoded form string
+        Returns:
+        The bytes of the whole form
+        """
+        return self.create_form_string().encode()
+
 
+@register_form
 class RequestForm(CommunicationForm):
     """
     This class represents the string, that is being sent from the user of the JTrojan system to the server. The request
     transmission is according to a form, that begins with the request header and which specifies the following
     information:
     - id: The id of the user, that sends the request, so that the server can address the response to the correct socket
+    - sequence: The integer number of the request on its connection. The response to the request carries the same
+        number, so that a client can have many requests outstanding on one connection and match the responses, which
+        may arrive in any order
     - function name: The name of the function to be executed within the server
     - return mode: whether or not the server is supposed to return the resulting data immediately or store it in the
         buffer if the users profile. So whether the user is executing as blocking or non blocking command
@@ -69,21 +413,56 @@ class RequestForm(CommunicationForm):
     - addresses: A list with the entities, that are being addresses by the function, so on which trojans the function
         is supposed to be executed on
     - parameters: The parameters of the function call. Originally given as a list and then pickled and string encoded
+        The received parameters are only decoded and unpickled, when they are accessed for the first time, which
+        usually is the execution of the request. Forwarding a form with parameters, which were never accessed, sends
+        the received encoded data again without unpickling and pickling them.
     """
+    HEADER = "REQUEST"
+    FIELDS = (
+        ("id", "id", decode_string),
+        ("sequence", "sequence", decode_integer),
+        ("function", "function_name", decode_string),
+        ("return", "return_mode", decode_string),
+        ("error", "error_mode", decode_string),
+        ("addresses", "addresses", decode_list),
+        ("parameters", "parameters", decode_lazy_pickled)
+    )
+    DEFAULTS = {"sequence": 0}
+    LAZY = ("parameters",)
+
+    __slots__ = ("function_name", "_parameters", "addresses", "return_mode", "error_mode", "id", "sequence", "_length")
 
-    def __init__(self, function_name, parameters, addresses, return_mode, error_mode, id):
+    def __init__(self, function_name, parameters, addresses, return_mode, error_mode, id, sequence=0):
         # Initializing the super class with the request header
-        CommunicationForm.__init__(self, "REQUEST")
+        CommunicationForm.__init__(self, self.HEADER)
         self.function_name = function_name
         self.parameters = parameters
         self.addresses = addresses
         self.return_mode = return_mode
         self.error_mode = error_mode
         self.id = id
+        self.sequence = sequence
 
         # The length of the parameters byte object as it is being received
         self._length = None
 
+    def reset(self):
+        CommunicationForm.reset(self)
+        self._length = None
+
+    @property
+    def parameters(self):
+        """
+        The parameters of the function call. In case they were received and not accessed yet, they are decoded now
+        """
+        if type(self._parameters) is EncodedContent:
+            self._parameters = self._parameters.decode()
+        return self._parameters
+
+    @parameters.setter
+    def parameters(self, value):
+        self._parameters = value
+
     def create_form_string(self):
         """
         This method creates the string for the whole form in general. The form consists of the Header, that identifies
@@ -96,6 +475,8 @@ class RequestForm(CommunicationForm):
         # Adding the id of the user
         id_string = self.create_id_string()
         string_list.append(id_string)
+        # Adding the sequence number of the request
+        string_list.append(self.create_sequence_string())
         # Adding function name line
         function_name_string = self.create_function_name_string()
         string_list.append(function_name_string)
@@ -114,8 +495,10 @@ class RequestForm(CommunicationForm):
         length_string = self.create_length_string()
         string_list.append(length_string)
         string_list.append(parameters_string)
-        # Adding the end line at the end of the form
+        # Adding the end line at the end of the form. The empty string at the end makes the join terminate the end line
+        # with a newline as well, as the receiving side reads the end line just like every other line
         string_list.append(self.create_end_string())
+        string_list.append("")
         # Actually assembling the string from the list
         return '\n'.join(string_list)
 
@@ -142,6 +525,15 @@ class RequestForm(CommunicationForm):
         string_list = ["id:", str(self.id)]
         return ''.join(string_list)
 
+    def create_sequence_string(self):
+        """
+        This method creates the string line, that specifies the sequence number of the request on its connection
+        Returns:
+        The string line
+        """
+        string_list = ["sequence:", str(self.sequence)]
+        return ''.join(string_list)
+
     def create_function_name_string(self):
         """
         This function creates the line, that specifies the function name, that is used to call the accorcing function
@@ -185,17 +577,9 @@ class RequestForm(CommunicationForm):
         Returns:
         The string line
         """
-        string_list = ["addresses:"]
-        # Encoding the list of the entities, that the user addresses with the request as comma separated strings
-        for address in self.addresses:
-            address_string = str(address)
-            # Adding the address and a comma
-            string_list.append(address_string)
-            string_list.append(",")
-        # Removing the last item of the list, which is a comma in every case
-        string_list.pop()
-        # Returning the assembled string
-        return ''.join(string_list)
+        # Encoding the list of the entities, that the user addresses with the request as comma separated strings. An
+        # empty list results in an empty content
+        return ''.join(["addresses:", ",".join(str(address) for address in self.addresses)])
 
     def create_parameter_string(self):
         """
@@ -211,17 +595,149 @@ class RequestForm(CommunicationForm):
         the string line for the parameter(without newline character9
         """
         string_list = ["parameters:"]
-        # Pickling the parameters object into a bytes object
-        pickled_parameters = pickle.dumps(self.parameters)
-        # Encoding the pickled data into a byte string of the 'base64' encoding and then into an actual string
-        encoded_byte_string = codecs.encode(pickled_parameters, "base64")
-        self._length = len(encoded_byte_string)
-        encoded_string = str(encoded_byte_string)[2:][:-1]
+        # Pickling and encoding the parameters object. The encoding is plain ascii, thus one character is one byte.
+        # Parameters, that were received and not decoded yet, are already in exactly that encoding
+        if type(self._parameters) is EncodedContent and self._parameters.decoder is decode_pickled:
+            encoded_string = self._parameters.content.decode()
+        else:
+            encoded_string = encode_content(self.parameters)
+        self._length = len(encoded_string)
         # Adding to the string list to convert the final assembled string
         string_list.append(encoded_string)
         return ''.join(string_list)
 
 
+@register_form
+class ResponseForm(CommunicationForm):
+    """
+    This class represents the string, that is being sent from the server back to the user of the JTrojan system, once
+    the result to one of its requests is available. The response form begins with the response header and specifies
+    the following information:
+    - id: The id of the user, that sent the request
+    - sequence: The sequence number of the request, this is the response to. As responses are sent as soon as their
+        result is available, they can arrive in a different order than the requests were sent
+    - status: The string status of the request, "ok" if it was successful, "overloaded" if the server rejected it
+        because it is overloaded, in that case the value contains the stage, the queue depth and the queue capacity,
+        and "error" otherwise
+    - value: The return value of the request. Pickled and string encoded just like the parameters of a request
+    """
+    HEADER = "RESPONSE"
+    FIELDS = (
+        ("id", "id", decode_string),
+        ("sequence", "sequence", decode_integer),
+        ("status", "status", decode_string),
+        ("value", "value", decode_pickled)
+    )
+
+    __slots__ = ("sequence", "status", "value", "id", "_length")
+
+    def __init__(self, sequence, status, value, id):
+        # Initializing the super class with the response header
+        CommunicationForm.__init__(self, self.HEADER)
+        self.sequence = sequence
+        self.status = status
+        self.value = value
+        self.id = id
+
+        # The length of the value byte object as it is being received
+        self._length = None
+
+    def reset(self):
+        CommunicationForm.reset(self)
+        self._length = None
+
+    def create_form_string(self):
+        """
+        This method creates the string for the whole form. The lines are separated by newlines and the encoded value
+        line is preceded by the length line, which specifies how many bytes the encoded value has.
+        Returns:
+        The string of the form string
+        """
+        string_list = [self.header]
+        string_list.append(''.join(["id:", str(self.id)]))
+        string_list.append(''.join(["sequence:", str(self.sequence)]))
+        string_list.append(''.join(["status:", str(self.status)]))
+        # The value has to be encoded first, because the length line depends on it
+        value_string = self.create_value_string()
+        string_list.append(''.join(["length:", str(self._length)]))
+        string_list.append(value_string)
+        # Adding the end line, which is terminated by a newline as well
+        string_list.append(self.create_end_string())
+        string_list.append("")
+        return '\n'.join(string_list)
+
+    def create_value_string(self):
+        """
+        This method creates the string line for the return value, which is pickled and encoded. It also updates the
+        length property, thus enabling the creation of the length line
+        Returns:
+        The string line for the value (without newline character)
+        """
+        encoded_string = encode_content(self.value)
+        self._length = len(encoded_string)
+        return ''.join(["value:", encoded_string])
+
+
+@register_form
+class ResponseBatchForm(CommunicationForm):
+    """
+    This class represents a response, which carries many results of the same request in one frame. That is the case
+    for requests, that address many trojans at once, where every trojan produces its own result. The results are sent
+    as a list of (address, command id, status, value) tuples, where the address is the id of the trojan and the
+    command id the id of the command on that trojan.
+    The whole list is pickled at once and sent as raw bytes, as the length line already terminates it, so neither the
+    per result framing nor the base64 overhead of the other encoded lines has to be paid.
+    The results of one request can be split into multiple batches, the final flag is only set for the last one.
+    - id: The id of the user, that sent the request
+    - sequence: The sequence number of the request, this is the response to
+    - final: 1 if this is the last batch for the request, 0 otherwise
+    - results: The pickled list of result tuples
+    """
+    HEADER = "RESPONSES"
+    FIELDS = (
+        ("id", "id", decode_string),
+        ("sequence", "sequence", decode_integer),
+        ("final", "final", decode_boolean),
+        ("results", "results", decode_raw_pickled)
+    )
+    DEFAULTS = {"final": True}
+
+    __slots__ = ("sequence", "results", "id", "final")
+
+    def __init__(self, sequence, results, id, final=True):
+        # Initializing the super class with the header for multiple responses
+        CommunicationForm.__init__(self, self.HEADER)
+        self.sequence = sequence
+        self.results = results
+        self.id = id
+        self.final = final
+
+    def create_form_bytes(self):
+        """
+        This method creates the bytes of the whole form. Other than the other forms, this form cannot be represented as
+        a string, as the results are sent as raw bytes
+        Returns:
+        The bytes of the whole form
+        """
+        pickled_results = pickle.dumps(self.results, pickle.HIGHEST_PROTOCOL)
+        string_list = [
+            self.header,
+            ''.join(["id:", str(self.id)]),
+            ''.join(["sequence:", str(self.sequence)]),
+            ''.join(["final:", str(int(self.final))]),
+            ''.join(["length:", str(len(pickled_results))]),
+            "results:"
+        ]
+        # The results line is the raw pickled data, after which the end line follows as with every other form
+        return b''.join([
+            '\n'.join(string_list).encode(),
+            pickled_results,
+            b'\n',
+            self.create_end_string().encode(),
+            b'\n'
+        ])
+
+
 if __name__ == '__main__':
     f = RequestForm("get", ["hallo", True], ["max", "anna"], "blocking", "discard", "Jonas")
     print(f.create_form_string())
@@ -0,0 +1,496 @@
+import multiprocessing as mp
+import concurrent.futures
+import JTrojan2.communication as comm
+import JTrojan2.network as net
+import JTrojan2.tracing as tracing
+import threading
+import functools
+import argparse
+import math
+import random
+import socket
+import queue
+import time
+
+
+def percentile(sorted_values, percent):
+    """
+    This function returns the percentile of the given list of values, using the nearest rank method.
+    Args:
+        sorted_values: The list of numeric values, which has to be sorted in ascending order already
+        percent: The float percentage between 0 and 100 of the percentile to compute
+
+    Returns:
+    The value of the list, which is the requested percentile. None in case the list is empty
+    """
+    if len(sorted_values) == 0:
+        return None
+    # The nearest rank is the smallest index, for which at least the given percentage of values is smaller or equal
+    rank = math.ceil(percent / 100 * len(sorted_values)) - 1
+    rank = min(max(rank, 0), len(sorted_values) - 1)
+    return sorted_values[rank]
+
+
+class LoadReport:
+    """
+    The LoadReport contains the results of a single run of the LoadGenerator.
+    Args:
+        target_rate: The float amount of requests per second that was targeted. None in case of as fast as possible
+        sent: The integer amount of requests, that were sent successfully
+        completed: The integer amount of requests, for which the completion was observed
+        errors: The integer amount of requests, that failed to be sent or were lost with their connection
+        duration: The float amount of seconds the run took
+        latencies: The list of float latencies of all the completed requests in seconds
+        rejected: The integer amount of requests, that the server rejected with an overloaded response. Default is 0
+    Attributes:
+        throughput: The float amount of completed requests per second
+        percentiles: A dict with the float percentages (50, 90, 99, 99.9) as keys and the latency percentiles in
+            seconds as values
+    """
+    PERCENTAGES = (50, 90, 99, 99.9)
+
+    def __init__(self, target_rate, sent, completed, errors, duration, latencies, rejected=0):
+        self.target_rate = target_rate
+        self.sent = sent
+        self.completed = completed
+        self.errors = errors
+        self.rejected = rejected
+        self.duration = duration
+        self.latencies = sorted(latencies)
+
+        self.throughput = completed / duration if duration > 0 else 0.0
+        self.percentiles = {percent: percentile(self.latencies, percent) for percent in self.PERCENTAGES}
+
+    def saturated(self, tolerance=0.9, latency_limit=None):
+        """
+        This method returns whether the run is considered to be saturated. That is the case, if the achieved
+        throughput lies below the given fraction of the target rate, if requests were lost, rejected or failed, or if
+        the 99th latency percentile exceeds the given limit.
+        Args:
+            tolerance: The float fraction of the target rate, that has to be achieved at least. Default is 0.9
+            latency_limit: The float amount of seconds the 99th percentile of the latency may not exceed. Default is
+                None, which means the latency is not considered
+
+        Returns:
+        The boolean value of whether the pipeline was saturated in this run
+        """
+        if self.errors > 0 or self.rejected > 0 or self.completed < self.sent:
+            return True
+        if self.target_rate is not None and self.throughput < tolerance * self.target_rate:
+            return True
+        p99 = self.percentiles[99]
+        if latency_limit is not None and p99 is not None and p99 > latency_limit:
+            return True
+        return False
+
+    def __str__(self):
+        string_list = [
+            "target rate: {}".format("max" if self.target_rate is None else "{:.1f}/s".format(self.target_rate)),
+            "sent: {}  completed: {}  rejected: {}  errors: {}".format(self.sent, self.completed, self.rejected,
+                                                                      self.errors),
+            "throughput: {:.1f}/s over {:.2f}s".format(self.throughput, self.duration)
+        ]
+        for percent, value in self.percentiles.items():
+            value_string = "-" if value is None else "{:.3f}ms".format(value * 1000)
+            string_list.append("p{}: {}".format(percent, value_string))
+        return '\n'.join(string_list)
+
+
+class LoopbackPipeline:
+    """
+    This class starts the network part of the server, which is the Greeter and the Evaluator process, on the loopback
+    interface, so that the load generator can be pointed at it. The forms produced by the pipeline end up in the
+    'output' queue together with their sockets.
+    Args:
+        port: The integer port at which to listen. Default is 0, which makes the operating system choose a free port
+        handler_amount: The integer amount of FormReceiveHandlers the Evaluator starts with. Default is 4
+        tracer: The tracing.Tracer, which decides which connections and which of the following forms on them are being
+            traced. Default is None
+        queue_size: The integer capacity of the queues between the stages. Default is 0, which means unbounded
+        policy: The policy of the greeter and the handlers for full queues, either network.BLOCK or network.REJECT.
+            Default is network.BLOCK
+    """
+    def __init__(self, port=0, handler_amount=4, tracer=None, queue_size=0, policy=net.BLOCK):
+        self.state = mp.Value("b", True)
+        self.accepted = mp.Queue(queue_size)
+        self.output = mp.Queue(queue_size)
+        self.greeter = net.Greeter(port, self.accepted, self.state, ip="127.0.0.1", tracer=tracer, policy=policy)
+        self.evaluator = net.Evaluator(self.accepted, self.output, self.state, handler_amount=handler_amount,
+                                       tracer=tracer, policy=policy)
+
+    @property
+    def port(self):
+        return self.greeter.port
+
+    def depths(self):
+        """
+        Returns the load signals of the queues between the stages
+        Returns:
+        A dict with the string stage names as keys and (depth, capacity) tuples as values
+        """
+        return {"accept": net.queue_depth(self.accepted), "parse": net.queue_depth(self.output)}
+
+    def start(self):
+        """
+        Starts the Greeter and the Evaluator processes
+        Returns:
+        void
+        """
+        self.greeter.start()
+        self.evaluator.start()
+
+    def stop(self):
+        """
+        Stops the Greeter and the Evaluator processes by resetting the shared state and waits for them to exit
+        Returns:
+        void
+        """
+        self.state.value = False
+        self.greeter.join(2)
+        self.evaluator.join(2)
+        # The greeter only closes the listening socket of its own process
+        self.greeter.sock.close()
+
+
+class LoadGenerator:
+    """
+    The LoadGenerator opens concurrent client connections over the loopback interface to a JTrojan server and sends
+    well formed RequestForms at a target rate or as fast as possible. The payload size of every request is drawn from
+    the given payload sizes, so that mixed traffic can be simulated.
+    The latency of a request is measured from the point in time, at which the request was scheduled to be sent (not
+    when it actually was sent, as that would hide the queueing delay of an overloaded pipeline). In case a sink queue
+    is given, a request counts as completed, when its form appears in that queue, which is the output queue of the
+    FormReceiveHandlers, otherwise a request counts as completed, as soon as all the data was sent.
+    The responses of the server are received on the persistent connections, so that the requests, which the server
+    rejected because it was overloaded, are counted as rejected instead of being waited for. The requests, that were
+    lost with a connection, which the server closed, count as errors. The connections, that are opened for a single
+    request, are closed right after sending, thus their rejections are not observed and the run waits for the timeout
+    of the collector instead.
+    Args:
+        ip: The string ip of the server
+        port: The integer port of the server
+        connections: The integer amount of concurrent client connections. Default is 4
+        rate: The float total amount of requests per second to send. Default is None, which means as fast as possible
+        payload_sizes: A list of integer sizes in bytes of the parameter payload. Each request picks one of them.
+            Default is (64,)
+        sink: A queue, from which the (socket, form) tuples of the server pipeline can be taken. Default is None
+        function_name: The string function name of the requests. Default is "echo"
+        addresses: The list of string addresses of the requests. Default is ["loadgen"]
+        seed: The seed for the random choice of the payload sizes. Default is None
+        tracer: The tracing.Tracer, into which the traces of the forms taken from the sink are collected. Default is
+            None
+        persistent: The boolean value of whether every connection carries all the requests of its worker. If False
+            a new connection is opened for every single request. Default is True
+    """
+    def __init__(self, ip, port, connections=4, rate=None, payload_sizes=(64,), sink=None, function_name="echo",
+                 addresses=("loadgen",), seed=None, tracer=None, persistent=True):
+        self.ip = ip
+        self.port = port
+        self.connections = connections
+        self.rate = rate
+        self.payload_sizes = list(payload_sizes)
+        self.sink = sink
+        self.function_name = function_name
+        self.addresses = list(addresses)
+        self.random = random.Random(seed)
+        self.tracer = tracer
+        self.persistent = persistent
+
+        # The dict with the (user id, sequence number) tuples of the requests as keys and the float scheduled send times
+        # as values
+        self._scheduled = {}
+        self._latencies = []
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._errors = 0
+        self._rejected = 0
+        # The list of the (socket, ResponseReceiver) tuples of the persistent connections
+        self._connections = []
+
+    def run(self, amount):
+        """
+        This method sends the given amount of requests, distributed over all the connections and waits for them to
+        be completed.
+        Args:
+            amount: The integer total amount of requests to send
+
+        Returns:
+        The LoadReport object describing the run
+        """
+        self._scheduled = {}
+        self._latencies = []
+        self._sent = 0
+        self._errors = 0
+        self._rejected = 0
+        self._connections = []
+
+        # Creating the payloads upfront, so that pickling random sizes is not part of the measured time
+        payloads = [self.create_payload(self.random.choice(self.payload_sizes)) for _ in range(amount)]
+
+        collector = None
+        if self.sink is not None:
+            collector = threading.Thread(target=self._collect, args=(amount,))
+            collector.start()
+
+        start_time = time.perf_counter()
+        workers = []
+        for index in range(self.connections):
+            worker_payloads = payloads[index::self.connections]
+            worker = threading.Thread(target=self._work, args=(index, worker_payloads, start_time))
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+
+        if collector is not None:
+            collector.join()
+        duration = time.perf_counter() - start_time
+        # The connections are kept open until here, as the rejections of their last requests may still arrive
+        for sock, receiver in self._connections:
+            self._disconnect(sock)
+            receiver.join()
+
+        completed = len(self._latencies)
+        return LoadReport(self.rate, self._sent, completed, self._errors, duration, self._latencies, self._rejected)
+
+    def create_payload(self, size):
+        """
+        Creates a request form with a parameter payload of the given size in bytes
+        Args:
+            size: The integer size in bytes of the parameter payload
+
+        Returns:
+        The RequestForm object, whose id still has to be set
+        """
+        return comm.RequestForm(self.function_name, [b'x' * size], self.addresses, "blocking", "discard", None)
+
+    def _work(self, index, payloads, start_time):
+        """
+        The main function of one worker thread. Sends the given forms over the persistent connection of the worker or
+        each one through a new connection, spacing them by the interval, which results from the rate share of this
+        worker. A persistent connection, that broke, is reopened for the next form.
+        Args:
+            index: The integer index of the worker
+            payloads: The list of RequestForm objects to send
+            start_time: The float perf counter time at which the run started
+
+        Returns:
+        void
+        """
+        interval = None
+        if self.rate is not None:
+            interval = self.connections / self.rate
+
+        sock = None
+        receiver = None
+        for count, form in enumerate(payloads):
+            # Every worker acts as its own user and numbers its requests, which identifies them uniquely
+            form.id = "loadgen-{}".format(index)
+            form.sequence = count
+            key = (form.id, form.sequence)
+            data = form.create_form_bytes()
+
+            # Scheduling the request at a fixed point in time, independent of how long the previous requests took
+            scheduled = time.perf_counter()
+            if interval is not None:
+                scheduled = start_time + count * interval
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            with self._lock:
+                self._scheduled[key] = scheduled
+            try:
+                if sock is None:
+                    sock = socket.create_connection((self.ip, self.port))
+                    receiver = self._listen(sock) if self.persistent else None
+                if receiver is not None:
+                    self._expect_response(receiver, key)
+                sock.sendall(data)
+            except OSError:
+                with self._lock:
+                    self._errors += 1
+                    self._scheduled.pop(key, None)
+                if sock is not None:
+                    self._disconnect(sock)
+                sock = None
+                continue
+
+            with self._lock:
+                self._sent += 1
+                if self.sink is None:
+                    # The request is complete already, thus it is not expected to be collected or rejected anymore
+                    self._latencies.append(time.perf_counter() - scheduled)
+                    self._scheduled.pop(key, None)
+            if not self.persistent:
+                # Closing the client side of the connection does not affect the data, that is already sent
+                sock.close()
+                sock = None
+
+    def _listen(self, sock):
+        """
+        Starts the ResponseReceiver for the given persistent connection, which resolves the futures of the requests,
+        that the server answered. The pipeline only answers the requests, that it rejected
+        Args:
+            sock: The connected socket object
+
+        Returns:
+        The started ResponseReceiver
+        """
+        receiver = net.ResponseReceiver({}, threading.Lock())
+        receiver.assign(sock)
+        receiver.start()
+        with self._lock:
+            self._connections.append((sock, receiver))
+        return receiver
+
+    def _expect_response(self, receiver, key):
+        """
+        Registers the future of the request with the given key at the receiver of its connection. This has to be done
+        before the request is sent, as the response could arrive before the send call returns
+        Args:
+            receiver: The ResponseReceiver of the connection
+            key: The (user id, sequence number) tuple of the request
+
+        Raises:
+            ConnectionError: In case the receiver already stopped, because the server closed the connection
+        Returns:
+        void
+        """
+        future = concurrent.futures.Future()
+        future.add_done_callback(functools.partial(self._count_response, key))
+        with receiver.lock:
+            if receiver.closed:
+                raise ConnectionError("The connection was closed")
+            receiver.pending[key[1]] = future
+
+    def _count_response(self, key, future):
+        """
+        Counts the request with the given key as rejected, in case its future was resolved with an overloaded response.
+        The futures of the requests, that were not answered, fail when their connection is closed. In case the request
+        was not collected by then, it was lost with the connection and is counted as an error. That is the case for all
+        the requests, that follow on a connection, which the server rejected as a whole
+        """
+        if future.cancelled():
+            return
+        lost = future.exception() is not None
+        if not lost and future.result().status != comm.OVERLOADED:
+            return
+        with self._lock:
+            if self._scheduled.pop(key, None) is not None:
+                if lost:
+                    self._errors += 1
+                else:
+                    self._rejected += 1
+
+    @staticmethod
+    def _disconnect(sock):
+        """
+        Closes the connection. It is shut down first, so that the receiver of the connection stops waiting for data
+        """
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+
+    def _collect(self, amount, timeout=5, interval=0.1):
+        """
+        The main function of the collector thread. Takes the forms from the sink queue and computes the latency of
+        the corresponding requests. Stops once every one of the given amount of requests was either collected,
+        rejected or failed to be sent, or after no form arrived for the given amount of seconds.
+        Args:
+            amount: The integer amount of requests
+            timeout: The float amount of seconds to wait for the next form. Default is 5
+            interval: The float amount of seconds after which to check the counts again. Default is 0.1
+
+        Returns:
+        void
+        """
+        last_arrival = time.perf_counter()
+        while True:
+            with self._lock:
+                if len(self._latencies) + self._rejected + self._errors >= amount:
+                    break
+            try:
+                sock, form = self.sink.get(timeout=interval)
+            except queue.Empty:
+                if time.perf_counter() - last_arrival >= timeout:
+                    break
+                continue
+            arrival = time.perf_counter()
+            last_arrival = arrival
+            sock.close()
+            if self.tracer is not None and form.trace is not None:
+                form.trace.end("handler.handoff")
+                self.tracer.collect(form.trace)
+            with self._lock:
+                scheduled = self._scheduled.pop((form.id, form.sequence), None)
+                if scheduled is not None:
+                    self._latencies.append(arrival - scheduled)
+
+
+def find_saturation_point(generator, rates, amount_per_step, tolerance=0.9, latency_limit=None):
+    """
+    This function runs the given load generator with increasing target rates and finds the first rate, at which the
+    pipeline cannot keep up anymore.
+    Args:
+        generator: The LoadGenerator object to use, its rate is being overridden for every step
+        rates: The list of float target rates in ascending order
+        amount_per_step: The integer amount of requests to send in each step
+        tolerance: The float fraction of the target rate that has to be achieved. Default is 0.9
+        latency_limit: The float limit in seconds for the 99th percentile of the latency. Default is None
+
+    Returns:
+    The tuple (rate, reports), where rate is the first target rate at which the pipeline was saturated, or None if it
+    never was and reports is the list of LoadReports of all the steps that were run
+    """
+    reports = []
+    for rate in rates:
+        generator.rate = rate
+        report = generator.run(amount_per_step)
+        reports.append(report)
+        if report.saturated(tolerance, latency_limit):
+            return rate, reports
+    return None, reports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sends RequestForms to a loopback JTrojan pipeline")
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--amount", type=int, default=1000)
+    parser.add_argument("--rates", type=float, nargs="*", default=[],
+                        help="Target rates to step through, as fast as possible if omitted")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 1024, 16384])
+    parser.add_argument("--latency-limit", type=float, default=None)
+    parser.add_argument("--trace", default=None, help="File to write the chrome trace of the sampled requests to")
+    parser.add_argument("--sample-rate", type=float, default=0.01)
+    parser.add_argument("--reconnect", action="store_true", help="Open a new connection for every request")
+    parser.add_argument("--queue-size", type=int, default=0, help="Capacity of the pipeline queues, 0 is unbounded")
+    parser.add_argument("--policy", choices=[net.BLOCK, net.REJECT], default=net.BLOCK)
+    arguments = parser.parse_args()
+
+    request_tracer = None
+    if arguments.trace is not None:
+        request_tracer = tracing.Tracer(sample_rate=arguments.sample_rate, enabled=True)
+
+    pipeline = LoopbackPipeline(handler_amount=arguments.connections, tracer=request_tracer,
+                                queue_size=arguments.queue_size, policy=arguments.policy)
+    pipeline.start()
+    try:
+        load_generator = LoadGenerator("127.0.0.1", pipeline.port, connections=arguments.connections,
+                                       payload_sizes=arguments.sizes, sink=pipeline.output, tracer=request_tracer,
+                                       persistent=not arguments.reconnect)
+        if arguments.rates:
+            saturation_rate, step_reports = find_saturation_point(load_generator, arguments.rates, arguments.amount,
+                                                                  latency_limit=arguments.latency_limit)
+            for step_report in step_reports:
+                print(step_report, end="\n\n")
+            print("saturation point: {}".format(saturation_rate))
+        else:
+            print(load_generator.run(arguments.amount))
+    finally:
+        pipeline.stop()
+
+    if request_tracer is not None:
+        request_tracer.dump(arguments.trace)
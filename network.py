@@ -1,15 +1,161 @@
 import multiprocessing as mp
+import concurrent.futures
 import JTrojan2.communication as comm
+import JTrojan2.tracing as tracing
 import threading
-import pickle
-import codecs
+import itertools
+import contextlib
+import random
+import queue
 import socket
+import select
+import selectors
 import time
+import zlib
 
 
-class SocketWrapper:
+# The policies for putting items into a bounded queue, that is full. With the BLOCK policy the producer waits until
+# there is space again, which stops it from accepting connections or reading from its socket, so that the pressure
+# propagates back to the clients. With the REJECT policy the item is dropped right away and the client is sent an
+# overloaded response, so that it can back off
+BLOCK = "block"
+REJECT = "reject"
+
+
+def queue_depth(target):
+    """
+    This function returns the amount of items in the given queue and its capacity, which are the signals, by which the
+    load of a stage of the server can be judged.
+    Args:
+        target: The queue.Queue or multiprocessing.Queue object
 
-    def __init__(self, sock, connected):
+    Returns:
+    The tuple (depth, capacity). The depth is None in case the platform does not support it for multiprocessing queues
+    and the capacity is None for unbounded queues
+    """
+    try:
+        depth = target.qsize()
+    except NotImplementedError:
+        depth = None
+    # The standard queues store their maximum size publicly, the multiprocessing queues privately, both use values
+    # lower or equal to zero for unbounded queues
+    capacity = getattr(target, "maxsize", getattr(target, "_maxsize", 0))
+    if capacity is not None and capacity <= 0:
+        capacity = None
+    return depth, capacity
+
+
+def put_with_policy(target, item, policy, block_timeout=None, is_running=None, interval=0.1):
+    """
+    This function puts the item into the given queue according to the policy for full queues. With the BLOCK policy
+    the function waits for space in the queue, at most for the block timeout, if one is given, with the REJECT policy
+    it does not wait at all. The waiting is done in small intervals, so that the producer can be stopped meanwhile.
+    Args:
+        target: The queue.Queue or multiprocessing.Queue object
+        item: The item to put into the queue
+        policy: Either BLOCK or REJECT
+        block_timeout: The float maximum amount of seconds to wait with the BLOCK policy. Default is None, which means
+            waiting for as long as it takes
+        is_running: A function returning the boolean value of whether the producer is still running. Default is None
+        interval: The float amount of seconds after which to check whether the producer is still running
+
+    Returns:
+    The boolean value of whether the item was put into the queue. False if it was rejected
+    """
+    assert policy in (BLOCK, REJECT), "Unknown policy {}".format(policy)
+    if policy == REJECT:
+        try:
+            target.put_nowait(item)
+            return True
+        except queue.Full:
+            return False
+
+    deadline = None if block_timeout is None else time.time() + block_timeout
+    while is_running is None or is_running():
+        timeout = interval if deadline is None else min(interval, deadline - time.time())
+        if timeout <= 0:
+            return False
+        try:
+            target.put(item, timeout=timeout)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def create_overloaded_response(stage, target, sequence=0, id="server"):
+    """
+    Creates the response form, that is sent to a client, whose request or connection was rejected because the queue of
+    the given stage was full. The value of the response contains the load signals of that queue, so that the client
+    can decide how long to back off.
+    Args:
+        stage: The string name of the stage, that rejected, e.g. "accept" or "parse"
+        target: The queue, that was full
+        sequence: The integer sequence number of the rejected request. Default is 0 for rejected connections
+        id: The string id of the user. Default is "server"
+
+    Returns:
+    The ResponseForm object
+    """
+    depth, capacity = queue_depth(target)
+    value = {"stage": stage, "depth": depth, "capacity": capacity}
+    return comm.ResponseForm(sequence, comm.OVERLOADED, value, id)
+
+
+def backoff_delay(attempt, delay, max_delay):
+    """
+    This function computes the amount of time to wait before the next attempt of an operation, that failed the given
+    amount of times already. The upper bound of the delay doubles with every attempt until the max delay is reached
+    and the actual delay is chosen randomly between 0 and that bound ("full jitter").
+    Args:
+        attempt: The integer amount of attempts, that failed before the first delayed one, 0 for the first retry
+        delay: The float amount of seconds, which is the upper bound for the first retry
+        max_delay: The float maximum amount of seconds
+
+    Returns:
+    The float amount of seconds to wait
+    """
+    # Limiting the exponent, so that the power does not get unnecessarily large for many attempts
+    bound = min(max_delay, delay * 2 ** min(attempt, 32))
+    return random.uniform(0, bound)
+
+
+def wait_readable(sock, timeout):
+    """
+    This function waits until there is something to receive from the given socket, which includes the end of the
+    connection. Poll is used where it is available, as select cannot wait for file descriptors above 1024, which the
+    process of the handlers reaches with many connections.
+    Args:
+        sock: The socket object
+        timeout: The float amount of seconds to wait at most, None means waiting as long as it takes
+
+    Returns:
+    The boolean value of whether the socket is readable
+    """
+    if not hasattr(select, "poll"):
+        readable, _, _ = select.select([sock], [], [], timeout)
+        return len(readable) > 0
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    return len(poller.poll(None if timeout is None else timeout * 1000)) > 0
+
+
+class SocketWrapper:
+    """
+    The SocketWrapper wraps a socket object and offers the methods to receive data of a certain length or up to a
+    certain character from it. The received data is buffered, so that the socket is read in chunks instead of byte by
+    byte.
+    All the receive methods respect two limits, which are enforced by waiting for the socket with select, so that a
+    peer, that stalls in the middle of the data, cannot block the receiving thread forever:
+    - The idle timeout is the amount of seconds the peer may not send any byte
+    - The deadline is the point in time at which all the receiving has to be finished, see 'set_deadline'
+    Args:
+        sock: The socket object to be wrapped
+        connected: The boolean value of whether the socket is already connected
+        idle_timeout: The float amount of seconds the peer may stay silent while receiving. Default is None, which
+            means no limit
+    """
+    def __init__(self, sock, connected, idle_timeout=None):
         # Assigning the socket object to the variable
         self.sock = sock
         # The variable, which stores the state of the connection
@@ -20,19 +166,31 @@ class SocketWrapper:
         self.type = None
         self.appoint_type()
 
-    def connect(self, ip, port, attempts, delay):
+        self.idle_timeout = idle_timeout
+        # The float time stamp until which the receiving has to be finished, None if there is no deadline
+        self.deadline = None
+        # The data, that was already received from the socket but not yet returned by one of the receive methods
+        self._buffer = bytearray()
+        self.chunk_size = 65536
+
+    def connect(self, ip, port, attempts, delay, max_delay=None):
         """
         This method capsules the connect functionality of the wrapped socket. The method will try to connect to the
         specified address, trying that the specified amount of attempts.
         In case an already connected socket is already stored in the wrapper, this method will close and connect to the
         new address (in case that is possible obviously).
+        Between the attempts the method waits for an exponentially growing, randomized amount of time, which starts at
+        the given delay and is bounded by the max delay. The randomization keeps many clients, that lost the connection
+        to the same server at the same time, from all reconnecting at the same time.
         In case the connection could not be established after the specified amount of attempts, the method will raise
         an ConnectionRefusedError!
         Args:
             ip: The string ip address of the target to connect to
             port: The integer port of the target to connect to
             attempts: The integer amount of attempts of trying to connect
-            delay: The float amount of seconds delayed to the next attempt
+            delay: The float amount of seconds delayed to the second attempt
+            max_delay: The float maximum amount of seconds delayed between two attempts. Default is None, which means
+                32 times the delay
 
         Returns:
         void
@@ -41,42 +199,53 @@ class SocketWrapper:
         assert isinstance(ip, str), "ip is not a string"
         assert isinstance(port, int) and (0 <= port <= 65536), "The port is wrong type or value range"
         assert isinstance(attempts, int) and (0 <= attempts), "The attempts parameter is not the same value"
+        if max_delay is None:
+            max_delay = 32 * delay
         # Assembling the port and the ip to the address tuple
         address = (ip, port)
+        # In case the wrapper is already connected, closing that connection first
+        if self.connected:
+            self.sock.close()
+            self.sock = socket.socket(self.family, self.type)
+            self.connected = False
         # Calling the connect of the socket as many times as specified
-        while not self.connected:
+        for attempt in range(attempts):
+            # Delaying all the attempts after the first one
+            if attempt > 0:
+                time.sleep(backoff_delay(attempt - 1, delay, max_delay))
             try:
-                # Delaying the try possibly
-                time.sleep(delay)
                 # Attempting to build the connection
                 self.sock.connect(address)
                 # Updating the connected status to True
                 self.connected = True
-            except Exception as exception:
-                # Closing the socket and creating a new one, which is gonna be used in the next try
+                return
+            except OSError:
+                # The state of a socket after a failed connect is unspecified, thus closing it and creating a new one,
+                # which is gonna be used in the next try
                 self.sock.close()
                 self.sock = socket.socket(self.family, self.type)
-                self.connected = False
-                # Decrementing the counter for the attempts
-                attempts -= 1
 
-        # In case the loop exits without the connection being established
-        if self.attempts == 0:
-            raise ConnectionRefusedError("The socket could not connect to {}".format(address))
+        # In case the loop exits without the connection being established. The socket, which was created for the next
+        # attempt, is not needed anymore
+        self.sock.close()
+        raise ConnectionRefusedError("The socket could not connect to {}".format(address))
 
     def receive_until_character(self, character, limit, timeout=None, include=False):
         """
         This method receives data from the wrapped socket until the special 'character' has been received. The limit
         specifies after how many bytes without the termination character a Error should be raised. The timeout
-        is the amount of seconds every individual byte is allowed to take to receive before raising an error. The
-        include flag tells whether the termination character should be included in the returned data.
+        is the amount of seconds the whole call is allowed to take before raising an error. The include flag tells
+        whether the termination character should be included in the returned data.
+        Raises:
+            OverflowError: In case the limit was reached without receiving the character
+            EOFError: In case the data stream terminated before the character was received
+            TimeoutError: In case the timeout, the idle timeout or the deadline passed
         Args:
             character: can either be an integer in the range between 0 and 255, that is being converted into a
                 character or can be a bytes object/ bytes string of the length 1. After receiving this byte the data
                 up to that point is returned.
             limit: The integer amount of bytes, that can be received without terminating, without raising an error.
-            timeout: The float amount of seconds each individual byte is allowed to take to receive before a
-                Timeout is raised.
+            timeout: The float amount of seconds the call is allowed to take before a Timeout is raised.
             include: The boolean flag of whether to include the termination character in the return or not
 
         Returns:
@@ -88,68 +257,126 @@ class SocketWrapper:
         assert (is_bytes and len(character) == 1) or (is_int and 0 <= character <= 255)
         # In case the input is an integer converting it into a bytes object
         if is_int:
-            character = int.to_bytes(character, "1", "big")
+            character = int.to_bytes(character, 1, "big")
 
-        counter = 0
-        # Calling the receive length function with one byte at a time until the character in question appears
-        data = b""
+        deadline = self.create_call_deadline(timeout)
+        # The position up to which the buffer was already searched for the character
+        searched = 0
         while True:
-            # Checking if the limit of bytes has been reched
-            if counter > limit:
-                raise OverflowError("The limit of bytes to receive until character has been reached")
-            current = self.receive_length(1, timeout)
-            if current == character:
-                if include is True:
-                    data += character
-                # After the character has been found and eventually was added to the data, breaking the infinite loop
+            index = self._buffer.find(character, searched)
+            if index != -1:
                 break
-            else:
-                # In case the character is not there adding the byte to the counter and incrementing the counter
-                data += character
-                counter += 1
-
+            # Checking if the limit of bytes has been reached
+            if len(self._buffer) > limit:
+                raise OverflowError("The limit of bytes to receive until character has been reached")
+            searched = len(self._buffer)
+            self.fill_buffer(deadline)
+
+        if index > limit:
+            raise OverflowError("The limit of bytes to receive until character has been reached")
+        end = index + 1 if include is True else index
+        data = bytes(self._buffer[:end])
+        # Removing the data and the character from the buffer
+        del self._buffer[:index + 1]
         return data
 
     def receive_length(self, length, timeout=None):
         """
         This method receives a certain amount of bytes from the socket object, that is being wrapped. It is also
-        possible to specify the amount of time the method is supposed to wait for the next character to be received
-        before issuing a timeout.
+        possible to specify the amount of time the method is allowed to take, before issuing a timeout.
         Raises:
             EOFError: In case the data stream terminated before the specified amount of bytes was received
             ConnectionError: In case the socket object in question is not connected yet.
-            TimeoutError: In case it took to long to receive the next byte
+            TimeoutError: In case the timeout, the idle timeout or the deadline passed
         Args:
             length: The integer amount of bytes to be received from the socket
-            timeout: The float amount of time, that is tolerated for a byte to be received
+            timeout: The float amount of time, that is tolerated for all the bytes to be received
 
         Returns:
         The bytes string of the data with the specified length, received from the socket
         """
+        deadline = self.create_call_deadline(timeout)
+        while len(self._buffer) < length:
+            self.fill_buffer(deadline, length)
+        data = bytes(self._buffer[:length])
+        del self._buffer[:length]
+        return data
+
+    def fill_buffer(self, deadline, length=None):
+        """
+        This method receives the next chunk of data from the socket and appends it to the buffer. The receive call
+        times out at the given deadline or after the idle timeout, whichever comes first.
+        Raises:
+            EOFError: In case the data stream terminated
+            ConnectionError: In case the socket object in question is not connected yet.
+            TimeoutError: In case the deadline or the idle timeout passed
+        Args:
+            deadline: The float time stamp until which the data has to be received or None
+            length: The integer amount of bytes, that were requested, only used for the error message. Default is None
+
+        Returns:
+        void
+        """
         # First checking whether or not there actually is a callable socket within the 'connection' attribute, by
         # checking the 'connected' flag. In case there is not, will raise an exception
         if not self.connected:
             raise ConnectionError("There is no open connection to receive from yet!")
 
-        start_time = time.time()
-        data = b''
-        while len(data) < length:
-            # receiving more data, while being careful not accidentally receiving too much
-            more = self.sock.recv(length - len(data))
+        timeout = self.idle_timeout
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError("The deadline to receive the data has passed")
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        # Not using a socket timeout, as that puts the socket into non blocking mode. That mode is a property of the
+        # connection, which is shared with all the duplicates of the socket, so that sending a large response over one
+        # of them would fail, as soon as the send buffer is full
+        if not wait_readable(self.sock, timeout):
+            raise TimeoutError("No data was received within {} seconds".format(timeout))
+        more = self.sock.recv(self.chunk_size)
+
+        # In case there can be no more data received, but the amount of data already received does not match the
+        # amount of data that was specified for the method, raising End of file error
+        if not more:
+            if length is not None:
+                raise EOFError("Only received ({}/{}) bytes".format(len(self._buffer), length))
+            raise EOFError("The connection was closed after {} bytes".format(len(self._buffer)))
+        self._buffer += more
+
+    def create_call_deadline(self, timeout):
+        """
+        Combines the deadline of the wrapper with the timeout of a single receive call into the deadline for that call
+        Args:
+            timeout: The float amount of seconds the call may take or None
 
-            # In case there can be no more data received, but the amount of data already received does not match the
-            # amount of data that was specified for the method, raising End of file error
-            if not more:
-                raise EOFError("Only received ({}/{}) bytes".format(len(data), length))
+        Returns:
+        The float time stamp of the earlier of both deadlines or None if there is none
+        """
+        if timeout is None:
+            return self.deadline
+        call_deadline = time.time() + timeout
+        if self.deadline is None:
+            return call_deadline
+        return min(self.deadline, call_deadline)
+
+    def set_deadline(self, timeout):
+        """
+        Sets the deadline of the wrapper to the given amount of seconds from now. All the receiving has to be finished
+        until then. This is used to limit the total time, that receiving a whole form may take.
+        Args:
+            timeout: The float amount of seconds or None to remove the deadline
 
-            # Checking for overall timeout
-            time_delta = time.time() - start_time
-            if (timeout is not None) and time_delta >= timeout:
-                raise TimeoutError("{} Bytes could not be received in {} seconds".format(length, timeout))
+        Returns:
+        void
+        """
+        self.deadline = None if timeout is None else time.time() + timeout
 
-            # Adding the newly received data to the stream of already received data
-            data += more
-        return data
+    def buffered(self):
+        """
+        Returns the integer amount of bytes, that were already received from the socket but not yet returned
+        """
+        return len(self._buffer)
 
     def sendall(self, data):
         """
@@ -166,7 +393,7 @@ class SocketWrapper:
         if not self.connected:
             raise ConnectionError("There is no open connection to send to yet!")
         # Actually calling the method of the socket
-        self.sock.sedall(data)
+        self.sock.sendall(data)
 
     def release_socket(self):
         """
@@ -203,7 +430,8 @@ class Greeter(mp.Process):
     """
     The Greeter process is the first network instance of the trojan server system, its only job is to listen at the
     designated port of the local machine and accept all incoming connection and putting all the resulting bound
-    sockets and their origin addresses as a tuple (in that order) into the multiprocessing queue, that was specified.
+    sockets, their origin addresses and their trace as a tuple (in that order) into the multiprocessing queue, that was
+    specified. The trace is None, unless a tracer is given, that decided to sample the connection.
     Args:
         port: The integer port at which the server is supposed to listen
         output_queue: A multiprocessing.Queue, into which the accepted socket connections are being put
@@ -213,8 +441,18 @@ class Greeter(mp.Process):
             Default on ip4
         ip: The string ip at which to listen to the incoming connections.
             Default on the local machine, by 'localhost'
+        backlog: The integer amount of not yet accepted connections the operating system is allowed to queue up.
+            Default is 10
+        accept_timeout: The float amount of seconds after which a blocking accept call returns to check the state.
+            Default is 0.1
+        tracer: The tracing.Tracer, which decides which connections are being traced. Default is None
+        policy: The policy in case the output queue is full. With BLOCK the greeter stops accepting connections until
+            there is space, with REJECT new connections are sent an overloaded response and closed. Default is BLOCK
+        block_timeout: The float amount of seconds to wait for space with the BLOCK policy, before rejecting the
+            connection. Default is None, which means waiting as long as it takes
     """
-    def __init__(self, port, output_queue, state, family=socket.AF_INET, ip="localhost"):
+    def __init__(self, port, output_queue, state, family=socket.AF_INET, ip="localhost", backlog=10,
+                 accept_timeout=0.1, tracer=None, policy=BLOCK, block_timeout=None):
         mp.Process.__init__(self)
         # The name of the process#
         self.name = "greeter"
@@ -222,6 +460,11 @@ class Greeter(mp.Process):
         self.ip = ip
         self.port = port
         self.family = family
+        self.backlog = backlog
+        self.accept_timeout = accept_timeout
+        self.tracer = tracer
+        self.policy = policy
+        self.block_timeout = block_timeout
         # The output queue for the sockets
         self.output = output_queue
 
@@ -240,20 +483,63 @@ class Greeter(mp.Process):
         Returns:
         void
         """
-        # Making the server start to listen
-        self.sock.listen(10)
+        # Making the server start to listen. The accept call times out periodically, so that the loop can check the
+        # shared state and the process can be stopped without terminating it by force
+        self.sock.listen(self.backlog)
+        self.sock.settimeout(self.accept_timeout)
 
         try:
-            while self.running is True:
+            while self.running.value:
                 # Constantly accepting new connections and putting the socket and the address into the output queue
-                connection, address = self.sock.accept()
-                self.output.put((connection, address))
+                try:
+                    connection, address = self.sock.accept()
+                except socket.timeout:
+                    continue
+                # The accept stage starts, when the accept call returned, as the trace can only be created afterwards
+                accepted = tracing.now()
+                trace = self.start_trace()
+                # The accepted socket would inherit the timeout of the listening socket otherwise
+                connection.settimeout(None)
+                if trace is not None:
+                    trace.add_span("greeter.accept", accepted, tracing.now())
+                    trace.begin("greeter.handoff")
+                if not put_with_policy(self.output, (connection, address, trace), self.policy, self.block_timeout,
+                                       lambda: self.running.value):
+                    self.reject(connection)
         except socket.error:
             pass
         finally:
             # Closing the socket in case of termination
             self.sock.close()
 
+    def reject(self, connection):
+        """
+        This method sends the overloaded response to a connection, which could not be put into the full output queue
+        and closes it. Errors are ignored, as the connection is discarded either way
+        Args:
+            connection: The socket object of the accepted connection
+
+        Returns:
+        void
+        """
+        try:
+            connection.sendall(create_overloaded_response("accept", self.output).create_form_bytes())
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+    def start_trace(self):
+        """
+        This method creates a new trace for an accepted connection, in case there is a tracer, which decides to sample
+        the connection
+        Returns:
+        The tracing.Trace object or None
+        """
+        if self.tracer is None:
+            return None
+        return self.tracer.start_trace()
+
     def init_socket(self):
         """
         This method creates a new socket in the 'sock' property of the object and then configures it to be a listening
@@ -266,6 +552,8 @@ class Greeter(mp.Process):
         # Setting the socket to listen
         address = self.assemble_address()
         self.sock.bind(address)
+        # In case the port 0 was passed, the operating system chose a free port, which is being fetched here
+        self.port = self.sock.getsockname()[1]
 
     def create_socket(self):
         """
@@ -294,8 +582,38 @@ class Greeter(mp.Process):
 
 
 class FormReceiveHandler(threading.Thread):
-
-    def __init__(self, output_queue):
+    """
+    The FormReceiveHandler is a thread, that owns a client connection, once it is assigned one. The connection is
+    persistent, which means the handler keeps receiving forms from it until the client closes the connection or it
+    has been idle for longer than the idle timeout. Every received form is put into the output queue together with the
+    socket it came from.
+    Args:
+        output_queue: The queue into which the (socket, form) tuples are being put
+        idle_timeout: The float amount of seconds a connection may stay idle between two forms before it is closed.
+            Default is 30
+        tracer: The tracing.Tracer, which decides if the forms after the first one on a connection are traced. The
+            first form uses the trace of the connection, that is passed on assignment. Default is None
+        pool: The communication.FormPool, from which the form objects are taken. Default is None, which means new
+            form objects are created for every form
+        policy: The policy in case the output queue is full. With BLOCK the handler stops reading from its connection
+            until there is space, with REJECT the form is dropped and the client is sent an overloaded response with
+            the sequence number of the form. Default is BLOCK
+        block_timeout: The float amount of seconds to wait for space with the BLOCK policy, before rejecting the form.
+            Default is None, which means waiting as long as it takes
+        form_timeout: The float amount of seconds receiving a whole form may take, from its first byte on. Default is
+            30, None means no limit
+        byte_timeout: The float amount of seconds the client may stay silent in the middle of a form. Default is 10,
+            None means no limit
+        sender: The ResponseSender, through which the overloaded responses are sent, so that they are not interleaved
+            with other responses to the same client. Default is None, which means the handler uses a sender of its own
+        park: The function, to which the handler passes the socket and the trace for the next form, when there is no
+            further form to receive right away. The handler then gives up the connection and becomes idle again, instead
+            of waiting for the next form itself. Default is None, which means the handler waits up to the idle timeout
+        A client, that exceeds one of the timeouts, is disconnected, so that slow or broken clients cannot keep the
+        handlers busy.
+    """
+    def __init__(self, output_queue, idle_timeout=30, tracer=None, pool=None, policy=BLOCK, block_timeout=None,
+                 form_timeout=30, byte_timeout=10, sender=None, park=None):
         threading.Thread.__init__(self)
         # Putting the already connected socket into the wrapper fro easier handle
         self.sock = None
@@ -307,9 +625,21 @@ class FormReceiveHandler(threading.Thread):
         # The idle flag tells the manager, if the handler can be used again or if it is still working
         self.idle = True
 
-        # The dictionary that saves the data in every step
-        self.data = {}
+        # The form, that is currently being received and the decoder table of its type
         self.form = None
+        self.decoders = {}
+        self.pool = pool
+        # The trace of the current form, None if it is not being traced
+        self.trace = None
+        self.tracer = tracer
+
+        self.idle_timeout = idle_timeout
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.form_timeout = form_timeout
+        self.byte_timeout = byte_timeout
+        self.sender = ResponseSender() if sender is None else sender
+        self.park = park
 
     def run(self):
         """
@@ -317,7 +647,8 @@ class FormReceiveHandler(threading.Thread):
         socket. It will then start to receive the data from the socket line by line and add each line, which consits of
         a identifier and the content, as a key-value-pair into a dict. When all the data has been received the dict
         will be converted into the according communication form and will then, together with the socket itself, be
-        put into the output queue. Then the loop starts to wait for a new socket to handle.
+        put into the output queue. This is repeated for every form sent over the connection, until the connection is
+        closed, then the loop starts to wait for a new socket to handle.
         Returns:
         void
         """
@@ -326,51 +657,185 @@ class FormReceiveHandler(threading.Thread):
 
         while self.running:
             # Waiting for a new socket to be assigned to handle
-            while self.idle is True:
+            while self.idle is True and self.running:
                 time.sleep(0.0001)
 
-            # Creating the dictionary for the data received. Clearing it, if this is 2nd+ run of handler
-            self.data = {}
+            if not self.running:
+                break
 
-            # Receiving the header, and adding it as a normal string to the dictionary
-            header = self.receive_header()
-            self.evaluate_header(header)
+            try:
+                self.serve_connection()
+            except Exception:
+                # An unexpected error only ends the connection, the socket of which was closed already. The handler
+                # has to become idle again in any case, otherwise the evaluator would never assign it a connection again
+                pass
 
-            identifier = b''
-
-            # Receiving all the lines until one is the length line, indicating that the following is encoded content or
-            # it is the end line
-            while identifier != b'end':
-                identifier, content = self.receive_content_line()
-                self.evaluate_content(identifier, content)
-                # In case the identifier is the length, receiving the next line as encoded line
-                if identifier == b'length':
-                    # Turning the length content into a int, so that it can be used to know how many bytes too receive
-                    length = int(self.create_content_string(content))
-                    # Getting the encoded data from the socket and adding it to the dictionary after decoding it
-                    identifier, content = self.receive_encoded_line(length)
-                    self.evaluate_encoded_content(identifier, content)
-
-            # After all the data is received, which means the data dict contains all the lines of the form, the data
-            # dict is being turned into a form
-            self.form = comm.produce_form(self.data)
-            output = self.assemble_output()
-            self.output.put(output)
-            # Releasing the socket
+            # Releasing the socket and signaling the managing instance, that the handler can be used again
             self.sock = None
+            self.trace = None
+            self.idle = True
 
-    def assign(self, sock):
+    def serve_connection(self):
+        """
+        This method receives forms from the assigned socket and puts them into the output queue, until the client
+        closes the connection, the connection stays idle for longer than the idle timeout or the handler is stopped.
+        The socket is closed afterwards, unless it was passed on to the park function, because there was no further
+        form to receive right away.
+        Returns:
+        void
+        """
+        first = True
+        try:
+            while self.running:
+                # The first form of a connection is traced with the trace of the connection, the following ones decide
+                # about their tracing themselves
+                if not first and self.tracer is not None:
+                    self.trace = self.tracer.start_trace()
+                # An idle connection is handed over to be watched by someone else, so that it does not keep the handler
+                # busy until the next form arrives. The first form has been announced by the one, who assigned the
+                # connection, already
+                if not first and self.park is not None and not self.form_available():
+                    self.park(self.sock, self.trace)
+                    self.sock = None
+                    self.trace = None
+                    break
+                first = False
+
+                if not self.wait_for_form():
+                    break
+
+                # The deadline for the whole form starts with its first byte
+                self.sock_wrap.set_deadline(self.form_timeout)
+                with tracing.span(self.trace, "handler.receive"):
+                    self.receive_form()
+                self.sock_wrap.set_deadline(None)
+                output = self.assemble_output()
+                if self.trace is not None:
+                    self.trace.begin("handler.handoff")
+                if not put_with_policy(self.output, output, self.policy, self.block_timeout, lambda: self.running):
+                    self.reject(output)
+                # The trace now belongs to the form
+                self.trace = None
+        except (EOFError, OSError, OverflowError, ValueError, KeyError):
+            # The client either disconnected in the middle of a form, sent a malformed form or exceeded the timeouts,
+            # in all cases the connection is dropped. The TimeoutError is an OSError as well. Closing the socket alone
+            # would not end the connection, as other processes may still hold a duplicate of it, thus the client could
+            # wait forever for a response
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        finally:
+            self.close_socket()
+
+    def wait_for_form(self, interval=0.1):
+        """
+        This method waits until the beginning of the next form can be received from the socket. The waiting is done in
+        small intervals, so that the handler can be stopped while waiting.
+        Args:
+            interval: The float amount of seconds after which to check the running flag again. Default is 0.1
+
+        Returns:
+        The boolean value of whether there is data to receive. False in case the client closed the connection, the
+        idle timeout passed or the handler was stopped.
+        """
+        # The next form may already be in the buffer of the wrapper, in case the client sent multiple at once
+        if self.sock_wrap.buffered() > 0:
+            return True
+        deadline = time.time() + self.idle_timeout
+        while self.running:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if wait_readable(self.sock, min(interval, remaining)):
+                # A readable socket without any data to peek at means, that the client closed the connection
+                return self.sock.recv(1, socket.MSG_PEEK) != b''
+        return False
+
+    def form_available(self):
+        """
+        This method checks without waiting, whether there is something to receive from the socket, which includes the
+        client closing the connection
+        Returns:
+        The boolean value of whether the socket is readable or the wrapper has buffered data
+        """
+        return self.sock_wrap.buffered() > 0 or wait_readable(self.sock, 0)
+
+    def reject(self, output):
+        """
+        This method sends the overloaded response for a form, which could not be put into the full output queue, to
+        the client. The connection stays open, so that the client can send the request again after backing off. The
+        response is sent through the sender, as responses to the previous forms may be sent at the same time
+        Args:
+            output: The (socket, form) tuple, that was rejected
+
+        Returns:
+        void
+        """
+        sock, form = output
+        response = create_overloaded_response("parse", self.output, form.sequence, form.id)
+        try:
+            self.sender.send(sock, response)
+        finally:
+            sock.close()
+
+    def stop(self):
+        """
+        This method stops the main loop of the handler, after the form, that is currently being received is finished
+        Returns:
+        void
+        """
+        self.running = False
+
+    def receive_form(self):
+        """
+        This method receives one whole form from the assigned socket. The header determines the type of the form, of
+        which a blank object is created in the 'form' attribute. The data is then received line by line, decoding the
+        content of every line with the decoder, that the form type declared for the identifier of the line and setting
+        it as the according attribute of the form directly, until the end line is received.
+        Raises:
+            KeyError: In case the header or the identifier of a line is unknown for the form type or a required field
+                is missing
+        Returns:
+        void
+        """
+        # Receiving the header and creating the blank form of that type. The header also determines the decoders for
+        # all the following lines
+        with tracing.span(self.trace, "handler.create_form"):
+            header = self.receive_header()
+            self.evaluate_header(header)
+
+        # Receiving all the lines until the end line. The length line indicates, that the following line is encoded
+        # content of the given length, which is not terminated by a newline
+        while True:
+            identifier, content = self.receive_content_line()
+            if identifier == b'end':
+                break
+            if identifier == b'length':
+                # Getting the encoded data from the socket, which is then decoded just like every other line
+                identifier, content = self.receive_encoded_line(int(content))
+            self.evaluate_content(identifier, content)
+
+        missing = self.form.missing_fields()
+        if len(missing) != 0:
+            raise KeyError("The {} form is missing the fields {}".format(self.form.header, missing))
+        # The trace travels on with the form
+        self.form.trace = self.trace
+
+    def assign(self, sock, trace=None):
         """
         this method will be used by whatever higher instance will manage the handler to assign it a new job. More
         specifically assigning it a new socket to begin receiving the form from
         Args:
             sock: The socket object, that should be handled
+            trace: The tracing.Trace object of the connection. Default is None, which means it is not traced
 
         Returns:
         void
         """
         # Assigning the socket to the property and creating the socket wrapper
         self.sock = sock
+        self.trace = trace
         self.create_socket_wrap()
         # Resetting the idle property so that the main loop exits
         self.idle = False
@@ -378,12 +843,14 @@ class FormReceiveHandler(threading.Thread):
     def assemble_output(self):
         """
         This method simply assembles the socket object and the form object into a tuple, that can be passed through the
-        output queue
+        output queue. As the handler keeps owning the connection, the tuple contains a duplicate of the socket, which
+        the receiver of the tuple has to close on its own. The duplicate also prevents the handler closing the
+        connection before a multiprocessing queue got to pickle the socket.
         Returns:
         The tuple, whose first element is the socket used for the transmission and the second the received form
         """
         assert self.form is not None
-        return self.sock, self.form
+        return self.sock.dup(), self.form
 
     def receive_encoded_line(self, length):
         """
@@ -397,7 +864,7 @@ class FormReceiveHandler(threading.Thread):
         """
         assert isinstance(self.sock_wrap, SocketWrapper)
         # First receiving the identifier from the next line, so until the ':'
-        identifier = self.sock_wrap.receive_until_character(b':')
+        identifier = self.sock_wrap.receive_until_character(b':', 500)
         # Now receiving as many bytes as specified
         content = self.sock_wrap.receive_length(length)
         self.sock_wrap.receive_length(1)
@@ -412,8 +879,8 @@ class FormReceiveHandler(threading.Thread):
         of the content
         """
         byte_string = self.receive_line()
-        # Splitting the line into the identifier and the content
-        split_list = byte_string.split(b':')
+        # Splitting the line into the identifier and the content, the content itself may contain the separator
+        split_list = byte_string.split(b':', 1)
         # Returning the tuple of the identifier byte string and the content byte string
         return tuple(split_list)
 
@@ -438,76 +905,74 @@ class FormReceiveHandler(threading.Thread):
         byte_string = self.sock_wrap.receive_until_character(b'\n', 500)
         return byte_string
 
+    def close_socket(self):
+        """
+        This method closes the socket, that is currently assigned to the handler. Errors while closing are ignored, as
+        the socket is being discarded anyways
+        Returns:
+        void
+        """
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+
     def create_socket_wrap(self):
         """
         This method creates a SocketWrapper object and assigns it to the 'sock_wrap' property
         Returns:
         void
         """
-        self.sock_wrap = SocketWrapper(self.sock, True)
+        self.sock_wrap = SocketWrapper(self.sock, True, self.byte_timeout)
 
-    def add_header(self, header):
+    def create_form(self, form_class):
         """
-        Simply adds the header string to the internal dictionary
+        Creates the blank form object of the given type in the 'form' attribute, taking it from the pool if there is
+        one and sets the decoder table of that type
         Args:
-            header: The string (not byte string!) of the header to add to the dict
+            form_class: The registered subclass of CommunicationForm
 
         Returns:
         void
         """
-        self.data["header"] = header
+        if self.pool is not None:
+            self.form = self.pool.acquire(form_class)
+        else:
+            self.form = form_class.blank()
+        self.decoders = form_class.DECODERS
 
     def evaluate_header(self, header):
-        # Turning the byte string into a string and then adding it to the dict
-        header = self.create_content_string(header)
-        self.add_header(header)
-
-    def evaluate_content(self, identifier, content):
         """
-        This method takes the byte string identifier and content of a line received by the socket and turns the
-        identifier into a string and evaluates the type of the content, turning it into either a int, a string or
-        a list of strings.
-        The type converted content is then used as the value to the identifier as key in the internal data dictionary
+        Looks up the form type of the header, which was received as byte string and creates the blank form of it
+        Raises:
+            KeyError: In case the header is unknown
         Args:
-            identifier: The byte string identifier for the content in a line
-            content: The byte string of the content
+            header: The byte string header line
 
         Returns:
         void
         """
-        # Turning the byte string identifier into a string
-        identifier = self.create_content_string(identifier)
-        # If the content contains a comma or more, it is interpreted as a list of individual strings
-        if b',' in content:
-            self.data[identifier] = self.create_content_list(content)
-        else:
-            # First creating the correct string representation of the byte string
-            string_content = self.create_content_string(content)
-            # Attempting to turn the string into a integer. But setting the string directly as the dictionary item in
-            # case the string did not represent a integer.
-            try:
-                self.data[identifier] = int(string_content)
-            except ValueError:
-                self.data[identifier] = string_content
+        form_class = comm.FORM_TYPES[self.create_content_string(header)]
+        self.create_form(form_class)
 
-    def evaluate_encoded_content(self, identifier, content):
+    def evaluate_content(self, identifier, content):
         """
-        This method takes the bytes string of the identifier of a data line, that is supposed to represent a complex
-        data type and is thus encoded and pickled. The method will turn the identifier into string and convert the
-        content back into its original data type and then add it as key; value pair to the internal data dict.
+        This method takes the byte string identifier and content of a line received by the socket and decodes the
+        content with the decoder, that the form type declared for that identifier. The decoded content is then saved
+        as the attribute of the field to the form, that is being received
+        Raises:
+            KeyError: In case the form type does not declare the identifier
+            ValueError: In case the content cannot be decoded
         Args:
-            identifier: The bytes string of the identifier
-            content: The bytes string of the encoded data object
+            identifier: The byte string identifier for the content in a line
+            content: The byte string of the content
 
         Returns:
         void
         """
-        # Turning the identifier into a string
-        identifier = str(identifier)
-        # Decoding and unpicking the content
-        content = self.create_content_decoded(content)
-        # Adding them to the dictionary
-        self.data[identifier] = content
+        attribute, decoder = self.decoders[identifier]
+        self.form.set_field(attribute, comm.decode_field(decoder, content))
 
     @staticmethod
     def create_content_string(content):
@@ -519,51 +984,475 @@ class FormReceiveHandler(threading.Thread):
         Returns:
         The string to the bytes string
         """
-        # Turning the bytes object into a string first and then stripping the additional '' characters
-        content_string = str(content)
-        content_string = content_string[2:][:-1]
-        return content_string
+        return content.decode()
+
+
+class ConnectionPool:
+    """
+    The ConnectionPool keeps connections to the servers open, so that client tools, which send many forms, can reuse a
+    warm connection instead of connecting for every form. The connections are kept per server address and at most
+    'max_size' connections per address are open at the same time, further requests for a connection wait until one is
+    released. Before an idle connection is handed out again, it is checked for being healthy, which means it was not
+    closed by the server in the meantime, broken connections are discarded and replaced by new ones.
+    New connections are established with bounded exponential backoff and jitter, see SocketWrapper.connect.
+    Args:
+        max_size: The integer maximum amount of connections per address. Default is 8
+        attempts: The integer amount of attempts to connect. Default is 5
+        delay: The float amount of seconds before the first retry to connect. Default is 0.05
+        max_delay: The float maximum amount of seconds between two attempts to connect. Default is 2
+        idle_timeout: The float amount of seconds a connection may stay idle in the pool, before it is closed instead
+            of being reused. Should be lower than the idle timeout of the server. Default is 20
+    """
+    def __init__(self, max_size=8, attempts=5, delay=0.05, max_delay=2, idle_timeout=20):
+        self.max_size = max_size
+        self.attempts = attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.idle_timeout = idle_timeout
+
+        # The dict with the address tuples as keys and lists of (socket, release time) tuples of the idle connections
+        # as values
+        self._idle = {}
+        # The dict with the address tuples as keys and the integer amount of open connections, idle or in use, as values
+        self._size = {}
+        # The dict with the sockets, that are currently in use, as keys and their address tuples as values
+        self._in_use = {}
+        self._condition = threading.Condition()
+        # Whether the pool was closed, the connections, that are released after that, are closed instead of being kept
+        self._closed = False
+
+    def acquire(self, ip, port, timeout=None):
+        """
+        This method returns a connected socket to the given address. An idle connection of the pool is being reused if
+        there is a healthy one, otherwise a new connection is established, as long as the maximum size is not reached.
+        Raises:
+            TimeoutError: In case the maximum amount of connections is in use and none was released within the timeout
+            ConnectionRefusedError: In case a new connection could not be established
+        Args:
+            ip: The string ip of the server
+            port: The integer port of the server
+            timeout: The float amount of seconds to wait for a connection to be released. Default is None, which means
+                waiting forever
+
+        Returns:
+        The connected socket object, which has to be given back with the 'release' method
+        """
+        address = (ip, port)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while True:
+                sock = self._pop_healthy(address)
+                if sock is not None:
+                    self._in_use[sock] = address
+                    return sock
+                if self._size.get(address, 0) < self.max_size:
+                    # Reserving the slot before connecting, so that other threads do not exceed the maximum size
+                    self._size[address] = self._size.get(address, 0) + 1
+                    break
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("No connection to {} was released within {} seconds".format(address, timeout))
+                self._condition.wait(remaining)
+
+        # Connecting outside of the lock, as that may take several attempts
+        try:
+            wrapper = SocketWrapper(socket.socket(socket.AF_INET, socket.SOCK_STREAM), False)
+            wrapper.connect(ip, port, self.attempts, self.delay, self.max_delay)
+        except OSError:
+            self._discard(address)
+            raise
+        sock = wrapper.release_socket()
+        with self._condition:
+            self._in_use[sock] = address
+        return sock
+
+    def release(self, sock, broken=False):
+        """
+        This method gives a socket, that was acquired from the pool, back to it, so that it can be reused
+        Args:
+            sock: The socket object, that was acquired
+            broken: The boolean value of whether the connection is known to be broken, it is closed then. This has to
+                be set, in case an error occurred during the communication, as the state of the protocol is unknown.
+                Default is False. After the pool was closed, every released connection is closed
+
+        Returns:
+        void
+        """
+        with self._condition:
+            address = self._in_use.pop(sock)
+            # After the pool was closed, the connection is closed just like a broken one
+            if not broken and not self._closed:
+                self._idle.setdefault(address, []).append((sock, time.time()))
+                self._condition.notify()
+                return
+        self._close(sock)
+        self._discard(address)
+
+    @contextlib.contextmanager
+    def connection(self, ip, port, timeout=None):
+        """
+        A context manager, which acquires a connection and releases it after the 'with' block. In case the block raises
+        an exception, the connection is considered broken and closed.
+        Args:
+            ip: The string ip of the server
+            port: The integer port of the server
+            timeout: The float amount of seconds to wait for a connection. Default is None
+
+        Returns:
+        The connected socket object
+        """
+        sock = self.acquire(ip, port, timeout)
+        try:
+            yield sock
+        except BaseException:
+            self.release(sock, broken=True)
+            raise
+        self.release(sock)
+
+    def close(self):
+        """
+        Closes all the idle connections of the pool. Connections, that are in use, are closed when they are released
+        Returns:
+        void
+        """
+        with self._condition:
+            self._closed = True
+            for address, idle in self._idle.items():
+                for sock, released in idle:
+                    self._close(sock)
+                self._size[address] -= len(idle)
+            self._idle = {}
+            self._condition.notify_all()
+
+    def size(self, ip, port):
+        """
+        Returns the integer amount of open connections to the given address, idle or in use
+        """
+        with self._condition:
+            return self._size.get((ip, port), 0)
+
+    def _pop_healthy(self, address):
+        """
+        Takes the most recently released healthy connection to the given address from the idle list. All the broken or
+        expired connections, that are found on the way, are closed. Has to be called while holding the lock.
+        Args:
+            address: The (ip, port) tuple of the server
+
+        Returns:
+        The socket object or None, in case there is no healthy idle connection
+        """
+        idle = self._idle.get(address, [])
+        while len(idle) != 0:
+            sock, released = idle.pop()
+            if time.time() - released < self.idle_timeout and self.is_healthy(sock):
+                return sock
+            self._close(sock)
+            self._size[address] -= 1
+        return None
+
+    def _discard(self, address):
+        """
+        Frees the slot of a connection to the given address, that was closed
+        Args:
+            address: The (ip, port) tuple of the server
+
+        Returns:
+        void
+        """
+        with self._condition:
+            self._size[address] -= 1
+            self._condition.notify()
 
     @staticmethod
-    def create_content_list(content):
+    def is_healthy(sock):
         """
-        This method will take the content line, that was received from the socket ans interprets it as comma separated
-        list of individual string values
+        This method checks, whether an idle connection can still be used. An idle connection should never have
+        anything to receive, if it is readable the server either closed it or sent unexpected data, in both cases it
+        cannot be used anymore.
         Args:
-            content: The bytes object, that was received as the content to one line of the form
+            sock: The socket object to check
 
         Returns:
-        The list of strings
+        The boolean value of whether the connection is healthy
         """
-        # Turning into a string
-        content_string = str(content)
-        # Splitting the string by the comma
-        content_list = content_string.split(",")
-        return content_list
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return len(readable) == 0
 
     @staticmethod
-    def create_content_decoded(content):
+    def _close(sock):
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+
+class ResponseSender:
+    """
+    The ResponseSender is used by the server to send the response forms back to the clients, as soon as the results of
+    their requests are available. Because the results complete in any order and possibly in different threads, the
+    whole form string of one response has to be written to the connection, before the next response may be written.
+    Every form taken from the handler output comes with its own duplicate of the socket, thus the connection is
+    identified by its address pair and one of a fixed set of locks is chosen by the hash of that pair.
+    The handlers send responses as well, in case they reject a form. To keep those from interleaving with the responses
+    of another process, the sender can use multiprocessing locks and be passed to the Evaluator.
+    Args:
+        lock_amount: The integer amount of locks, which are shared by all the connections. Default is 64
+        shared: The boolean value of whether to use multiprocessing locks, so that the sender can be used by multiple
+            processes. Default is False
+        send_timeout: The float amount of seconds sending one response may take. Default is None, which means sending
+            blocks until all the data is written. As the timeout applies to the connection and not only to the given
+            socket object, a timeout also puts the duplicates of the socket, which the handler receives from, into non
+            blocking mode
+    """
+    def __init__(self, lock_amount=64, shared=False, send_timeout=None):
+        lock_type = mp.Lock if shared else threading.Lock
+        self.locks = [lock_type() for _ in range(lock_amount)]
+        self.send_timeout = send_timeout
+
+    def send(self, sock, form):
+        """
+        This method sends the given form over the given socket, while no other response is written to the same
+        connection through this sender.
+        Args:
+            sock: The socket object, that came together with the request form from the handler output
+            form: The ResponseForm or ResponseBatchForm object to be sent
+
+        Returns:
+        void
         """
-        This method will take the content of a line, that was received from the socket and interpret it as encoded
-        and pickled data and thus will decode it using the 'base64' codec and then unpickle the resulting bytes object
+        data = form.create_form_bytes()
+        with self.get_lock(sock):
+            # Setting the mode of the connection explicitly, as a non blocking connection would make sendall fail as
+            # soon as the send buffer is full
+            sock.settimeout(self.send_timeout)
+            sock.sendall(data)
+
+    def get_lock(self, sock):
+        """
+        Returns the lock, that is responsible for the connection of the given socket
         Args:
-            content: The bytes string, that was received as content to a line of the form
+            sock: The socket object of the connection
 
         Returns:
-        The object that was originally pickled
+        The threading.Lock object
         """
-        # Decoding the content byte string
-        content_bytes = codecs.decode(content.encode(), "base64")
-        # Unpickling the data
-        content_object = pickle.loads(content_bytes)
-        # Returning the unpickled object
-        return content_object
+        # The crc32 hash is used instead of the builtin hash, as that is randomized per process and the processes, which
+        # share the locks, have to choose the same one
+        key = repr((sock.getsockname(), sock.getpeername())).encode()
+        return self.locks[zlib.crc32(key) % len(self.locks)]
 
 
-class Evaluator(mp.Process):
+class ResponseReceiver(FormReceiveHandler):
+    """
+    The ResponseReceiver is the thread on the client side, that receives the response forms from the connection of a
+    MultiplexClient and hands every response to the waiting future of the request with the same sequence number. It
+    is a FormReceiveHandler, that dispatches the forms to the futures instead of putting them into an output queue.
+    In case the results of a request are split into multiple batches, the results are collected until the final
+    batch arrives, which then resolves the future with a single batch form containing all of them.
+    Args:
+        pending: The dict with the integer sequence numbers as keys and the futures of the requests as values
+        lock: The threading.Lock, which protects the pending dict
+    """
+    def __init__(self, pending, lock):
+        # The responses can take arbitrarily long, thus there are no timeouts for receiving them
+        FormReceiveHandler.__init__(self, None, form_timeout=None, byte_timeout=None)
+        self.daemon = True
+        self.pending = pending
+        self.lock = lock
+        # The dict with the sequence numbers as keys and the lists of the results of the batches, that were received
+        # before the final batch, as values
+        self.partial = {}
+        # Whether the receiver stopped dispatching, the futures registered after that would never be resolved
+        self.closed = False
+
+    def run(self):
+        """
+        The main method of the thread. Receives response forms until the connection is closed and then fails all the
+        requests, which are still pending
+        Returns:
+        void
+        """
+        self.running = True
+        try:
+            while self.running:
+                self.receive_form()
+                if not self.collect_batch(self.form):
+                    continue
+                with self.lock:
+                    future = self.pending.pop(self.form.sequence, None)
+                # The caller may have cancelled the request in the meantime
+                if future is not None and future.set_running_or_notify_cancel():
+                    future.set_result(self.form)
+        except Exception as exception:
+            # Besides the errors of the connection, this also catches unexpected errors, as the receiver has to fail
+            # the pending requests in any case, otherwise their callers would wait forever
+            error = exception
+        else:
+            error = ConnectionError("The response receiver was stopped")
+        # All the requests, that did not get a response by now, will never get one
+        with self.lock:
+            self.closed = True
+            futures = list(self.pending.values())
+            self.pending.clear()
+        for future in futures:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ConnectionError("The connection was closed: {}".format(error)))
+
+    def collect_batch(self, form):
+        """
+        This method collects the results of batch forms, until the final batch of a request arrives. The final batch
+        is then extended by all the results, which were received before it.
+        Args:
+            form: The form, that was received
+
+        Returns:
+        The boolean value of whether the form is complete and can be handed to the future of the request
+        """
+        if not isinstance(form, comm.ResponseBatchForm):
+            return True
+        if not form.final:
+            self.partial.setdefault(form.sequence, []).extend(form.results)
+            return False
+        form.results = self.partial.pop(form.sequence, []) + form.results
+        return True
+
+
+class MultiplexClient:
+    """
+    The MultiplexClient sends requests to the server over a single connection without waiting for the responses of the
+    previous requests. Every request is given the next sequence number of the connection and the response with the
+    same sequence number resolves the future, which was returned for the request. This way hundreds of requests can be
+    outstanding at the same time and a slow request does not delay the responses of the following ones.
+    Args:
+        sock: The already connected socket object to the server
+        id: The string id of the user
+    """
+    def __init__(self, sock, id):
+        self.sock = sock
+        self.id = id
+
+        self._sequence = itertools.count(1)
+        self._send_lock = threading.Lock()
+        # The dict with the sequence numbers as keys and the futures of the not yet answered requests as values
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+        self.receiver = ResponseReceiver(self._pending, self._pending_lock)
+        self.receiver.assign(sock)
+        self.receiver.start()
+
+    @classmethod
+    def connect(cls, ip, port, id, attempts=5, delay=0.05):
+        """
+        Creates a new MultiplexClient with a new connection to the given address
+        Args:
+            ip: The string ip of the server
+            port: The integer port of the server
+            id: The string id of the user
+            attempts: The integer amount of attempts to connect. Default is 5
+            delay: The float amount of seconds before the first retry, which grows exponentially. Default is 0.05
 
-    def __init__(self, input_queue, output_queue, state, handler_amount=2):
+        Returns:
+        The MultiplexClient object
+        """
+        wrapper = SocketWrapper(socket.socket(socket.AF_INET, socket.SOCK_STREAM), False)
+        wrapper.connect(ip, port, attempts, delay)
+        return cls(wrapper.release_socket(), id)
+
+    @property
+    def pending(self):
+        """
+        The integer amount of requests, which were sent but not answered yet
+        """
+        return len(self._pending)
+
+    def request(self, function_name, parameters, addresses, return_mode="blocking", error_mode="discard"):
+        """
+        This method sends a new request to the server and returns without waiting for the response.
+        Args:
+            function_name: The string name of the function to be executed
+            parameters: The list of parameters of the function call
+            addresses: The list of string addresses of the entities, on which the function is to be executed
+            return_mode: The string return mode. Default is "blocking"
+            error_mode: The string error mode. Default is "discard"
+
+        Raises:
+            ConnectionError: In case the connection was already closed
+        Returns:
+        The concurrent.futures.Future, which will be resolved with the ResponseForm to the request
+        """
+        future = concurrent.futures.Future()
+        with self._send_lock:
+            sequence = next(self._sequence)
+            form = comm.RequestForm(function_name, parameters, addresses, return_mode, error_mode, self.id, sequence)
+            # Registering the future before sending, as the response could arrive before the send call returns
+            with self._pending_lock:
+                if self.receiver.closed:
+                    raise ConnectionError("The connection was closed")
+                self._pending[sequence] = future
+            try:
+                self.sock.sendall(form.create_form_bytes())
+            except OSError:
+                with self._pending_lock:
+                    del self._pending[sequence]
+                raise
+        return future
+
+    def close(self):
+        """
+        Closes the connection, all the requests, that are still pending, fail with a ConnectionError
+        Returns:
+        void
+        """
+        self.receiver.stop()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.receiver.join()
+
+
+class Evaluator(mp.Process):
+    """
+    The Evaluator process is the second network instance of the trojan server system. It takes the sockets, that were
+    accepted by the Greeter, from its input queue and watches them with a selector. Once a form arrives on a socket, it
+    is assigned to an idle FormReceiveHandler thread, which will receive the forms from the socket and put the socket
+    and each form as a tuple into the output queue. As soon as there is no further form to receive right away, the
+    handler gives the connection back to be watched again. Thus the connections are persistent, but a handler is only
+    busy while forms are arriving and idle connections cannot block the other clients.
+    In case all handlers are busy when a form arrives, a new handler is being created, until the maximum amount of
+    handlers is reached. Then the evaluator waits until a handler is idle again. The evaluator stops taking sockets from
+    the input queue, while it watches the maximum amount of connections, so that the input queue fills up and the
+    policy of the greeter takes effect.
+    Args:
+        input_queue: The multiprocessing.Queue, from which the (socket, address, trace) tuples of the Greeter are taken
+        output_queue: The multiprocessing.Queue, into which the handlers put the (socket, form) tuples
+        state: A multiprocessing.Value of boolean type, by which the mother process of the server can control the main
+            loop of the Evaluator
+        handler_amount: The integer amount of handlers to be created, when the process starts. Default is 2
+        idle_timeout: The float amount of seconds a connection may stay idle between two forms before it is closed.
+            Default is 30
+        tracer: The tracing.Tracer, which is passed to the handlers. Default is None
+        max_handlers: The integer maximum amount of handlers. Default is 64
+        policy: The policy of the handlers in case the output queue is full, see FormReceiveHandler. Default is BLOCK
+        block_timeout: The float amount of seconds the handlers wait with the BLOCK policy. Default is None
+        form_timeout: The float amount of seconds receiving a whole form may take. Default is 30
+        byte_timeout: The float amount of seconds a client may stay silent in the middle of a form. Default is 10
+        sender: The ResponseSender, through which the handlers send the overloaded responses. It has to be created with
+            shared locks and be the one, that sends the other responses. Default is None, which means the handlers
+            share a sender of their own
+        max_connections: The integer maximum amount of idle connections to watch. Default is 1024
+    """
+    def __init__(self, input_queue, output_queue, state, handler_amount=2, idle_timeout=30, tracer=None,
+                 max_handlers=64, policy=BLOCK, block_timeout=None, form_timeout=30, byte_timeout=10, sender=None,
+                 max_connections=1024):
         mp.Process.__init__(self)
+        # The name of the process
+        self.name = "evaluator"
         # The queues working as standardized interfaces
         self.input = input_queue
         self.output = output_queue
@@ -572,22 +1461,203 @@ class Evaluator(mp.Process):
 
         self.handler_amount = handler_amount
         self.handlers = []
+        self.idle_timeout = idle_timeout
+        self.tracer = tracer
+        self.max_handlers = max_handlers
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.form_timeout = form_timeout
+        self.byte_timeout = byte_timeout
+        self.sender = sender
+        self.max_connections = max_connections
+
+        # The selector watching the idle connections, the (socket, trace) tuples waiting to be registered with it and
+        # the socket pair, by which the other threads wake the selector up for them. All of them are created in the
+        # process itself, as they cannot be passed to it
+        self.selector = None
+        self.waiting = None
+        self.wakeup = None
 
     def run(self):
+        """
+        This is the main method of the process. It creates the initial handlers and the thread, which takes new sockets
+        from the input queue. It then constantly waits for forms to arrive on the watched sockets and assigns those
+        sockets to idle handlers, until the shared state is set to False
+        Returns:
+        void
+        """
+        if self.sender is None:
+            self.sender = ResponseSender()
+        self.selector = selectors.DefaultSelector()
+        self.waiting = queue.Queue()
+        self.wakeup = socket.socketpair()
+        for sock in self.wakeup:
+            sock.setblocking(False)
+        self.selector.register(self.wakeup[0], selectors.EVENT_READ)
+        for _ in range(self.handler_amount):
+            self.add_handler()
+        taker = threading.Thread(target=self.take_connections)
+        taker.daemon = True
+        taker.start()
+
+        try:
+            last_check = time.time()
+            while self.running.value:
+                # Timing out periodically, so that the loop can check the shared state and the idle connections
+                for key, _ in self.selector.select(timeout=0.1):
+                    if key.fileobj is self.wakeup[0]:
+                        self.drain_wakeup()
+                        continue
+                    self.selector.unregister(key.fileobj)
+                    handler = self.wait_for_handler()
+                    if handler is None:
+                        key.fileobj.close()
+                        break
+                    trace, _ = key.data
+                    handler.assign(key.fileobj, trace)
+                self.register_waiting()
+                if time.time() - last_check >= 0.1:
+                    self.close_idle()
+                    last_check = time.time()
+        finally:
+            # Stopping all the handler threads and closing the connections, which are still being watched
+            for handler in self.handlers:
+                handler.stop()
+            self.register_waiting()
+            for key in list(self.selector.get_map().values()):
+                key.fileobj.close()
+            self.selector.close()
+            self.wakeup[1].close()
+
+    def take_connections(self, interval=0.001):
+        """
+        This method is the main loop of the thread, which takes the new sockets from the input queue and passes them on
+        to be watched, until the shared state is set to False. While the maximum amount of connections is watched, no
+        new sockets are taken
+        Args:
+            interval: The float amount of seconds to sleep between the checks for room. Default is 0.001
 
-        while self.running is True:
+        Returns:
+        void
+        """
+        while self.running.value:
+            if self.watched_amount() >= self.max_connections:
+                time.sleep(interval)
+                continue
+            # Timing out periodically, so that the loop can check the shared state
+            try:
+                connection, address, trace = self.input.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if trace is not None:
+                trace.end("greeter.handoff")
+            self.watch(connection, trace)
+
+    def watch(self, sock, trace=None):
+        """
+        This method passes a socket on to be watched by the selector, until the next form arrives on it. It is called by
+        the thread taking the new sockets and by the handlers, as the park function, thus the socket is registered by
+        the main loop itself, which is woken up for it
+        Args:
+            sock: The socket object to watch
+            trace: The tracing.Trace object of the next form on the socket. Default is None
+
+        Returns:
+        void
+        """
+        self.waiting.put((sock, trace))
+        try:
+            self.wakeup[1].send(b'\x00')
+        except OSError:
+            # In case the socket pair is full, the main loop is going to be woken up anyways
             pass
 
-    def add_handler(self):
+    def watched_amount(self):
         """
-        This method will create a new FormReceiveHandler, start the Thread and add it to the internal list
+        Returns the integer amount of connections, that are watched or waiting to be watched
+        """
+        return len(self.selector.get_map()) - 1 + self.waiting.qsize()
+
+    def drain_wakeup(self):
+        """
+        This method receives all the bytes, that were sent to wake up the main loop
         Returns:
         void
         """
-        handler = FormReceiveHandler(self.output)
-        handler.start()
-        self.handlers.append(handler)
+        try:
+            while self.wakeup[0].recv(4096):
+                pass
+        except OSError:
+            pass
 
+    def register_waiting(self):
+        """
+        This method registers all the sockets, which are waiting to be watched, with the selector. Each one remembers
+        its trace and the time since which it is idle
+        Returns:
+        void
+        """
+        while True:
+            try:
+                sock, trace = self.waiting.get_nowait()
+            except queue.Empty:
+                return
+            self.selector.register(sock, selectors.EVENT_READ, (trace, time.time()))
 
+    def close_idle(self):
+        """
+        This method closes all the watched connections, which have been idle for longer than the idle timeout
+        Returns:
+        void
+        """
+        now = time.time()
+        for key in list(self.selector.get_map().values()):
+            if key.fileobj is self.wakeup[0] or now - key.data[1] <= self.idle_timeout:
+                continue
+            self.selector.unregister(key.fileobj)
+            key.fileobj.close()
+
+    def get_idle_handler(self):
+        """
+        This method returns the first handler of the internal list, that is currently idle. In case there is no idle
+        handler, a new one is being created and returned, unless the maximum amount of handlers is reached
+        Returns:
+        The FormReceiveHandler object, that can be assigned a new socket or None if all the handlers are busy
+        """
+        for handler in self.handlers:
+            if handler.idle is True:
+                return handler
+        if len(self.handlers) >= self.max_handlers:
+            return None
+        # In case all the handlers are busy, adding a new one, which will be the last in the list
+        self.add_handler()
+        return self.handlers[-1]
+
+    def wait_for_handler(self, interval=0.001):
+        """
+        This method waits until there is a handler, which can be assigned a new socket
+        Args:
+            interval: The float amount of seconds to sleep between the checks. Default is 0.001
 
+        Returns:
+        The FormReceiveHandler object or None in case the evaluator was stopped while waiting
+        """
+        while self.running.value:
+            handler = self.get_idle_handler()
+            if handler is not None:
+                return handler
+            time.sleep(interval)
+        return None
 
+    def add_handler(self):
+        """
+        This method will create a new FormReceiveHandler, start the Thread and add it to the internal list
+        Returns:
+        void
+        """
+        handler = FormReceiveHandler(self.output, self.idle_timeout, self.tracer, policy=self.policy,
+                                     block_timeout=self.block_timeout, form_timeout=self.form_timeout,
+                                     byte_timeout=self.byte_timeout, sender=self.sender, park=self.watch)
+        handler.daemon = True
+        handler.start()
+        self.handlers.append(handler)
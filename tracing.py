@@ -0,0 +1,229 @@
+import multiprocessing as mp
+import collections
+import contextlib
+import itertools
+import threading
+import random
+import json
+import time
+import os
+
+
+def now():
+    """
+    This function returns the current time in microseconds of the monotonic clock. On linux this clock is shared by
+    all processes of the machine, so that timestamps taken in different processes of the server can be compared.
+    Returns:
+    The integer amount of microseconds
+    """
+    return time.perf_counter_ns() // 1000
+
+
+@contextlib.contextmanager
+def span(trace, name):
+    """
+    This is a context manager, which records the time spent within the 'with' block as a span of the given name into
+    the given trace. In case the trace is None, which is the case for requests that were not sampled, nothing is
+    recorded.
+    Args:
+        trace: The Trace object to record the span into or None
+        name: The string name of the stage
+
+    Returns:
+    void
+    """
+    if trace is None:
+        yield
+        return
+    start = now()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start, now())
+
+
+class Trace:
+    """
+    A Trace object is attached to a single connection or form and travels along with it through the queues of the
+    server. Every stage the item passes records a span with the start and end timestamp, together with the process
+    and the thread it was recorded in. Because the spans travel with the item, stages in different processes end up
+    in the same trace, without any shared state between the processes.
+    Args:
+        trace_id: The string id of the trace
+    Attributes:
+        spans: The list of tuples (name, start, end, pid, tid), with the timestamps in microseconds
+    """
+    def __init__(self, trace_id):
+        self.id = trace_id
+        self.spans = []
+        # The dict of the names of stages, that were began but not yet ended, as keys and the start times as values
+        self._open = {}
+
+    def add_span(self, name, start, end):
+        """
+        Adds a finished span to the trace
+        Args:
+            name: The string name of the stage
+            start: The integer start time in microseconds
+            end: The integer end time in microseconds
+
+        Returns:
+        void
+        """
+        self.spans.append((name, start, end, os.getpid(), threading.get_native_id()))
+
+    def begin(self, name):
+        """
+        Marks the beginning of a stage, which is ended with the 'end' method. This is used for stages, that span a
+        thread or process boundary, like the handoff through a queue.
+        Args:
+            name: The string name of the stage
+
+        Returns:
+        void
+        """
+        self._open[name] = now()
+
+    def end(self, name):
+        """
+        Ends the stage of the given name, that was began with the 'begin' method and adds it as a span. Stages that were
+        never began are ignored.
+        Args:
+            name: The string name of the stage
+
+        Returns:
+        void
+        """
+        start = self._open.pop(name, None)
+        if start is not None:
+            self.add_span(name, start, now())
+
+
+class Tracer:
+    """
+    The Tracer decides which connections or forms are being traced and collects the finished traces, so that they can
+    be dumped in the chrome 'trace_event' format, which can be viewed with chrome://tracing or perfetto.
+    The enabled flag and the sampling rate are shared values, so that the tracing can be toggled at runtime from the
+    mother process, even after the tracer was passed to the Greeter and Evaluator processes.
+    Args:
+        sample_rate: The float fraction between 0 and 1 of the items to be traced. Default is 1.0
+        enabled: The boolean value of whether tracing is enabled from the start. Default is False
+        max_traces: The integer amount of finished traces to keep. The oldest ones are discarded. Default is 10000
+    """
+    def __init__(self, sample_rate=1.0, enabled=False, max_traces=10000):
+        assert 0 <= sample_rate <= 1, "The sample rate has to be between 0 and 1"
+        self._enabled = mp.Value("b", enabled, lock=False)
+        self._sample_rate = mp.Value("d", sample_rate, lock=False)
+
+        self.traces = collections.deque(maxlen=max_traces)
+        self._lock = threading.Lock()
+        # The counter for the trace ids, which are unique together with the process id
+        self._counter = itertools.count()
+
+    @property
+    def enabled(self):
+        return bool(self._enabled.value)
+
+    @property
+    def sample_rate(self):
+        return self._sample_rate.value
+
+    def enable(self, sample_rate=None):
+        """
+        Enables the tracing, optionally changing the sampling rate as well
+        Args:
+            sample_rate: The float fraction of items to be traced. Default is None, which keeps the current rate
+
+        Returns:
+        void
+        """
+        if sample_rate is not None:
+            self.set_sample_rate(sample_rate)
+        self._enabled.value = True
+
+    def disable(self):
+        """
+        Disables the tracing. Items that are already being traced will still finish their trace
+        Returns:
+        void
+        """
+        self._enabled.value = False
+
+    def set_sample_rate(self, sample_rate):
+        """
+        Sets the fraction of the items to be traced
+        Args:
+            sample_rate: The float fraction between 0 and 1
+
+        Returns:
+        void
+        """
+        assert 0 <= sample_rate <= 1, "The sample rate has to be between 0 and 1"
+        self._sample_rate.value = sample_rate
+
+    def start_trace(self):
+        """
+        This method decides whether a new item is being traced and creates a new Trace object for it if so. When the
+        tracing is disabled the cost of this method is a single read of a shared value.
+        Returns:
+        The new Trace object or None in case the item is not traced
+        """
+        if not self._enabled.value:
+            return None
+        if random.random() >= self._sample_rate.value:
+            return None
+        trace_id = "{:x}-{:x}".format(os.getpid(), next(self._counter))
+        return Trace(trace_id)
+
+    def collect(self, trace):
+        """
+        Adds a finished trace to the collected traces of this tracer. None values are ignored, so that the trace
+        attribute of an item can be passed without checking
+        Args:
+            trace: The Trace object or None
+
+        Returns:
+        void
+        """
+        if trace is None:
+            return
+        with self._lock:
+            self.traces.append(trace)
+
+    def create_trace_events(self):
+        """
+        Creates the list of the chrome trace events for all the collected traces. Every span is a complete event with
+        the trace id as argument.
+        Returns:
+        The list of trace event dicts
+        """
+        events = []
+        with self._lock:
+            traces = list(self.traces)
+        for trace in traces:
+            for name, start, end, pid, tid in trace.spans:
+                event = {
+                    "name": name,
+                    "cat": "jtrojan",
+                    "ph": "X",
+                    "ts": start,
+                    "dur": end - start,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"trace_id": trace.id}
+                }
+                events.append(event)
+        return events
+
+    def dump(self, filename):
+        """
+        Writes all the collected traces into a JSON file of the chrome 'trace_event' format
+        Args:
+            filename: The string path of the file to write to
+
+        Returns:
+        void
+        """
+        content = {"traceEvents": self.create_trace_events(), "displayTimeUnit": "ms"}
+        with open(filename, "w") as file:
+            json.dump(content, file)
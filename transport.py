@@ -0,0 +1,224 @@
+from multiprocessing import shared_memory
+import JTrojan2.communication as comm
+import struct
+import os
+import queue
+import time
+
+
+# The layout of the control block at the beginning of the shared memory. It contains the four counters of the ring
+# buffer: the byte positions of the head and the tail and the amount of records put and gotten. The tail and the put
+# counter are only ever written by the producer, the head and the get counter only by the consumer
+CONTROL = struct.Struct("<QQQQ")
+HEAD = 0
+TAIL = 8
+PUTS = 16
+GETS = 24
+
+# Every record in the ring is framed by its length
+FRAME = struct.Struct("<I")
+
+
+def encode_form(form):
+    """
+    Encodes the form into the bytes of a record, which are the same bytes as sent over the socket
+    """
+    return form.create_form_bytes()
+
+
+def decode_form(data):
+    """
+    Decodes the bytes of a record back into the form object
+    """
+    return comm.parse_form_bytes(data)
+
+
+class RingBuffer:
+    """
+    The RingBuffer is a transport between exactly one producing and one consuming process, which is based on shared
+    memory instead of a pipe. The records are copied into a ring of bytes, framed by their length, so handing over an
+    item costs a copy into and out of the shared memory, but no pickling, no write to a pipe and no feeder thread.
+    The ring does not use any locks: the producer only ever advances the tail and the consumer only ever advances the
+    head, both after the record itself has been copied. Thus there may only be one producer and one consumer at a time,
+    multiple producers need multiple rings.
+    The interface is that of the queues, so the ring can be used with 'network.put_with_policy' and
+    'network.queue_depth'. Waiting for space or for a record is done by polling with short sleeps, as there is no way to
+    wait for a change of the shared memory.
+    The items are converted into bytes with the encode function and back with the decode function, by default the
+    items have to be bytes already. To pass forms, 'encode_form' and 'decode_form' can be used. Note that the trace of
+    a form is not part of its bytes and does not travel through the ring.
+    The ring can be passed to a child process as argument, the child then attaches to the same shared memory.
+    Args:
+        capacity: The integer amount of bytes of the ring. Default is 1 MB
+        encode: The function to turn an item into bytes. Default is None, which means the items are bytes
+        decode: The function to turn bytes into an item. Default is None, which means the items are bytes
+        name: The string name of existing shared memory to attach to. Default is None, which creates new shared memory
+    """
+    def __init__(self, capacity=1 << 20, encode=None, decode=None, name=None):
+        assert capacity > FRAME.size, "The capacity has to fit at least the frame of a record"
+        self.capacity = capacity
+        self.encode = encode
+        self.decode = decode
+        # Only the process, that created the shared memory, removes it in the end. The process id is remembered instead
+        # of a flag, as forked children inherit the object as it is
+        self.owner = os.getpid() if name is None else None
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=CONTROL.size + capacity)
+            CONTROL.pack_into(self.memory.buf, 0, 0, 0, 0, 0)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.control = self.memory.buf[:CONTROL.size]
+        self.data = self.memory.buf[CONTROL.size:CONTROL.size + capacity]
+
+    def __getstate__(self):
+        return self.memory.name, self.capacity, self.encode, self.decode
+
+    def __setstate__(self, state):
+        name, capacity, encode, decode = state
+        self.__init__(capacity, encode, decode, name)
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Copies the item into the ring, waiting for enough space, if block is True, at most for the timeout
+        Raises:
+            queue.Full: In case there was not enough space in time
+            ValueError: In case the item would not even fit into the empty ring
+        Args:
+            item: The item to put into the ring
+            block: The boolean value of whether to wait for space. Default is True
+            timeout: The float maximum amount of seconds to wait. Default is None, which means waiting until there is
+
+        Returns:
+        void
+        """
+        data = item if self.encode is None else self.encode(item)
+        size = FRAME.size + len(data)
+        if size > self.capacity:
+            raise ValueError("The record of {} bytes does not fit into the ring".format(len(data)))
+
+        tail = self.read_counter(TAIL)
+        if not self.wait(lambda: self.capacity - (tail - self.read_counter(HEAD)) >= size, block, timeout):
+            raise queue.Full
+        self.write(tail, FRAME.pack(len(data)))
+        self.write(tail + FRAME.size, data)
+        # Publishing the record only after it was copied completely
+        self.write_counter(PUTS, self.read_counter(PUTS) + 1)
+        self.write_counter(TAIL, tail + size)
+
+    def put_nowait(self, item):
+        """
+        Copies the item into the ring without waiting for space
+        Raises:
+            queue.Full: In case there is not enough space
+        """
+        self.put(item, False)
+
+    def get(self, block=True, timeout=None):
+        """
+        Takes the next record out of the ring, waiting for one, if block is True, at most for the timeout
+        Raises:
+            queue.Empty: In case there was no record in time
+        Args:
+            block: The boolean value of whether to wait for a record. Default is True
+            timeout: The float maximum amount of seconds to wait. Default is None, which means waiting until there is
+
+        Returns:
+        The item
+        """
+        head = self.read_counter(HEAD)
+        if not self.wait(lambda: self.read_counter(TAIL) != head, block, timeout):
+            raise queue.Empty
+        length, = FRAME.unpack(self.read(head, FRAME.size))
+        data = self.read(head + FRAME.size, length)
+        # Releasing the space only after the record was copied out
+        self.write_counter(GETS, self.read_counter(GETS) + 1)
+        self.write_counter(HEAD, head + FRAME.size + length)
+        return data if self.decode is None else self.decode(data)
+
+    def get_nowait(self):
+        """
+        Takes the next record out of the ring without waiting
+        Raises:
+            queue.Empty: In case there is no record
+        """
+        return self.get(False)
+
+    def qsize(self):
+        """
+        Returns the integer amount of records in the ring
+        """
+        return self.read_counter(PUTS) - self.read_counter(GETS)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def used(self):
+        """
+        Returns the integer amount of bytes in the ring, including the frames of the records
+        """
+        return self.read_counter(TAIL) - self.read_counter(HEAD)
+
+    def close(self):
+        """
+        Detaches from the shared memory. The creator of the ring also removes the shared memory, thus it has to be
+        closed last
+        Returns:
+        void
+        """
+        self.control.release()
+        self.data.release()
+        self.memory.close()
+        if self.owner == os.getpid():
+            self.memory.unlink()
+
+    @staticmethod
+    def wait(condition, block, timeout):
+        """
+        Polls the condition until it is True. The first checks are done right after each other, after that the sleeps
+        between the checks grow up to a millisecond, so a waiting side reacts fast without burning a core for long.
+        Args:
+            condition: The function returning the boolean value to wait for
+            block: The boolean value of whether to wait at all
+            timeout: The float maximum amount of seconds to wait or None
+
+        Returns:
+        The boolean value of whether the condition became True
+        """
+        if condition():
+            return True
+        if not block:
+            return False
+        deadline = None if timeout is None else time.time() + timeout
+        interval = 0
+        while not condition():
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2 or 0.00001, 0.001)
+        return True
+
+    def read_counter(self, offset):
+        return int.from_bytes(self.control[offset:offset + 8], "little")
+
+    def write_counter(self, offset, value):
+        self.control[offset:offset + 8] = value.to_bytes(8, "little")
+
+    def write(self, position, data):
+        """
+        Copies the data into the ring at the given position, wrapping around at the end of the ring
+        """
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.data[start:start + first] = data[:first]
+        self.data[:len(data) - first] = data[first:]
+
+    def read(self, position, length):
+        """
+        Copies the data of the given length out of the ring at the given position, wrapping around at the end of the
+        ring
+        """
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        if first == length:
+            return bytes(self.data[start:start + length])
+        return b''.join([self.data[start:start + first], self.data[:length - first]])